@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+IT Management Network Monitor Agent Test Harness
+Fake collectors, clocks and backend sessions for running the real agent pipeline
+offline, and the diagnostic commands built on them.
+
+The agent's soak, record, replay, replay-diff and profile commands import this
+module on demand; the agent itself never does, so none of it is loaded by the
+service. Tests, benchmark_agent.py and fleet_simulator.py use the fakes directly.
+"""
+
+import os
+import time
+import json
+import gzip
+import random
+import socket
+import logging
+import threading
+from collections import defaultdict
+
+from network_monitor_agent import (
+    AGENT_VERSION, UPDATE_INTERVAL, NetworkMonitorAgent, MemoryProfiler, NetIOCounters, Address, Connection
+)
+
+SOAK_GROWTH_LIMIT = 512 * 1024  # bytes of traced growth allowed after the warm-up
+SOAK_WARMUP_HOURS = 12  # simulated hours before the soak baseline, at most half the run
+SYNTHETIC_DOMAINS = ['google.com', 'youtube.com', 'teams.microsoft.com', 'office.com', 'zoom.us',
+                     'slack.com', 'github.com', 'dropbox.com', 'cloudfront.net', 'akamai.net',
+                     'amazonaws.com', 'fastly.com', 'whatsapp.com', 'linkedin.com', 'spotify.com']
+
+class VirtualClock:
+    """Manually advanced stand-in for the time module (monotonic() and time())"""
+
+    def __init__(self, start=None):
+        self.epoch = time.time() if start is None else start
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.epoch + self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def set(self, monotonic, wall):
+        """Jump to a recorded (monotonic, wall clock) pair"""
+        self.now = monotonic
+        self.epoch = wall - monotonic
+
+class SyntheticCollector:
+    """Deterministic fake collector: office-hours traffic over a fixed pool of hosts"""
+
+    def __init__(self, clock, seed=1, hosts=2000, peak_connections=80):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.hosts = [f"{self.random.randint(1, 223)}.{self.random.randint(0, 255)}."
+                      f"{self.random.randint(0, 255)}.{self.random.randint(1, 254)}" for _ in range(hosts)]
+        self.names = SYNTHETIC_DOMAINS
+        self.peak_connections = peak_connections
+        self.flows = {}
+        self.next_port = 49152
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.last_time = clock.monotonic()
+
+    def activity(self):
+        """0.1 overnight, 1.0 during office hours"""
+        hour = (self.clock.time() / 3600) % 24
+        return 1.0 if 9 <= hour < 18 else 0.1
+
+    def net_io_counters(self):
+        now = self.clock.monotonic()
+        elapsed, self.last_time = now - self.last_time, now
+        level = self.activity()
+        self.bytes_sent += int(elapsed * level * self.random.uniform(5e3, 2e5))
+        self.bytes_recv += int(elapsed * level * self.random.uniform(2e4, 2e6))
+        return NetIOCounters(self.bytes_sent, self.bytes_recv)
+
+    def net_connections(self):
+        target = max(1, int(self.peak_connections * self.activity()))
+        for key in [key for key in self.flows if self.random.random() < 0.2]:
+            del self.flows[key]
+        while len(self.flows) < target:
+            self.next_port = 49152 + (self.next_port - 49151) % 16000
+            remote = Address(self.random.choice(self.hosts), self.random.choice((443, 443, 443, 80, 8443, 5228)))
+            self.flows[(self.next_port, remote)] = Connection(Address('10.0.0.2', self.next_port), remote,
+                                                              'ESTABLISHED', 4)
+        return list(self.flows.values())
+
+    def gethostbyaddr(self, ip):
+        index = sum(int(octet) for octet in ip.split('.'))
+        if index % 10 < 3:
+            raise socket.herror(1, "Unknown host")
+        return (f"edge{index % 50}.{self.names[index % len(self.names)]}", [], [ip])
+
+RECORDING_FORMAT = 'itmonitor-recording'
+RECORDING_VERSION = 1
+
+class RecordingCollector:
+    """Wraps a collector and records every raw input it returns, one tick per line
+
+    The file is gzip-compressed JSON lines: a header, then per tick the wall and
+    monotonic time, IO counters, the connection table (when scanned) and the
+    reverse DNS answers looked up during that tick (null for failures).
+    """
+
+    def __init__(self, inner, path, clock=time):
+        self.inner = inner
+        self.clock = clock
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+        self.file.write(json.dumps({'format': RECORDING_FORMAT, 'version': RECORDING_VERSION,
+                                    'agentVersion': AGENT_VERSION}) + "\n")
+        self.tick = None
+        self.ticks = 0
+
+    def _flush(self):
+        if self.tick is not None:
+            self.file.write(json.dumps(self.tick, separators=(',', ':')) + "\n")
+            self.ticks += 1
+            self.tick = None
+
+    def net_io_counters(self):
+        # Each tick starts with an IO counter read
+        self._flush()
+        counters = self.inner.net_io_counters()
+        self.tick = {'t': round(self.clock.time(), 3), 'm': round(self.clock.monotonic(), 3),
+                     'io': [counters.bytes_sent, counters.bytes_recv]}
+        return counters
+
+    def net_connections(self):
+        connections = self.inner.net_connections()
+        if self.tick is not None:
+            self.tick['conns'] = [[conn.laddr.ip, conn.laddr.port, conn.raddr.ip, conn.raddr.port,
+                                   conn.status, conn.pid]
+                                  for conn in connections if conn.laddr and conn.raddr]
+        return connections
+
+    def gethostbyaddr(self, ip):
+        try:
+            answer = self.inner.gethostbyaddr(ip)
+        except Exception:
+            if self.tick is not None:
+                self.tick.setdefault('dns', {})[ip] = None
+            raise
+        if self.tick is not None:
+            self.tick.setdefault('dns', {})[ip] = answer[0]
+        return answer
+
+    def close(self):
+        """Write the last tick and close the file"""
+        self._flush()
+        self.file.close()
+
+class ReplayCollector:
+    """Feeds a RecordingCollector file back to the agent, driving a VirtualClock"""
+
+    def __init__(self, path, clock):
+        self.file = gzip.open(path, 'rt', encoding='utf-8')
+        header = json.loads(self.file.readline() or '{}')
+        if header.get('format') != RECORDING_FORMAT or header.get('version') != RECORDING_VERSION:
+            raise ValueError(f"{path} is not a version {RECORDING_VERSION} agent recording")
+        self.header = header
+        self.clock = clock
+        self.current = None
+        self.connections = []
+        self.dns = {}
+
+    def next_tick(self):
+        """Advance to the next recorded tick; False at the end of the recording"""
+        line = self.file.readline()
+        if not line:
+            self.file.close()
+            return False
+        self.current = json.loads(line)
+        self.clock.set(self.current['m'], self.current['t'])
+        if 'conns' in self.current:
+            self.connections = [Connection(Address(lip, lport), Address(rip, rport), status, pid)
+                                for lip, lport, rip, rport, status, pid in self.current['conns']]
+        self.dns.update(self.current.get('dns', {}))
+        return True
+
+    def net_io_counters(self):
+        return NetIOCounters(*self.current['io'])
+
+    def net_connections(self):
+        return self.connections
+
+    def gethostbyaddr(self, ip):
+        name = self.dns.get(ip)
+        if name is None:
+            raise socket.herror(1, "Unknown host (not answered in recording)")
+        return (name, [], [ip])
+
+class CaptureSession:
+    """Fake requests session that keeps uploaded payloads instead of sending them"""
+
+    def __init__(self):
+        self.payloads = []
+
+    def post(self, url, json=None, **kwargs):
+        if url.endswith('/logs'):
+            self.payloads.append(json)
+            return SoakResponse(201)
+        return SoakResponse(200)
+
+class SoakResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+class SoakSession:
+    """Fake requests session: accepts everything except during a daily outage window"""
+
+    def __init__(self, clock, outage_hours=(2, 6)):
+        self.clock = clock
+        self.outage_hours = outage_hours
+
+    def post(self, url, **kwargs):
+        hour = (self.clock.time() / 3600) % 24
+        if self.outage_hours[0] <= hour < self.outage_hours[1]:
+            raise ConnectionError("simulated backend outage")
+        return SoakResponse(201 if url.endswith('/logs') else 200)
+
+def soak_agent(days=7, tick_seconds=30, sample_hours=4, warmup_hours=SOAK_WARMUP_HOURS,
+               growth_limit=SOAK_GROWTH_LIMIT, hosts=2000):
+    """Run the pipeline for a simulated period against fake collectors; True if memory stays flat
+
+    Uses a virtual clock, SyntheticCollector and a backend that is down four hours
+    a night, so network_stats has to hold several hours of data between uploads.
+    Tracing starts after the warm-up (capped at half the run, so there is always
+    a measured period), once the caches and pending stats have filled; whatever
+    the agent allocates after that and still holds at the end counts as growth.
+    """
+    clock = VirtualClock(start=0)
+    agent = NetworkMonitorAgent()
+    agent.log = lambda message, level=logging.INFO: None
+    agent.clock = clock
+    agent.collector = SyntheticCollector(clock, hosts=hosts)
+    agent.session = SoakSession(clock)
+    agent.agent_token = agent.agent_token or 'soak-test'
+    
+    ticks = int(days * 86400 / tick_seconds)
+    ticks_per_sample = max(1, int(sample_hours * 3600 / tick_seconds))
+    ticks_per_upload = max(1, int(UPDATE_INTERVAL / tick_seconds))
+    warmup_hours = min(warmup_hours, days * 12)
+    warmup_ticks = max(1, int(warmup_hours * 3600 / tick_seconds))
+    warm_memory = None
+    print(f"Warm-up: {warmup_hours:g} h")
+    print(f"{'day':>6}{'traced KB':>12}{'labels':>8}{'cache':>8}")
+    
+    for tick in range(1, ticks + 1):
+        clock.advance(tick_seconds)
+        agent.monitor_network_traffic()
+        if tick % ticks_per_upload == 0:
+            agent.send_data_to_backend()
+        if tick == warmup_ticks:
+            agent.memory_profiler = MemoryProfiler()
+            agent.memory_profiler.sample()
+            warm_memory, _ = agent.memory_profiler.traced_memory()
+        elif warm_memory is not None and (tick - warmup_ticks) % ticks_per_sample == 0:
+            agent.memory_profiler.sample()
+        else:
+            continue
+        current, _ = agent.memory_profiler.traced_memory()
+        day = tick * tick_seconds / 86400
+        print(f"{day:>6.2f}{current / 1024:>12.0f}{len(agent.network_stats):>8}{len(agent.domain_cache):>8}")
+    
+    if warm_memory is None:
+        print("Soak FAILED: the run ended before the warm-up")
+        return False
+    current, peak = agent.memory_profiler.traced_memory()
+    growth = current - warm_memory
+    suspects = agent.memory_profiler.suspects
+    agent.memory_profiler.stop()
+    agent.memory_profiler = None
+    
+    print(f"\nGrowth after warm-up: {growth / 1024:.1f} KB (limit {growth_limit / 1024:.0f} KB), "
+          f"peak {peak / 1024:.0f} KB")
+    for site, size, streak in suspects:
+        print(f"LEAK SUSPECT {site}: +{size / 1024:.1f} KB over {streak} samples")
+    passed = growth <= growth_limit and not suspects
+    print("Soak PASSED: memory profile is flat" if passed else "Soak FAILED: memory keeps growing")
+    return passed
+
+def run_offline(agent, seconds):
+    """Run the live agent for seconds without contacting the backend or changing the installation
+
+    Uploads and heartbeats are built as usual but kept by a CaptureSession, and the
+    command, rules and update workers idle, so no pushed command, rules version,
+    update or rollback takes effect during the run and nothing restarts the agent.
+    """
+    agent.session = CaptureSession()
+    agent.agent_token = agent.agent_token or 'offline'
+    agent.relay_url = None
+    agent.udp_heartbeat = None
+    agent.auto_update = False
+    agent.updater.state = {}  # an installed update is neither confirmed nor rolled back by this run
+    agent.command_loop = agent.rules_loop = agent.update_loop = lambda lease: agent.stop_event.wait()
+    timer = threading.Timer(seconds, agent.stop)
+    timer.daemon = True
+    timer.start()
+    try:
+        agent.run()
+    finally:
+        timer.cancel()
+
+def record_agent(seconds, path):
+    """Run the live agent offline for a while, recording its raw collector inputs to path"""
+    agent = NetworkMonitorAgent()
+    recorder = RecordingCollector(agent.collector, path)
+    agent.collector = recorder
+    try:
+        run_offline(agent, seconds)
+    finally:
+        recorder.close()
+    print(f"Recorded {recorder.ticks} ticks to {path} ({os.path.getsize(path) / 1024:.1f} KB)")
+
+def replay_agent(path, output=None):
+    """Replay a recording through the real pipeline as fast as possible
+
+    Uploads happen every UPDATE_INTERVAL of recorded time and are captured instead
+    of sent. Writes the deterministic part of each upload as JSON lines to output
+    so two replays (e.g. before/after a classification change) can be diffed.
+    """
+    clock = VirtualClock()
+    collector = ReplayCollector(path, clock)
+    agent = NetworkMonitorAgent()
+    agent.log = lambda message, level=logging.INFO: None
+    agent.clock = clock
+    agent.collector = collector
+    agent.session = CaptureSession()
+    agent.agent_token = agent.agent_token or 'replay'
+    
+    started = time.monotonic()
+    ticks = 0
+    first_tick = last_upload = None
+    while collector.next_tick():
+        ticks += 1
+        if first_tick is None:
+            first_tick = last_upload = clock.monotonic()
+        agent.monitor_network_traffic()
+        if clock.monotonic() - last_upload >= UPDATE_INTERVAL:
+            agent.send_data_to_backend()
+            last_upload = clock.monotonic()
+    agent.send_data_to_backend()
+    wall = time.monotonic() - started
+    recorded = clock.monotonic() - (first_tick or 0)
+    
+    uploads = [replay_summary(payload, index) for index, payload in enumerate(agent.session.payloads)]
+    if output:
+        with open(output, 'w') as f:
+            for upload in uploads:
+                f.write(json.dumps(upload, sort_keys=True) + "\n")
+    print(f"Replayed {ticks} ticks ({recorded / 3600:.2f} h recorded) in {wall:.2f} s "
+          f"({recorded / max(wall, 1e-6):.0f}x real time), {len(uploads)} uploads")
+    return uploads
+
+def replay_summary(payload, index):
+    """Deterministic, diffable subset of an upload payload"""
+    return {
+        'upload': index,
+        'totalUploadMB': payload['totalUploadMB'],
+        'totalDownloadMB': payload['totalDownloadMB'],
+        'websites': sorted(({key: site[key] for key in ('domain', 'uploadMB', 'downloadMB', 'requestCount',
+                                                        'rateBps', 'distinctRemoteIps', 'distinctRemotePorts')}
+                            for site in payload['websites']), key=lambda site: site['domain'])
+    }
+
+def diff_replays(path_a, path_b):
+    """Compare per-label totals of two replay outputs; returns True if identical"""
+    def totals(path):
+        result = defaultdict(float)
+        with open(path) as f:
+            for line in f:
+                for site in json.loads(line)['websites']:
+                    result[site['domain']] += site['uploadMB'] + site['downloadMB']
+        return result
+    
+    a, b = totals(path_a), totals(path_b)
+    changed = [(label, a.get(label, 0.0), b.get(label, 0.0)) for label in sorted(set(a) | set(b))
+               if abs(a.get(label, 0.0) - b.get(label, 0.0)) >= 0.005]
+    print(f"{'label':<40}{'A MB':>12}{'B MB':>12}")
+    for label, before, after in sorted(changed, key=lambda item: -abs(item[2] - item[1])):
+        print(f"{label[:39]:<40}{before:>12.2f}{after:>12.2f}")
+    print(f"{len(changed)} of {len(set(a) | set(b))} labels differ")
+    return not changed
+
+def profile_agent(agent, seconds, trace_file=None):
+    """Run the agent loop offline for a while and print per-stage latency percentiles"""
+    agent.profiler.tracing = trace_file is not None
+    run_offline(agent, seconds)
+    
+    print()
+    print(agent.profiler.report())
+    if trace_file:
+        agent.profiler.write_trace(trace_file)
+        print(f"\nChrome trace written to {trace_file} ({len(agent.profiler.trace_events)} events)")
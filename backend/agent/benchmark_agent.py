@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+IT Management Network Monitor Agent Benchmarks
+Micro-benchmarks for the agent's per-tick hot paths, run against synthetic fixtures.
+
+Usage:
+    python benchmark_agent.py [--output results.json] [--compare baseline.json]
+                              [--threshold 0.2] [--filter name-prefix]
+
+Results are written as JSON so runs from two commits can be compared; with
+--compare the script exits with status 1 if any benchmark got slower than the
+baseline by more than the threshold.
+
+The startup/ benchmarks run fresh interpreters: the module's cumulative cost in
+`python -X importtime` and the wall time of `network_monitor_agent.py status`.
+They have fixed budgets and the script exits with status 1 when one is exceeded
+(`--filter startup/` runs only those).
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import statistics
+import subprocess
+import atexit
+import shutil
+import tempfile
+from datetime import datetime
+
+# Benchmark agents get a scratch config, log and rules cache instead of ~/.it_monitor
+if not os.environ.get('ITMONITOR_HOME'):
+    os.environ['ITMONITOR_HOME'] = tempfile.mkdtemp(prefix='itmonitor-bench-')
+    atexit.register(shutil.rmtree, os.environ['ITMONITOR_HOME'], ignore_errors=True)
+
+from network_monitor_agent import (
+    AGENT_VERSION, NetworkMonitorAgent, NetIOCounters, Address, Connection, new_label_stats, get_cli_option
+)
+from agent_harness import VirtualClock, CaptureSession
+
+RESULTS_FORMAT = 'itmonitor-benchmark'
+RESULTS_VERSION = 1
+TARGET_SECONDS = 0.2  # minimum wall time of one timed repeat
+REPEATS = 5
+DEFAULT_THRESHOLD = 0.2  # relative slowdown reported as a regression
+IMPORT_TIME_BUDGET_MS = 60  # cumulative -X importtime cost of importing network_monitor_agent
+STATUS_BUDGET_MS = 150  # wall time of `network_monitor_agent.py status`, interpreter start included
+STARTUP_REPEATS = 7
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT_SCRIPT = os.path.join(AGENT_DIR, 'network_monitor_agent.py')
+CONNECTION_COUNTS = [10, 100, 1000, 5000]
+LABEL_COUNTS = [10, 100, 1000]
+
+# Host names returned by the fixture resolver, keyed by the last octet's bucket
+FIXTURE_HOSTS = ['edge-fra1.youtube.com', 'www.github.com', 'd3k81ch9hvuctc.cloudfront.net',
+                 'teams.microsoft.com', 'api.slack.com', 'a23-45-67-89.deploy.akamai.net',
+                 'lb-140-82-114-4-iad.github.com', 'mail.example.org']
+
+class FixtureCollector:
+    """Fixed connection table and instant, deterministic reverse DNS"""
+
+    def __init__(self, connections=0):
+        self.bytes_sent = 0
+        self.bytes_recv = 0
+        self.connections = [
+            Connection(Address('10.0.0.2', 49152 + index), Address(fixture_ip(index), 443), 'ESTABLISHED', 4)
+            for index in range(connections)
+        ]
+
+    def net_io_counters(self):
+        self.bytes_sent += 250000
+        self.bytes_recv += 2000000
+        return NetIOCounters(self.bytes_sent, self.bytes_recv)
+
+    def net_connections(self):
+        return self.connections
+
+    def gethostbyaddr(self, ip):
+        last = int(ip.rsplit('.', 1)[1])
+        if last % 10 == 9:
+            raise socket.herror(1, "Unknown host")
+        return (FIXTURE_HOSTS[last % len(FIXTURE_HOSTS)], [], [ip])
+
+def fixture_ip(index):
+    """Public address outside the built-in service ranges"""
+    return f"93.{(index >> 16) & 0xff}.{(index >> 8) & 0xff}.{index & 0xff}"
+
+def make_agent(connections=0):
+    """Agent wired to fixtures: virtual clock, fixture collector, capturing session"""
+    clock = VirtualClock(start=0)
+    agent = NetworkMonitorAgent()
+    agent.clock = clock
+    agent.collector = FixtureCollector(connections)
+    agent.session = CaptureSession()
+    agent.agent_token = agent.agent_token or 'benchmark'
+    return agent
+
+def measure(func, target=TARGET_SECONDS, repeats=REPEATS):
+    """Time func like timeit: calibrate a loop count, then take several repeats (seconds per call)"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= target / 4 or loops >= 1 << 24:
+            break
+        loops *= 4 if elapsed < target / 40 else 2
+    loops = max(1, int(loops * target / max(elapsed, 1e-9)))
+
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - start) / loops)
+    return loops, timings
+
+# Benchmark registry: (name, setup) where setup returns the zero-argument callable to time
+BENCHMARKS = []
+
+def benchmark(name):
+    """Register a benchmark fixture under name"""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+@benchmark('resolve_ip_to_domain/cache-hit')
+def bench_resolve_hit():
+    agent = make_agent()
+    agent.resolve_ip_to_domain('93.0.0.1')
+    return lambda: agent.resolve_ip_to_domain('93.0.0.1')
+
+@benchmark('resolve_ip_to_domain/cache-miss')
+def bench_resolve_miss():
+    agent = make_agent()
+    def run():
+        agent.domain_cache.clear()
+        agent.resolve_ip_to_domain('93.0.0.1')
+    return run
+
+@benchmark('resolve_ip_to_domain/cdn')
+def bench_resolve_cdn():
+    agent = make_agent()
+    def run():
+        agent.domain_cache.clear()
+        agent.resolve_ip_to_domain('93.0.0.2')  # d3k81ch9hvuctc.cloudfront.net
+    return run
+
+@benchmark('resolve_ip_to_domain/private')
+def bench_resolve_private():
+    agent = make_agent()
+    def run():
+        agent.domain_cache.clear()
+        agent.resolve_ip_to_domain('192.168.1.20')
+    return run
+
+@benchmark('resolve_ip_to_domain/lookup-failure')
+def bench_resolve_failure():
+    agent = make_agent()
+    def run():
+        agent.domain_cache.clear()
+        agent.resolve_ip_to_domain('93.0.0.9')
+    return run
+
+@benchmark('get_service_name_by_ip/known-range')
+def bench_service_known():
+    agent = make_agent()
+    return lambda: agent.get_service_name_by_ip('142.250.190.78')
+
+@benchmark('get_service_name_by_ip/unknown')
+def bench_service_unknown():
+    agent = make_agent()
+    return lambda: agent.get_service_name_by_ip('93.184.216.34')
+
+@benchmark('is_private_ip/private')
+def bench_private_private():
+    agent = make_agent()
+    return lambda: agent.is_private_ip('10.1.2.3')
+
+@benchmark('is_private_ip/public')
+def bench_private_public():
+    agent = make_agent()
+    return lambda: agent.is_private_ip('93.184.216.34')
+
+@benchmark('is_ip_like/hostname')
+def bench_ip_like_hostname():
+    agent = make_agent()
+    return lambda: agent.is_ip_like('edge-fra1.youtube.com')
+
+@benchmark('is_ip_like/numeric-hostname')
+def bench_ip_like_numeric():
+    agent = make_agent()
+    return lambda: agent.is_ip_like('93-184-216-34.static.1e100.net')
+
+def bench_monitor(connections):
+    """Steady-state tick: resolution cache warm, connection table unchanged"""
+    agent = make_agent(connections)
+    def run():
+        agent.clock.advance(1)
+        agent.monitor_network_traffic()
+    run()
+    run()
+    return run
+
+def payload_agent(labels):
+    """Agent holding one upload interval's worth of stats for the given number of labels"""
+    agent = make_agent()
+    for index in range(labels):
+        stats = agent.network_stats[f"label-{index}.example.com"] = new_label_stats()
+        for tick in range(10):
+            stats['upload'] += 0.01
+            stats['download'] += 0.1
+            stats['count'] += 3
+            stats['rate'].add(1000.0 * (index + 1) * (tick + 1))
+            stats['remote_ips'].add(fixture_ip(index * 10 + tick))
+            stats['remote_ports'].add(str(443 + tick % 3))
+    return agent
+
+def bench_build(labels):
+    agent = payload_agent(labels)
+    return agent.build_payload
+
+def bench_serialize(labels):
+    payload = payload_agent(labels).build_payload()
+    return lambda: json.dumps(payload)
+
+def bench_send(labels):
+    """send_data_to_backend end to end (capturing session); stats are restored after each send"""
+    agent = payload_agent(labels)
+    stats = dict(agent.network_stats)
+    def run():
+        agent.network_stats.update(stats)
+        agent.send_data_to_backend()
+        del agent.session.payloads[:]
+    return run
+
+for count in CONNECTION_COUNTS:
+    benchmark(f'monitor_network_traffic/{count}-connections')(lambda count=count: bench_monitor(count))
+for count in LABEL_COUNTS:
+    benchmark(f'build_payload/{count}-labels')(lambda count=count: bench_build(count))
+    benchmark(f'payload_json/{count}-labels')(lambda count=count: bench_serialize(count))
+    benchmark(f'send_data_to_backend/{count}-labels')(lambda count=count: bench_send(count))
+
+def startup_env():
+    """Subprocess environment with bytecode caching allowed, as on an installed agent"""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [AGENT_DIR, env.get('PYTHONPATH')]))
+    return env
+
+def measure_import_time(repeats=STARTUP_REPEATS):
+    """Cumulative import time of network_monitor_agent reported by -X importtime (seconds per run)"""
+    timings = []
+    for _ in range(repeats + 1):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import network_monitor_agent'],
+                                env=startup_env(), capture_output=True, text=True)
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == 'network_monitor_agent':
+                timings.append(int(fields[1]) / 1e6)
+    if len(timings) <= repeats:
+        raise RuntimeError(f"importing network_monitor_agent failed: {result.stderr.strip()[-300:]}")
+    return timings[1:]  # the first run only writes the bytecode cache
+
+def measure_status(repeats=STARTUP_REPEATS):
+    """Wall time of a `status` invocation in a fresh interpreter (seconds per run)"""
+    timings = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, AGENT_SCRIPT, 'status'], env=startup_env(), capture_output=True)
+        timings.append(time.perf_counter() - start)
+    return timings[1:]
+
+# Startup benchmarks: (name, measure, budget in seconds)
+STARTUP_BENCHMARKS = [
+    ('startup/import', measure_import_time, IMPORT_TIME_BUDGET_MS / 1000),
+    ('startup/status', measure_status, STATUS_BUDGET_MS / 1000)
+]
+
+def git_commit():
+    """Current commit of the checkout, if any"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def run_benchmarks(name_filter=None):
+    """Run the registered benchmarks and return the results document"""
+    results = []
+    print(f"{'benchmark':<46}{'median':>12}{'min':>12}{'loops':>10}")
+    runs = [(name, lambda setup=setup: measure(setup()), None) for name, setup in BENCHMARKS]
+    runs += [(name, lambda run=run: (1, run()), budget) for name, run, budget in STARTUP_BENCHMARKS]
+    for name, run, budget in runs:
+        if name_filter and not name.startswith(name_filter):
+            continue
+        loops, timings = run()
+        result = {
+            'name': name,
+            'loops': loops,
+            'repeats': len(timings),
+            'medianNs': round(statistics.median(timings) * 1e9, 1),
+            'minNs': round(min(timings) * 1e9, 1),
+            'stdevNs': round(statistics.pstdev(timings) * 1e9, 1)
+        }
+        line = f"{name:<46}{format_ns(result['medianNs']):>12}{format_ns(result['minNs']):>12}{loops:>10}"
+        if budget is not None:
+            result['budgetNs'] = round(budget * 1e9, 1)
+            line += f"  (budget {format_ns(result['budgetNs'])})"
+        results.append(result)
+        print(line)
+
+    return {
+        'format': RESULTS_FORMAT,
+        'version': RESULTS_VERSION,
+        'agentVersion': AGENT_VERSION,
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results
+    }
+
+def format_ns(ns):
+    """Human readable duration for a nanosecond figure"""
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if ns >= scale:
+            return f"{ns / scale:.2f} {unit}"
+    return f"{ns:.0f} ns"
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Print per-benchmark change against a baseline; returns the names that regressed"""
+    before = {result['name']: result for result in baseline['results']}
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp', '?')}):")
+    print(f"{'benchmark':<46}{'before':>12}{'after':>12}{'change':>10}")
+    for result in current['results']:
+        old = before.get(result['name'])
+        if not old:
+            print(f"{result['name']:<46}{'-':>12}{format_ns(result['medianNs']):>12}{'new':>10}")
+            continue
+        # Compare the fastest repeats: least affected by scheduler noise
+        change = result['minNs'] / max(old['minNs'], 1e-9) - 1
+        marker = ''
+        if change > threshold:
+            regressions.append(result['name'])
+            marker = '  REGRESSION'
+        print(f"{result['name']:<46}{format_ns(old['minNs']):>12}{format_ns(result['minNs']):>12}"
+              f"{change * 100:>+9.1f}%{marker}")
+    return regressions
+
+def main():
+    """Main entry point"""
+    output = get_cli_option('--output', 'benchmark-results.json')
+    baseline_file = get_cli_option('--compare')
+    threshold = float(get_cli_option('--threshold', DEFAULT_THRESHOLD))
+
+    print(f"Agent {AGENT_VERSION} benchmarks on Python {platform.python_version()} ({platform.machine()})\n")
+    results = run_benchmarks(get_cli_option('--filter'))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    # Startup budgets use the fastest run: the budget is for a warm bytecode cache
+    over_budget = [result for result in results['results'] if result['minNs'] > result.get('budgetNs', float('inf'))]
+    for result in over_budget:
+        print(f"OVER BUDGET {result['name']}: {format_ns(result['minNs'])} > {format_ns(result['budgetNs'])}")
+    if over_budget:
+        sys.exit(1)
+
+    if baseline_file:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than baseline by more than {threshold * 100:.0f}%")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {threshold * 100:.0f}%")
+
+if __name__ == "__main__":
+    main()
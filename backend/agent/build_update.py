@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+IT Management Network Monitor Update Builder
+Publishes the agent files in this directory as a release for the agents' self-updater.
+
+Usage:
+    python build_update.py keygen [--key ~/.itmonitor-update-signing.key]
+    python build_update.py [--rollout 10] [--downloads ../downloads] [--key ~/.itmonitor-update-signing.key]
+                           [--files network_monitor_agent.py service_wrapper.py agent_harness.py requirements.txt]
+
+keygen creates the release signing key (keep it off the server and out of the
+repository) and writes its public half to update_public_key.txt, which the
+installer ships next to the agent; agents reject manifests that are not signed
+with it. Run it once and commit update_public_key.txt.
+
+The release version is AGENT_VERSION of network_monitor_agent.py, so bump it
+first. The files are copied to downloads/releases/<version>/, a delta from every
+earlier release under downloads/releases is written to downloads/updates/ (when
+it is smaller than the file itself), and downloads/agent-manifest.json is
+rewritten; the backend serves it to agents at GET /update/manifest. Widen the
+rollout later with PATCH /update/rollout or by re-running with a larger
+--rollout. Re-running for the same version rebuilds the same files.
+"""
+
+import os
+import sys
+import json
+import shutil
+import itertools
+import hashlib
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from network_monitor_agent import (
+    AGENT_VERSION, UPDATE_PUBLIC_KEY_FILE, make_delta, parse_version, get_cli_option, manifest_signing_payload
+)
+
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FILES = ['network_monitor_agent.py', 'service_wrapper.py', 'agent_harness.py', 'requirements.txt']
+DEFAULT_KEY_FILE = os.path.join(os.path.expanduser("~"), ".itmonitor-update-signing.key")
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def ed25519_public_key(secret):
+    """32-byte public key of a 32-byte Ed25519 secret"""
+    return Ed25519PrivateKey.from_private_bytes(secret).public_key().public_bytes_raw()
+
+def ed25519_sign(secret, message):
+    return Ed25519PrivateKey.from_private_bytes(secret).sign(message)
+
+def generate_key(key_file):
+    """Create the signing key and write its public half to update_public_key.txt"""
+    if os.path.exists(key_file):
+        print(f"{key_file} already exists; delete it first to replace the signing key")
+        return False
+    secret = os.urandom(32)
+    descriptor = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, 'w') as f:
+        f.write(secret.hex() + '\n')
+    with open(os.path.join(AGENT_DIR, UPDATE_PUBLIC_KEY_FILE), 'w') as f:
+        f.write(ed25519_public_key(secret).hex() + '\n')
+    print(f"Signing key written to {key_file}; public key to {UPDATE_PUBLIC_KEY_FILE}")
+    return True
+
+def load_key(key_file):
+    """The signing key, checked against the public key agents are shipped with"""
+    with open(key_file) as f:
+        secret = bytes.fromhex(f.read().strip())
+    with open(os.path.join(AGENT_DIR, UPDATE_PUBLIC_KEY_FILE)) as f:
+        public = bytes.fromhex(f.read().strip())
+    if ed25519_public_key(secret) != public:
+        raise ValueError(f"{key_file} does not match {UPDATE_PUBLIC_KEY_FILE}")
+    return secret
+
+def build_release(downloads, names, rollout, secret):
+    """Copy the files, write the deltas and the manifest; returns the manifest"""
+    releases = os.path.join(downloads, 'releases')
+    release_dir = os.path.join(releases, AGENT_VERSION)
+    updates_dir = os.path.join(downloads, 'updates')
+    os.makedirs(release_dir, exist_ok=True)
+    os.makedirs(updates_dir, exist_ok=True)
+    earlier = sorted((version for version in os.listdir(releases)
+                      if version != AGENT_VERSION and os.path.isdir(os.path.join(releases, version))),
+                     key=parse_version)
+
+    files = {}
+    for name in names:
+        with open(os.path.join(AGENT_DIR, name), 'rb') as f:
+            data = f.read()
+        shutil.copyfile(os.path.join(AGENT_DIR, name), os.path.join(release_dir, name))
+        digest = sha256(data)
+        entry = files[name] = {
+            'sha256': digest,
+            'size': len(data),
+            'url': f"downloads/releases/{AGENT_VERSION}/{name}",
+            'deltas': {}
+        }
+        for version in earlier:
+            try:
+                with open(os.path.join(releases, version, name), 'rb') as f:
+                    old = f.read()
+            except FileNotFoundError:
+                continue
+            old_digest = sha256(old)
+            if old_digest == digest or old_digest in entry['deltas']:
+                continue
+            delta = make_delta(old, data)
+            if len(delta) >= len(data):
+                continue
+            delta_name = f"{name}-{old_digest[:12]}-{digest[:12]}.delta"
+            with open(os.path.join(updates_dir, delta_name), 'wb') as f:
+                f.write(delta)
+            entry['deltas'][old_digest] = {'from': version, 'url': f"downloads/updates/{delta_name}",
+                                           'size': len(delta)}
+
+    manifest = {'version': AGENT_VERSION, 'rolloutPercent': rollout, 'files': files}
+    manifest['signature'] = ed25519_sign(secret, manifest_signing_payload(manifest)).hex()
+    path = os.path.join(downloads, 'agent-manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+    os.replace(path + '.tmp', path)
+    return manifest
+
+def main():
+    """Main entry point"""
+    key_file = get_cli_option('--key', DEFAULT_KEY_FILE)
+    if len(sys.argv) > 1 and sys.argv[1] == 'keygen':
+        sys.exit(0 if generate_key(key_file) else 1)
+    try:
+        secret = load_key(key_file)
+    except (OSError, ValueError) as e:
+        print(f"Cannot sign the release: {e} (run 'python build_update.py keygen' once)")
+        sys.exit(1)
+    downloads = get_cli_option('--downloads', os.path.join(AGENT_DIR, '..', 'downloads'))
+    rollout = float(get_cli_option('--rollout', 10))
+    names = DEFAULT_FILES
+    if '--files' in sys.argv:
+        names = list(itertools.takewhile(lambda arg: not arg.startswith('--'),
+                                         sys.argv[sys.argv.index('--files') + 1:]))
+    if not 0 <= rollout <= 100:
+        print("--rollout must be between 0 and 100")
+        sys.exit(1)
+
+    manifest = build_release(downloads, names, rollout, secret)
+    print(f"Published agent v{manifest['version']} to {rollout:g}% of the fleet")
+    for name, entry in manifest['files'].items():
+        deltas = ', '.join(f"from v{delta['from']} {delta['size']} bytes" for delta in entry['deltas'].values())
+        print(f"  {name}: {entry['size']} bytes{'; deltas ' + deltas if deltas else ''}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+IT Management Network Monitor Fleet Simulator
+Runs N NetworkMonitorAgent instances as asyncio coroutines in one process against a
+backend URL, to see how the ingest path behaves at fleet scale before a rollout.
+
+Usage:
+    python fleet_simulator.py --agents 5000 [--url http://127.0.0.1:5001/api | --local]
+                              [--minutes 10] [--token TOKEN | --tokens-file tokens.txt]
+                              [--min-tick 5] [--insecure] [--output fleet-results.json]
+
+Each virtual agent has its own SyntheticCollector (light/office/heavy traffic mix),
+runs the real monitor_network_traffic and build_payload and uploads every
+UPDATE_INTERVAL over its own keep-alive connection, exactly like the agent's
+requests session. Liveness follows the agent's command worker: a second connection
+holds a GET /commands long-poll open, re-polling as soon as it is answered and
+backing off like command_loop when it fails. The backend counts an open poll as
+liveness, so heartbeats go out every HEARTBEAT_INTERVAL only while no poll is open. A 'flush' command triggers an
+upload; other commands are only counted. --local starts the ingest_server.py
+stand-in in the same process. There is no fallback to the backup URL.
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import random
+import asyncio
+import logging
+import platform
+import atexit
+import shutil
+import tempfile
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+
+# Virtual agents get a scratch config, log and rules cache instead of ~/.it_monitor
+if not os.environ.get('ITMONITOR_HOME'):
+    os.environ['ITMONITOR_HOME'] = tempfile.mkdtemp(prefix='itmonitor-fleet-')
+    atexit.register(shutil.rmtree, os.environ['ITMONITOR_HOME'], ignore_errors=True)
+
+from network_monitor_agent import (
+    AGENT_VERSION, UPDATE_INTERVAL, HEARTBEAT_INTERVAL, MAX_SAMPLE_INTERVAL, COMMAND_POLL_SECONDS,
+    COMMAND_BACKOFF_MIN, COMMAND_BACKOFF_MAX, NetworkMonitorAgent, get_cli_option
+)
+from agent_harness import SyntheticCollector
+
+REQUEST_TIMEOUT = 10  # seconds, same as the agent's upload timeout
+HEARTBEAT_TIMEOUT = 5
+COMMAND_POLL_GRACE = 30  # seconds a long-poll may run past its wait, as in poll_commands
+DEFAULT_MIN_TICK = 5  # seconds; floor on the adaptive cadence so thousands of agents fit in one core
+LAG_WARNING = 1.0  # seconds of scheduling lag (p99) at which results are flagged unreliable
+# Traffic mix: (profile, share of the fleet, peak connections, distinct remote hosts)
+FLEET_PROFILES = [('light', 0.5, 20, 100), ('office', 0.35, 80, 300), ('heavy', 0.15, 300, 800)]
+
+class AsyncHttpConnection:
+    """One keep-alive HTTP/1.1 connection per virtual agent (like a requests.Session)"""
+
+    def __init__(self, base_url, ssl_context=None):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.path = parsed.path.rstrip('/')
+        self.ssl = ssl_context if parsed.scheme == 'https' else None
+        self.reader = None
+        self.writer = None
+
+    async def post(self, endpoint, body, token, timeout):
+        """POST to /network-monitoring/<endpoint>; returns (status, request bytes)"""
+        status, size, _ = await self.request('POST', endpoint, body, token, timeout)
+        return status, size
+
+    async def request(self, method, endpoint, body, token, timeout):
+        """One request; returns (status, request bytes, response body)"""
+        return await asyncio.wait_for(self._request(method, endpoint, body, token), timeout)
+
+    async def _request(self, method, endpoint, body, token):
+        if self.writer is None or self.writer.is_closing():
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl, server_hostname=self.host if self.ssl else None)
+        content = (f"Content-Type: application/json\r\n"
+                   f"Content-Length: {len(body)}\r\n") if method == 'POST' else ""
+        head = (f"{method} {self.path}/network-monitoring/{endpoint} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                f"Authorization: Bearer {token}\r\n"
+                f"{content}"
+                f"Connection: keep-alive\r\n\r\n").encode('latin-1')
+        try:
+            self.writer.write(head + body)
+            await self.writer.drain()
+            status_line = await self.reader.readuntil(b"\r\n")
+            status = int(status_line.split()[1])
+            headers = {}
+            for line in (await self.reader.readuntil(b"\r\n\r\n")).decode('latin-1').split("\r\n"):
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            response = await self.reader.readexactly(int(headers.get('content-length', 0) or 0))
+            if headers.get('connection', '').lower() == 'close':
+                self.close()
+        except BaseException:
+            self.close()
+            raise
+        return status, len(head) + len(body), response
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class FleetStats:
+    """Per-endpoint outcomes and latencies across the whole fleet"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.statuses = defaultdict(Counter)  # endpoint -> status code or error name -> count
+        self.latencies = defaultdict(list)  # endpoint -> seconds, successful and failed requests (not long-polls)
+        self.commands = Counter()  # command type -> deliveries
+        self.open_polls = 0
+        self.peak_open_polls = 0
+        self.connected = 0  # agents with a command long-poll open
+        self.bytes_sent = 0
+        self.lag = []  # seconds each scheduled wakeup fired late
+        self.interval_start = time.monotonic()
+        self.interval_requests = 0
+
+    def record(self, endpoint, outcome, latency=None, size=0):
+        self.statuses[endpoint][outcome] += 1
+        if latency is not None:
+            self.latencies[endpoint].append(latency)
+        self.bytes_sent += size
+        self.interval_requests += 1
+
+    def progress(self, agents):
+        """One line for the periodic console report; resets the interval counters"""
+        now = time.monotonic()
+        rate = self.interval_requests / max(now - self.interval_start, 1e-3)
+        self.interval_start, self.interval_requests = now, 0
+        uploads = self.statuses['logs']
+        return (f"{rate:8.1f} req/s  uploads {sum(uploads.values()):7d} "
+                f"({uploads.get(201, 0)} ok)  polls open {self.open_polls:6d}  "
+                f"heartbeats {sum(self.statuses['heartbeat'].values()):7d}  "
+                f"upload p99 {percentile(self.latencies['logs'], 99) * 1000:7.1f} ms  "
+                f"lag p99 {percentile(self.lag[-agents:], 99):5.2f} s")
+
+    def summary(self, agents):
+        elapsed = time.monotonic() - self.started
+        endpoints = {}
+        # Heartbeats are only expected from agents whose command channel is down
+        for endpoint, expected in (('logs', agents / UPDATE_INTERVAL),
+                                   ('commands', agents / COMMAND_POLL_SECONDS),
+                                   ('heartbeat', (agents - self.connected) / HEARTBEAT_INTERVAL)):
+            latencies = sorted(self.latencies[endpoint])
+            statuses = self.statuses[endpoint]
+            endpoints[endpoint] = {
+                'requests': sum(statuses.values()),
+                'outcomes': {str(key): value for key, value in statuses.items()},
+                'achievedPerSec': round(sum(statuses.values()) / elapsed, 2),
+                'expectedPerSec': round(expected, 2),
+                'latencyMs': {f"p{q}": round(percentile(latencies, q, presorted=True) * 1000, 1)
+                              for q in (50, 90, 95, 99)},
+                'maxLatencyMs': round(latencies[-1] * 1000, 1) if latencies else 0.0
+            }
+        return {
+            'agents': agents,
+            'elapsedSeconds': round(elapsed, 1),
+            'bytesSent': self.bytes_sent,
+            'bytesPerSec': round(self.bytes_sent / elapsed, 1),
+            'schedulingLagP99Sec': round(percentile(self.lag, 99), 3),
+            'peakOpenPolls': self.peak_open_polls,
+            'agentsWithoutCommandChannel': agents - self.connected,
+            'commands': dict(self.commands),
+            'endpoints': endpoints
+        }
+
+def percentile(values, q, presorted=False):
+    """q-th percentile (nearest rank) of a list of numbers, 0.0 when empty"""
+    if not values:
+        return 0.0
+    ordered = values if presorted else sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+def create_fleet(count, tokens, seed=1):
+    """Build count agents with synthetic collectors and per-agent identities"""
+    rng = random.Random(seed)
+    profiles = [profile for profile in FLEET_PROFILES for _ in range(int(profile[1] * 100))]
+    fleet = []
+    # Construction logs "Configuration loaded" once per agent; keep that out of agent.log
+    logging.disable(logging.INFO)
+    try:
+        for index in range(count):
+            name, _, peak_connections, hosts = rng.choice(profiles)
+            agent = NetworkMonitorAgent()
+            agent.log = lambda message, level=logging.INFO: None
+            agent.system_id = f"sys-fleet{index:07d}"
+            agent.system_name = f"FLEET-{name.upper()}-{index:05d}"
+            agent.agent_token = tokens[index % len(tokens)]
+            agent.collector = SyntheticCollector(time, seed=seed * 100003 + index, hosts=hosts,
+                                                 peak_connections=peak_connections)
+            system_info = {'os': 'Windows', 'osVersion': '10.0.19045', 'cpu': 'Intel64 Family 6', 'ram': '16.0 GB',
+                           'ipAddress': f"10.{index >> 16 & 0xff}.{index >> 8 & 0xff}.{index & 0xff}",
+                           'macAddress': ':'.join(f"{rng.randrange(256):02x}" for _ in range(6))}
+            agent.get_system_info = lambda info=system_info: info
+            fleet.append(agent)
+    finally:
+        logging.disable(logging.NOTSET)
+    return fleet
+
+async def run_agent(agent, connection, poll_connection, stats, deadline, min_tick):
+    """One virtual agent: the sampler, uploader, heartbeat and command workers' schedule on asyncio"""
+    loop = asyncio.get_running_loop()
+    # Real agents start at arbitrary times; spread the fleet over one upload interval
+    start = loop.time() + random.uniform(0, UPDATE_INTERVAL)
+    next_tick = start
+    next_upload = start + UPDATE_INTERVAL
+    next_heartbeat = start
+    await asyncio.sleep(max(0.0, start - loop.time()))
+    channel = asyncio.ensure_future(command_channel(agent, poll_connection, stats, deadline))
+    await asyncio.sleep(0)  # let the first poll open before the first heartbeat is due
+
+    try:
+        while True:
+            wakeup = min(next_tick, next_upload, next_heartbeat)
+            if wakeup >= deadline:
+                break
+            await asyncio.sleep(max(0.0, wakeup - loop.time()))
+            now = loop.time()
+            stats.lag.append(now - wakeup)
+
+            if now >= next_tick:
+                agent.monitor_network_traffic()
+                interval = agent.cadence.update(*agent.last_activity)
+                next_tick = now + min(max(interval, min_tick), MAX_SAMPLE_INTERVAL)
+                if agent.upload_requested.is_set():
+                    next_upload = now
+
+            if now >= next_heartbeat:
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+                if not agent.push_connected:
+                    await post(connection, stats, 'heartbeat', b'', agent.agent_token, HEARTBEAT_TIMEOUT)
+
+            if now >= next_upload:
+                agent.upload_requested.clear()
+                next_upload = now + UPDATE_INTERVAL
+                body = json.dumps(agent.build_payload()).encode()
+                agent.failed_uploads += 1
+                if await post(connection, stats, 'logs', body, agent.agent_token, REQUEST_TIMEOUT) == 201:
+                    # Same bookkeeping as send_data_to_backend
+                    agent.network_stats.clear()
+                    agent.failed_uploads = 0
+    finally:
+        channel.cancel()
+        await asyncio.gather(channel, return_exceptions=True)
+        poll_connection.close()
+
+async def command_channel(agent, connection, stats, deadline):
+    """The agent's command worker: back-to-back long-polls, backing off like command_loop"""
+    loop = asyncio.get_running_loop()
+    wait = int(agent.command_poll_seconds)
+    backoff = COMMAND_BACKOFF_MIN
+    while loop.time() < deadline:
+        set_connected(agent, stats, True)
+        stats.open_polls += 1
+        stats.peak_open_polls = max(stats.peak_open_polls, stats.open_polls)
+        started = time.monotonic()
+        size = 0
+        try:
+            status, size, body = await connection.request('GET', f'commands?wait={wait}', b'',
+                                                          agent.agent_token, wait + COMMAND_POLL_GRACE)
+        except asyncio.TimeoutError:
+            status, outcome = None, 'timeout'
+        except Exception as e:
+            status, outcome = None, type(e).__name__
+        else:
+            outcome = status
+        finally:
+            stats.open_polls -= 1
+        # How long a poll was held says nothing about the server; only failures are timed
+        stats.record('commands', outcome, None if status in (200, 204) else time.monotonic() - started,
+                     size)
+
+        if status in (200, 204):
+            backoff = COMMAND_BACKOFF_MIN
+            if status == 200:
+                for command in json.loads(body or b'{}').get('commands', []):
+                    stats.commands[command.get('type')] += 1
+                    if command.get('type') == 'flush':
+                        agent.upload_requested.set()
+            continue
+        set_connected(agent, stats, False)
+        await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+        backoff = min(backoff * 2, COMMAND_BACKOFF_MAX)
+
+def set_connected(agent, stats, connected):
+    """Track whether the agent's command channel is up (push_connected) fleet-wide"""
+    if connected != agent.push_connected:
+        stats.connected += 1 if connected else -1
+        agent.push_connected = connected
+
+async def post(connection, stats, endpoint, body, token, timeout):
+    """POST and record the outcome; returns the status code or None on error"""
+    started = time.monotonic()
+    try:
+        status, size = await connection.post(endpoint, body, token, timeout)
+    except asyncio.TimeoutError:
+        stats.record(endpoint, 'timeout', time.monotonic() - started)
+        return None
+    except Exception as e:
+        stats.record(endpoint, type(e).__name__, time.monotonic() - started)
+        return None
+    stats.record(endpoint, status, time.monotonic() - started, size)
+    return status
+
+def raise_file_limit(wanted):
+    """Raise the open-file soft limit towards wanted (one socket per agent); POSIX only"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        if soft != resource.RLIM_INFINITY and soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+async def simulate_fleet(url, agents, seconds, tokens, min_tick=DEFAULT_MIN_TICK, verify=True,
+                         report_seconds=10, seed=1):
+    """Run the fleet for seconds against url; returns the summary dict"""
+    raise_file_limit(agents * 4 + 256)
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    print(f"Creating {agents} agents...")
+    fleet = create_fleet(agents, tokens, seed)
+    connections = [AsyncHttpConnection(url, context) for _ in fleet]
+    poll_connections = [AsyncHttpConnection(url, context) for _ in fleet]
+    stats = FleetStats()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds
+    print(f"Running {agents} agents against {url} for {seconds:g} s "
+          f"(expecting {agents / UPDATE_INTERVAL:.1f} uploads/s and {agents} open command long-polls)")
+
+    tasks = [asyncio.ensure_future(run_agent(agent, connection, poll_connection, stats, deadline, min_tick))
+             for agent, connection, poll_connection in zip(fleet, connections, poll_connections)]
+    try:
+        while not all(task.done() for task in tasks):
+            await asyncio.wait(tasks, timeout=report_seconds)
+            print(f"[{time.strftime('%H:%M:%S')}] {stats.progress(agents)}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for connection in connections + poll_connections:
+            connection.close()
+
+    summary = stats.summary(agents)
+    summary.update({'url': url, 'agentVersion': AGENT_VERSION, 'python': platform.python_version()})
+    return summary
+
+def print_summary(summary):
+    print(f"\n{summary['agents']} agents, {summary['elapsedSeconds']:g} s, "
+          f"{summary['bytesPerSec'] / 1024:.1f} KB/s sent")
+    print(f"{'endpoint':<11}{'requests':>10}{'achieved/s':>12}{'expected/s':>12}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}  outcomes")
+    for endpoint, result in summary['endpoints'].items():
+        latency = result['latencyMs']
+        outcomes = ' '.join(f"{key}:{value}" for key, value in sorted(result['outcomes'].items()))
+        print(f"{endpoint:<11}{result['requests']:>10}{result['achievedPerSec']:>12.1f}{result['expectedPerSec']:>12.1f}"
+              f"{latency['p50']:>9.1f}{latency['p95']:>9.1f}{latency['p99']:>9.1f}{result['maxLatencyMs']:>9.1f}  {outcomes}")
+    print(f"Command channel: peak {summary['peakOpenPolls']} long-polls open, "
+          f"{summary['agentsWithoutCommandChannel']} agents on heartbeats at the end, "
+          f"commands delivered {summary['commands'] or 'none'}")
+    if summary['schedulingLagP99Sec'] > LAG_WARNING:
+        print(f"\nWARNING: p99 scheduling lag {summary['schedulingLagP99Sec']:.2f} s - the simulator is CPU bound, "
+              f"achieved rates understate the target; use fewer agents or a higher --min-tick")
+
+def load_tokens():
+    """Agent tokens from --tokens-file (one per line) or --token"""
+    tokens_file = get_cli_option('--tokens-file')
+    if tokens_file:
+        with open(tokens_file) as f:
+            tokens = [line.strip() for line in f if line.strip()]
+        if tokens:
+            return tokens
+    return [get_cli_option('--token', 'fleet-simulator')]
+
+async def run_local(agents, seconds, tokens, min_tick, report_seconds):
+    """Fleet against an in-process ingest_server stand-in"""
+    from ingest_server import IngestServer
+    server = await IngestServer(port=0).start()
+    try:
+        return await simulate_fleet(server.base_url, agents, seconds, tokens, min_tick,
+                                    report_seconds=report_seconds)
+    finally:
+        print(f"\nStand-in server: {json.dumps(server.stats.snapshot())}")
+        await server.stop()
+
+def main():
+    """Main entry point"""
+    agents = int(get_cli_option('--agents', 100))
+    seconds = float(get_cli_option('--minutes', 5)) * 60
+    min_tick = float(get_cli_option('--min-tick', DEFAULT_MIN_TICK))
+    report_seconds = float(get_cli_option('--report-seconds', 10))
+    tokens = load_tokens()
+
+    if '--local' in sys.argv:
+        summary = asyncio.run(run_local(agents, seconds, tokens, min_tick, report_seconds))
+    else:
+        url = get_cli_option('--url', 'http://127.0.0.1:5001/api')
+        summary = asyncio.run(simulate_fleet(url, agents, seconds, tokens, min_tick,
+                                             verify='--insecure' not in sys.argv, report_seconds=report_seconds))
+    print_summary(summary)
+
+    output = get_cli_option('--output')
+    if output:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
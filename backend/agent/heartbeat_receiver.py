@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+IT Management Network Monitor Heartbeat Receiver
+Reference collector for the agent's signed UDP heartbeats (config: udp_heartbeat).
+
+Usage:
+    python heartbeat_receiver.py --keys agents.json [--host 0.0.0.0] [--port 5140]
+                                 [--state liveness.json] [--report-seconds 10]
+
+agents.json maps each system id to its agent token, the same token the backend
+issued at registration; the file is re-read when it changes. Every authentic
+heartbeat is answered with a signed acknowledgement, so the agent does not fall
+back to HTTPS. --state writes the last-seen table as JSON after each report.
+
+From Python:
+
+    with HeartbeatReceiver(keys={system_id: token}, port=0).serve_in_thread() as receiver:
+        agent.udp_heartbeat = f"127.0.0.1:{receiver.port}"
+        ...
+        receiver.last_seen  # system id -> (received at, sequence, pending bytes, address)
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from network_monitor_agent import (
+    UDP_HEARTBEAT_MAX_SKEW, heartbeat_key, unpack_heartbeat, pack_heartbeat_ack, get_cli_option
+)
+
+DEFAULT_PORT = 5140
+
+class HeartbeatReceiver(asyncio.DatagramProtocol):
+    """Verifies, deduplicates and acknowledges heartbeat datagrams
+
+    A heartbeat is accepted when its HMAC matches the sender's token, its
+    timestamp is within UDP_HEARTBEAT_MAX_SKEW of the local clock, and it is
+    newer than the last one accepted from that system. A retransmission of the
+    last accepted heartbeat (its acknowledgement was lost) is acknowledged again
+    without being counted; anything else is dropped silently.
+    """
+
+    def __init__(self, keys=None, keys_file=None, host="0.0.0.0", port=DEFAULT_PORT, state_file=None):
+        self.host = host
+        self.port = port
+        self.keys_file = keys_file
+        self.keys_mtime = None
+        self.keys = {}
+        self.set_tokens(keys or {})
+        self.state_file = state_file
+        self.last_seen = {}  # system id -> (received at, sequence, pending bytes, address)
+        self.latest = {}  # system id -> (timestamp, sequence) of the last accepted heartbeat
+        self.counts = Counter()
+        self.transport = None
+        self.loop = None
+
+    def set_tokens(self, tokens):
+        """Replace the system id -> agent token table"""
+        self.keys = {system_id: heartbeat_key(token) for system_id, token in tokens.items()}
+
+    def reload_keys(self):
+        """Re-read the keys file if it changed"""
+        if not self.keys_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.keys_file)
+            if mtime != self.keys_mtime:
+                with open(self.keys_file) as f:
+                    self.set_tokens(json.load(f))
+                self.keys_mtime = mtime
+        except (OSError, ValueError) as e:
+            print(f"Could not load keys from {self.keys_file}: {e}")
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        heartbeat = unpack_heartbeat(data, self.keys.get)
+        if heartbeat is None:
+            self.counts['rejected'] += 1
+            return
+        system_id, sequence, timestamp, pending_bytes, key = heartbeat
+        now = time.time()
+        if abs(now - timestamp) > UDP_HEARTBEAT_MAX_SKEW:
+            self.counts['stale'] += 1
+            return
+
+        latest = self.latest.get(system_id)
+        if latest == (timestamp, sequence):
+            self.counts['duplicate'] += 1
+        elif latest and (timestamp, sequence) < latest:
+            self.counts['replayed'] += 1
+            return
+        else:
+            self.latest[system_id] = (timestamp, sequence)
+            self.last_seen[system_id] = (now, sequence, pending_bytes, addr[0])
+            self.counts['accepted'] += 1
+        self.transport.sendto(pack_heartbeat_ack(key, sequence), addr)
+
+    async def start(self):
+        """Start listening; with port=0 the chosen port is stored in self.port"""
+        self.reload_keys()
+        self.loop = asyncio.get_running_loop()
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.port = transport.get_extra_info('sockname')[1]
+        return self
+
+    def stop(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    def snapshot(self):
+        """Counters plus the last-seen table, as written to --state"""
+        return {
+            'counts': dict(self.counts),
+            'agents': {system_id: {'lastSeen': seen, 'sequence': sequence, 'pendingBytes': pending,
+                                   'address': address}
+                       for system_id, (seen, sequence, pending, address) in self.last_seen.items()}
+        }
+
+    def report(self, window):
+        """One-line summary of the agents heard from within window seconds"""
+        live = sum(1 for seen, _, _, _ in self.last_seen.values() if time.time() - seen <= window)
+        counts = ', '.join(f"{name} {count}" for name, count in sorted(self.counts.items()))
+        return f"{live} agents live in the last {window:g}s; {counts or 'no datagrams'}"
+
+    async def serve_forever(self, report_seconds=10):
+        """Run until cancelled, reporting (and reloading keys) every report_seconds"""
+        await self.start()
+        print(f"Heartbeat receiver listening on udp://{self.host}:{self.port} ({len(self.keys)} agents known)")
+        try:
+            while True:
+                await asyncio.sleep(report_seconds)
+                self.reload_keys()
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {self.report(report_seconds * 6)}")
+                if self.state_file:
+                    with open(self.state_file, 'w') as f:
+                        json.dump(self.snapshot(), f, indent=2)
+        finally:
+            self.stop()
+
+    @contextmanager
+    def serve_in_thread(self):
+        """Run the receiver on a background event loop for the duration of a with block"""
+        ready = threading.Event()
+        holder = {}
+
+        def run():
+            loop = asyncio.new_event_loop()
+            holder['loop'] = loop
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as e:
+                holder['error'] = e
+                ready.set()
+                return
+            ready.set()
+            loop.run_forever()
+            self.stop()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+        thread = threading.Thread(target=run, name="heartbeat-receiver", daemon=True)
+        thread.start()
+        ready.wait()
+        if 'error' in holder:
+            raise holder['error']
+        try:
+            yield self
+        finally:
+            holder['loop'].call_soon_threadsafe(holder['loop'].stop)
+            thread.join()
+
+def main():
+    """Main entry point"""
+    keys_file = get_cli_option('--keys')
+    if not keys_file:
+        print("Usage: python heartbeat_receiver.py --keys agents.json [--port 5140] [--state liveness.json]")
+        sys.exit(1)
+    receiver = HeartbeatReceiver(
+        keys_file=keys_file,
+        host=get_cli_option('--host', '0.0.0.0'),
+        port=int(get_cli_option('--port', DEFAULT_PORT)),
+        state_file=get_cli_option('--state')
+    )
+    try:
+        asyncio.run(receiver.serve_forever(float(get_cli_option('--report-seconds', 10))))
+    except KeyboardInterrupt:
+        print(f"\nStopped. {json.dumps(dict(receiver.counts))}")
+
+if __name__ == "__main__":
+    main()
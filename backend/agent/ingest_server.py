@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+IT Management Network Monitor Ingestion Stand-in
+Small asyncio HTTP server implementing the agent-facing network-monitoring endpoints,
+for load and contract testing without the Node backend and MongoDB.
+
+Usage:
+    python ingest_server.py [--host 127.0.0.1] [--port 5001] [--latency-ms 0] [--jitter-ms 0]
+                            [--error-rate 0] [--throttle-rate 0] [--retry-after 5]
+                            [--certfile cert.pem --keyfile key.pem] [--record payloads.jsonl]
+                            [--downloads ../downloads] [--report-seconds 10] [--verbose]
+
+Point an agent at it with backend_url = http://127.0.0.1:5001/api. A request the server
+fails on is answered 500 and logged with its traceback; --verbose also logs dropped
+connections and malformed requests. From Python:
+
+    with IngestServer(port=0).serve_in_thread() as server:
+        agent.backend_url = server.base_url
+        ...
+        server.payloads  # received /logs bodies
+"""
+
+import os
+import sys
+import ssl
+import gzip
+import json
+import time
+import random
+import hashlib
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+API_PREFIX = "/api/network-monitoring/"
+MAX_BODY_BYTES = 16 * 1024 * 1024  # larger requests are answered with 413
+MAX_RECORDED_PAYLOADS = 10000  # payloads kept in memory (all of them go to --record)
+RATE_WINDOW = 10  # seconds of traffic the reported request and byte rates cover
+KEEPALIVE_TIMEOUT = 75  # seconds an idle client connection is kept open
+MAX_COMMAND_WAIT = 300  # seconds a /commands long-poll is held, like the backend
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classification_rules.json")
+
+log = logging.getLogger('ingest_server')
+
+STATUS_TEXT = {200: 'OK', 201: 'Created', 202: 'Accepted', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+               405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+               429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+class IngestStats:
+    """Request counters plus a sliding window for request and byte rates"""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.started = time.monotonic()
+        self.requests = Counter()  # (endpoint, status) -> count
+        self.bytes_received = 0
+        self.connections = 0
+        self.recent = deque()  # (monotonic time, request bytes)
+
+    def record(self, endpoint, status, size):
+        now = time.monotonic()
+        self.requests[(endpoint, status)] += 1
+        self.bytes_received += size
+        self.recent.append((now, size))
+        self._trim(now)
+
+    def _trim(self, now):
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+
+    def rates(self):
+        """(requests/sec, bytes/sec) over the last window"""
+        now = time.monotonic()
+        self._trim(now)
+        span = min(self.window, max(now - self.started, 1e-3))
+        return len(self.recent) / span, sum(size for _, size in self.recent) / span
+
+    def snapshot(self):
+        requests_per_sec, bytes_per_sec = self.rates()
+        return {
+            'uptimeSeconds': round(time.monotonic() - self.started, 1),
+            'requests': {f"{endpoint} {status}": count for (endpoint, status), count in sorted(self.requests.items())},
+            'totalRequests': sum(self.requests.values()),
+            'bytesReceived': self.bytes_received,
+            'openConnections': self.connections,
+            'requestsPerSec': round(requests_per_sec, 2),
+            'bytesPerSec': round(bytes_per_sec, 1)
+        }
+
+    def report(self):
+        """One-line summary for the periodic console report"""
+        requests_per_sec, bytes_per_sec = self.rates()
+        statuses = Counter()
+        for (_, status), count in self.requests.items():
+            statuses[status] += count
+        breakdown = ' '.join(f"{status}:{count}" for status, count in sorted(statuses.items()))
+        return (f"{requests_per_sec:8.1f} req/s {bytes_per_sec / 1024:10.1f} KB/s  "
+                f"conns {self.connections:5d}  total {sum(statuses.values())} [{breakdown}]")
+
+class IngestServer:
+    """Stand-in for the backend's /logs and /heartbeat agent endpoints
+
+    Responds 201 to /logs and 200 to /heartbeat like routes/networkMonitoring.js,
+    401 without a bearer token and 400 when the upload totals are missing. GET
+    /rules serves the classification rules bundle with an ETag and answers 304
+    to a matching If-None-Match. GET /commands is the long-poll push channel:
+    commands given to queue_command() are delivered at once, otherwise the poll
+    is answered 204 when its wait runs out.
+    Latency, 500 error rate and 429 throttle rate are injected per request.
+    """
+
+    def __init__(self, host="127.0.0.1", port=5001, latency_ms=0, jitter_ms=0, error_rate=0.0,
+                 throttle_rate=0.0, retry_after=5, certfile=None, keyfile=None, record_file=None, seed=None,
+                 rules_file=RULES_FILE, downloads_dir=None):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.record_file = record_file
+        self.random = random.Random(seed)
+        self.stats = IngestStats()
+        self.payloads = deque(maxlen=MAX_RECORDED_PAYLOADS)
+        self.heartbeats = Counter()  # bearer token -> heartbeats received
+        self.revoked = set()  # tokens relay/verify and logs/bulk reject
+        self.relays = None  # tokens of agents marked isRelay; None lets any agent use the relay endpoints
+        self.bulk_requests = 0  # logs/bulk requests received from relays
+        self.server = None
+        self.loop = None
+        self.tasks = set()  # open connection handlers, cancelled on stop()
+        self._record = None
+        self.commands = {}  # bearer token -> queued commands
+        self.command_waiters = {}  # bearer token -> asyncio.Event of the held poll
+        self.rules = None
+        self.rules_etag = None
+        self.downloads_dir = downloads_dir  # serves /downloads/ and its agent-manifest.json, like the backend
+        if rules_file and os.path.exists(rules_file):
+            with open(rules_file, 'rb') as f:
+                data = f.read()
+            self.rules = json.loads(data)
+            self.rules_etag = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+    @property
+    def scheme(self):
+        return 'https' if self.certfile else 'http'
+
+    @property
+    def base_url(self):
+        """Value for the agent's backend_url"""
+        return f"{self.scheme}://{self.host}:{self.port}/api"
+
+    async def start(self):
+        """Start listening; with port=0 the chosen port is stored in self.port"""
+        context = None
+        if self.certfile:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.certfile, self.keyfile)
+        if self.record_file:
+            self._record = open(self.record_file, 'a')
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                 ssl=context, backlog=4096, limit=64 * 1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+        if self._record:
+            self._record.close()
+            self._record = None
+
+    def queue_command(self, command, token=None):
+        """Queue a command for one agent token, or for every polling agent; thread-safe"""
+        def queue():
+            for target in ([token] if token else list(self.command_waiters)):
+                self.commands.setdefault(target, []).append(command)
+                if target in self.command_waiters:
+                    self.command_waiters[target].set()
+        self.loop.call_soon_threadsafe(queue)
+
+    async def serve_forever(self, report_seconds=10):
+        """Run until cancelled, printing a rate report every report_seconds"""
+        await self.start()
+        print(f"Ingestion stand-in listening on {self.base_url}")
+        try:
+            while True:
+                await asyncio.sleep(report_seconds)
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {self.stats.report()}")
+        finally:
+            await self.stop()
+
+    @contextmanager
+    def serve_in_thread(self):
+        """Run the server on a background event loop for the duration of a with block"""
+        ready = threading.Event()
+        holder = {}
+
+        def run():
+            loop = asyncio.new_event_loop()
+            holder['loop'] = loop
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as e:
+                holder['error'] = e
+                ready.set()
+                return
+            ready.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        thread = threading.Thread(target=run, name="ingest-server", daemon=True)
+        thread.start()
+        ready.wait()
+        if 'error' in holder:
+            raise holder['error']
+        try:
+            yield self
+        finally:
+            holder['loop'].call_soon_threadsafe(holder['loop'].stop)
+            thread.join(timeout=5)
+
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until it closes"""
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        self.stats.connections += 1
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # Unparseable head (bad Content-Length, oversized headers): answer and hang up
+                    log.debug("Malformed request: %r", e)
+                    self.stats.record('malformed', 400, 0)
+                    writer.write(self.format_response(400, {'msg': 'Malformed request'}, {}, False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body, size = request
+                try:
+                    status, response, extra = await self.dispatch(method, path, headers, body)
+                except Exception:
+                    log.exception("Error handling %s %s", method, path)
+                    status, response, extra = 500, {'msg': 'Server error'}, {}
+                endpoint = path.split('?', 1)[0]
+                if endpoint.startswith(API_PREFIX):
+                    endpoint = endpoint[len(API_PREFIX):]
+                self.stats.record(endpoint, status, size)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(self.format_response(status, response, extra, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except asyncio.CancelledError:
+            # Cancelled by stop(): finish normally so the stream callback stays quiet
+            pass
+        except Exception as e:
+            # The client went away mid-response or similar; the connection is closed below
+            log.debug("Connection error: %r", e, exc_info=True)
+        finally:
+            self.tasks.discard(task)
+            self.stats.connections -= 1
+            writer.close()
+
+    async def read_request(self, reader):
+        """Parse one request: (method, path, headers, body, bytes read), None on EOF"""
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, path, _ = lines[0].split(' ', 2)
+        except ValueError:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0) or 0)
+        if length > MAX_BODY_BYTES:
+            return method, path, dict(headers, **{'x-rejected': '413'}), b'', len(head)
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            return method, path, dict(headers, **{'x-rejected': '411', 'connection': 'close'}), b'', len(head)
+        body = await reader.readexactly(length) if length else b''
+        return method, path, headers, body, len(head) + length
+
+    async def dispatch(self, method, path, headers, body):
+        """Route a request; returns (status, JSON body, extra headers)"""
+        if headers.get('x-rejected'):
+            return int(headers['x-rejected']), {'msg': 'Request rejected'}, {}
+
+        endpoint = path.split('?', 1)[0]
+        if endpoint == '/stats' and method == 'GET':
+            return 200, self.stats.snapshot(), {}
+        if endpoint.startswith('/downloads/') and method == 'GET' and self.downloads_dir:
+            return self.download(endpoint[len('/downloads/'):])
+        if endpoint not in (API_PREFIX + 'logs', API_PREFIX + 'heartbeat', API_PREFIX + 'rules',
+                            API_PREFIX + 'commands', API_PREFIX + 'logs/bulk', API_PREFIX + 'relay/verify',
+                            API_PREFIX + 'update/manifest'):
+            return 404, {'msg': 'Not found'}, {}
+        if method != ('GET' if endpoint.endswith(('/rules', '/commands', '/manifest')) else 'POST'):
+            return 405, {'msg': 'Method not allowed'}, {}
+
+        if self.latency_ms or self.jitter_ms:
+            await asyncio.sleep(max(0.0, self.latency_ms + self.random.uniform(-1, 1) * self.jitter_ms) / 1000)
+
+        # Same checks, in the same order, as verifyAgent and the route handlers
+        token = headers.get('authorization', '').replace('Bearer ', '', 1).strip()
+        if not token:
+            return 401, {'msg': 'No agent token provided'}, {}
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            return 429, {'msg': 'Too many requests'}, {'Retry-After': str(self.retry_after)}
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, {'msg': 'Server error'}, {}
+
+        if endpoint.endswith('/commands'):
+            query = dict(part.split('=', 1) for part in path.partition('?')[2].split('&') if '=' in part)
+            wait = min(int(query['wait']) if query.get('wait', '').isdigit() else 0, MAX_COMMAND_WAIT)
+            if not self.commands.get(token):
+                event = self.command_waiters[token] = asyncio.Event()
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    if self.command_waiters.get(token) is event:
+                        del self.command_waiters[token]
+            commands = self.commands.pop(token, None)
+            if not commands:
+                return 204, None, {}
+            return 200, {'success': True, 'commands': commands}, {}
+
+        if endpoint.endswith('/rules'):
+            if self.rules is None:
+                return 404, {'msg': 'No rules bundle'}, {}
+            extra = {'ETag': self.rules_etag, 'Cache-Control': 'no-cache'}
+            if headers.get('if-none-match') == self.rules_etag:
+                return 304, None, extra
+            return 200, self.rules, extra
+
+        if endpoint.endswith('/update/manifest'):
+            status, manifest, _ = self.download('agent-manifest.json') if self.downloads_dir else (404, None, {})
+            if status != 200:
+                return 404, {'msg': 'No agent update published'}, {}
+            extra = {'ETag': '"' + hashlib.sha256(manifest).hexdigest()[:32] + '"', 'Cache-Control': 'no-cache'}
+            if headers.get('if-none-match') == extra['ETag']:
+                return 304, None, extra
+            return 200, manifest, extra
+
+        if endpoint.endswith('/heartbeat'):
+            self.heartbeats[token] += 1
+            return 200, {'success': True, 'message': 'Heartbeat received',
+                         'timestamp': datetime.now(timezone.utc).isoformat()}, {}
+
+        try:
+            if headers.get('content-encoding', '').lower() == 'gzip':
+                body = gzip.decompress(body)
+            payload = json.loads(body or b'{}')
+        except (ValueError, OSError):
+            return 400, {'msg': 'Invalid JSON body'}, {}
+        if not isinstance(payload, dict):
+            return 400, {'msg': 'Invalid JSON body'}, {}
+
+        # Relay endpoints: every token is valid except those in self.revoked
+        if endpoint.endswith(('/relay/verify', '/logs/bulk')) and self.relays is not None and token not in self.relays:
+            return 403, {'msg': 'Agent is not a relay'}, {}
+        if endpoint.endswith('/relay/verify'):
+            return 200, {'valid': [t not in self.revoked for t in payload.get('tokens', [])]}, {}
+        if endpoint.endswith('/logs/bulk'):
+            accepted = rejected = 0
+            for batch in payload.get('batches', []):
+                if batch.get('token') in self.revoked or not self.store_payload(batch.get('token', ''), batch.get('payload')):
+                    rejected += 1
+                else:
+                    accepted += 1
+            for alive in payload.get('alive', []):
+                self.heartbeats[alive] += 1
+            self.bulk_requests += 1
+            return 200, {'success': True, 'accepted': accepted, 'rejected': rejected}, {}
+
+        if not self.store_payload(token, payload):
+            return 400, {'msg': 'Upload and download data are required'}, {}
+        return 201, {'success': True, 'message': 'Network data logged successfully'}, {}
+
+    def store_payload(self, token, payload):
+        """Keep (and record) one /logs body; False if it lacks the required totals"""
+        if not isinstance(payload, dict) or payload.get('totalUploadMB') is None \
+                or payload.get('totalDownloadMB') is None:
+            return False
+        self.payloads.append(payload)
+        if self._record:
+            self._record.write(json.dumps({'receivedAt': time.time(), 'token': token[-8:], 'payload': payload}) + "\n")
+        return True
+
+    def download(self, name):
+        """A file under downloads_dir as (status, bytes or JSON error, extra headers)"""
+        root = os.path.abspath(self.downloads_dir)
+        path = os.path.abspath(os.path.join(root, name))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            return 404, {'msg': 'Not found'}, {}
+        with open(path, 'rb') as f:
+            return 200, f.read(), {}
+
+    def format_response(self, status, response, extra, keep_alive):
+        if isinstance(response, bytes):
+            body = response
+        else:
+            body = json.dumps(response).encode() if response is not None else b''
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Unknown')}",
+                 "Content-Type: application/json; charset=utf-8",
+                 f"Content-Length: {len(body)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines.extend(f"{name}: {value}" for name, value in extra.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+def get_cli_option(name, default=None):
+    """Value following a --name option on the command line"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+def main():
+    """Main entry point"""
+    logging.basicConfig(level=logging.DEBUG if '--verbose' in sys.argv else logging.INFO,
+                        format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%H:%M:%S')
+    server = IngestServer(
+        host=get_cli_option('--host', '127.0.0.1'),
+        port=int(get_cli_option('--port', 5001)),
+        latency_ms=float(get_cli_option('--latency-ms', 0)),
+        jitter_ms=float(get_cli_option('--jitter-ms', 0)),
+        error_rate=float(get_cli_option('--error-rate', 0)),
+        throttle_rate=float(get_cli_option('--throttle-rate', 0)),
+        retry_after=int(get_cli_option('--retry-after', 5)),
+        certfile=get_cli_option('--certfile'),
+        keyfile=get_cli_option('--keyfile'),
+        record_file=get_cli_option('--record'),
+        downloads_dir=get_cli_option('--downloads')
+    )
+    try:
+        asyncio.run(server.serve_forever(float(get_cli_option('--report-seconds', 10))))
+    except KeyboardInterrupt:
+        print(f"\nStopped. {json.dumps(server.stats.snapshot())}")
+
+if __name__ == "__main__":
+    main()
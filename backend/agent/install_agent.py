@@ -11,6 +11,9 @@ import json
 import winreg
 import ctypes
 import shutil
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 AGENT_NAME = "ITNetworkMonitor"
@@ -18,6 +21,12 @@ AGENT_DISPLAY_NAME = "IT Network Monitor Agent"
 AGENT_DESCRIPTION = "Monitors network traffic for IT Management System"
 INSTALL_DIR = os.path.join(os.environ['ProgramFiles'], 'ITNetworkMonitor')
 SERVICE_SCRIPT = os.path.join(INSTALL_DIR, 'network_monitor_agent.py')
+AGENT_FILES = ['network_monitor_agent.py', 'requirements.txt', 'service_wrapper.py', 'install_agent.py',
+               'agent_harness.py', 'update_public_key.txt']  # the key agents check update manifests against
+INSTALL_MANIFEST = os.path.join(INSTALL_DIR, 'install-manifest.json')  # sha256 and size/mtime of each installed file
+WHEELHOUSE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wheelhouse')  # bundled wheels, see build_wheelhouse
+
+step_timings = []  # (step, seconds, outcome) for the report at the end of main()
 
 def is_admin():
     """Check if running with admin privileges"""
@@ -26,19 +35,83 @@ def is_admin():
     except:
         return False
 
+def file_sha256(path):
+    """Hex sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_requirements(path):
+    """(name, pinned version or None, requirement) for each line of a requirements file"""
+    requirements = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            name, _, version = line.partition('==')
+            requirements.append((name.strip(), version.strip() or None, line))
+    return requirements
+
+def missing_requirements(requirements):
+    """The requirements not already installed at the pinned version"""
+    from importlib import metadata
+    missing = []
+    for name, version, line in requirements:
+        try:
+            installed = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            missing.append(line)
+            continue
+        if version and installed != version:
+            missing.append(line)
+    return missing
+
+def has_wheelhouse():
+    return os.path.isdir(WHEELHOUSE_DIR) and any(name.endswith('.whl') for name in os.listdir(WHEELHOUSE_DIR))
+
 def install_dependencies():
-    """Install required Python packages"""
-    print("Installing dependencies...")
+    """Install the required packages that are not already satisfied
+
+    Uses the bundled wheelhouse when there is one (no network needed) and PyPI
+    for anything it lacks. Returns the requirements installed, None on failure.
+    """
+    print("Checking dependencies...")
+    try:
+        requirements = read_requirements(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'requirements.txt'))
+        missing = missing_requirements(requirements)
+        if not missing:
+            print(f"✓ Dependencies already satisfied ({len(requirements)} packages)")
+            return []
+        
+        pip = [sys.executable, '-m', 'pip', 'install', '--quiet', '--disable-pip-version-check']
+        if has_wheelhouse():
+            result = subprocess.run(pip + ['--no-index', '--find-links', WHEELHOUSE_DIR] + missing,
+                                    capture_output=True, text=True)
+            if result.returncode == 0:
+                print(f"✓ Dependencies installed from the bundled wheelhouse: {', '.join(missing)}")
+                return missing
+            print("⚠ Bundled wheelhouse is incomplete, downloading from PyPI")
+        subprocess.check_call(pip + missing)
+        print(f"✓ Dependencies installed: {', '.join(missing)}")
+        return missing
+    except Exception as e:
+        print(f"✗ Failed to install dependencies: {e}")
+        return None
+
+def build_wheelhouse():
+    """Download wheels for requirements.txt into WHEELHOUSE_DIR for offline installs"""
     try:
         subprocess.check_call([
-            sys.executable, '-m', 'pip', 'install', '-r', 
-            os.path.join(os.path.dirname(__file__), 'requirements.txt'),
-            '--quiet'
+            sys.executable, '-m', 'pip', 'download', '--only-binary=:all:', '--dest', WHEELHOUSE_DIR,
+            '-r', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'requirements.txt')
         ])
-        print("✓ Dependencies installed successfully")
+        print(f"✓ Wheelhouse ready: {WHEELHOUSE_DIR}")
         return True
     except Exception as e:
-        print(f"✗ Failed to install dependencies: {e}")
+        print(f"✗ Failed to build the wheelhouse: {e}")
         return False
 
 def create_install_directory():
@@ -52,40 +125,85 @@ def create_install_directory():
         return False
 
 def copy_agent_files():
-    """Copy agent files to installation directory"""
+    """Copy the agent files whose content changed since the last install
+
+    INSTALL_MANIFEST records each installed file's sha256 with its size and
+    mtime, so an unchanged file is recognised without reading it again.
+    Returns the names copied, None on failure.
+    """
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
+        try:
+            with open(INSTALL_MANIFEST) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
         
-        # Copy main agent script
-        shutil.copy(
-            os.path.join(script_dir, 'network_monitor_agent.py'),
-            SERVICE_SCRIPT
-        )
-        
-        # Copy requirements
-        shutil.copy(
-            os.path.join(script_dir, 'requirements.txt'),
-            os.path.join(INSTALL_DIR, 'requirements.txt')
-        )
+        copied = []
+        for name in AGENT_FILES:
+            source = os.path.join(script_dir, name)
+            target = os.path.join(INSTALL_DIR, name)
+            if not os.path.exists(source):
+                continue
+            digest = file_sha256(source)
+            recorded = manifest.get(name, {})
+            if os.path.exists(target):
+                stat = os.stat(target)
+                if recorded.get('sha256') == digest and recorded.get('stat') == [stat.st_size, stat.st_mtime_ns]:
+                    continue
+                if file_sha256(target) == digest:
+                    manifest[name] = {'sha256': digest, 'stat': [stat.st_size, stat.st_mtime_ns]}
+                    continue
+            
+            # Copy next to the target and rename, so a running agent never loads a partial file
+            temporary = target + '.tmp'
+            shutil.copy2(source, temporary)
+            os.replace(temporary, target)
+            stat = os.stat(target)
+            manifest[name] = {'sha256': digest, 'stat': [stat.st_size, stat.st_mtime_ns]}
+            copied.append(name)
         
-        # Copy service wrapper
-        shutil.copy(
-            os.path.join(script_dir, 'service_wrapper.py'),
-            os.path.join(INSTALL_DIR, 'service_wrapper.py')
-        )
+        with open(INSTALL_MANIFEST + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(INSTALL_MANIFEST + '.tmp', INSTALL_MANIFEST)
         
-        print("✓ Agent files copied successfully")
-        return True
+        if copied:
+            print(f"✓ Agent files copied: {', '.join(copied)}")
+        else:
+            print("✓ Agent files already up to date")
+        return copied
     except Exception as e:
         print(f"✗ Failed to copy agent files: {e}")
-        return False
+        return None
+
+def service_registered():
+    """True if the agent's Windows service already exists"""
+    result = subprocess.run(['sc', 'query', AGENT_NAME], capture_output=True, text=True)
+    return result.returncode == 0
+
+def install_windows_service(changed=True):
+    """Install the agent as a Windows service for auto-start
 
-def install_windows_service():
-    """Install the agent as a Windows service for auto-start"""
+    A service left by an earlier install is kept and only restarted when the
+    files or dependencies changed.
+    """
     try:
         # Import service wrapper
         service_script = os.path.join(INSTALL_DIR, 'service_wrapper.py')
         
+        if service_registered():
+            if not changed:
+                print("✓ Windows service already installed")
+                return True
+            result = subprocess.run([
+                sys.executable, service_script, 'restart'
+            ], capture_output=True, text=True)
+            if result.returncode == 0:
+                print("✓ Windows service restarted with the updated agent")
+            else:
+                print(f"⚠ Service installed but failed to restart: {result.stderr}")
+            return True
+        
         # Install the service using the service wrapper
         result = subprocess.run([
             sys.executable, service_script, 'install'
@@ -223,6 +341,30 @@ def start_agent():
         print(f"✗ Failed to start agent: {e}")
         return False
 
+def timed_step(name, function, *args):
+    """Run one install step and record how long it took for the timing report"""
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    except Exception as e:
+        print(f"✗ {name} failed: {e}")
+        result = None
+    if result is None or result is False:
+        outcome = 'failed'
+    elif result == []:
+        outcome = 'unchanged'
+    else:
+        outcome = 'done'
+    step_timings.append((name, time.perf_counter() - start, outcome))
+    return result
+
+def print_timing_report(total):
+    """Per-step durations; steps that ran concurrently add up to more than the total"""
+    print("\nStep timings:")
+    for name, seconds, outcome in step_timings:
+        print(f"  {name:<16} {seconds:7.2f}s  {outcome}")
+    print(f"  {'total':<16} {total:7.2f}s")
+
 def uninstall():
     """Uninstall the agent"""
     if not is_admin():
@@ -297,6 +439,10 @@ def main():
     if len(sys.argv) > 1 and sys.argv[1].lower() == 'uninstall':
         return uninstall()
     
+    # Build machine: bundle the dependencies next to the installer
+    if len(sys.argv) > 1 and sys.argv[1].lower() == 'wheelhouse':
+        return build_wheelhouse()
+    
     # Check admin privileges
     if not is_admin():
         print("\n✗ This installer requires administrator privileges")
@@ -304,32 +450,37 @@ def main():
         return False
     
     print("\nInstalling agent...")
+    started = time.perf_counter()
     
-    # Step 1: Install dependencies
-    if not install_dependencies():
+    # Step 1: Create installation directory
+    if not timed_step('directory', create_install_directory):
         return False
     
-    # Step 2: Create installation directory
-    if not create_install_directory():
-        return False
-    
-    # Step 3: Copy agent files
-    if not copy_agent_files():
+    # Step 2: Dependencies, agent files and the registry entry (additional
+    # fallback) do not depend on each other, so they run side by side
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        dependencies = pool.submit(timed_step, 'dependencies', install_dependencies)
+        files = pool.submit(timed_step, 'files', copy_agent_files)
+        registry = pool.submit(timed_step, 'registry', add_to_registry)
+    installed, copied = dependencies.result(), files.result()
+    if installed is None or copied is None:
+        print_timing_report(time.perf_counter() - started)
         return False
+    if not registry.result():
+        print("⚠ Warning: Could not add registry entry (non-critical)")
     
-    # Step 4: Install Windows service (primary method)
-    service_installed = install_windows_service()
+    # Step 3: Install Windows service (primary method); needs service_wrapper.py
+    # and pywin32 from step 2
+    service_installed = timed_step('service', install_windows_service, bool(installed or copied))
     
-    # Step 5: Create scheduled task as fallback if service installation failed
+    # Step 4: Create scheduled task as fallback if service installation failed
     if not service_installed:
         print("⚠ Windows service installation failed, using scheduled task as fallback")
-        if not create_scheduled_task_fallback():
+        if not timed_step('scheduled task', create_scheduled_task_fallback):
             print("⚠ Both service and scheduled task installation failed")
-            # Continue with registry method as last resort
+            # The registry entry is the last resort
     
-    # Step 6: Add to registry as additional fallback
-    if not add_to_registry():
-        print("⚠ Warning: Could not add registry entry (non-critical)")
+    print_timing_report(time.perf_counter() - started)
     
     print("\n" + "=" * 60)
     print("✓ Installation completed successfully!")
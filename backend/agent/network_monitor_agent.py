@@ -11,27 +11,2079 @@ import os
 import sys
 import time
 import json
+import math
+import zlib
+import base64
+import random
+import hashlib
+import hmac
+import itertools
 import socket
-import psutil
-import requests
+import gzip
+import mmap
+import heapq
+import struct
+import marshal
+import shutil
+import queue
+import atexit
+import logging
+import logging.handlers
 import threading
-import subprocess
-from datetime import datetime
-from collections import defaultdict
-from urllib.parse import urlparse
-import ctypes
-import winreg
-import uuid
-import platform
+import tracemalloc
+from collections import defaultdict, namedtuple, deque
 
 # Configuration
 AGENT_VERSION = "1.0.0"
-CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".it_monitor", "config.json")
-LOG_FILE = os.path.join(os.path.expanduser("~"), ".it_monitor", "agent.log")
+# Config, log and caches; ITMONITOR_HOME moves them (and the status record) to a scratch
+# directory for the benchmark, soak and fleet harnesses
+AGENT_HOME = os.environ.get('ITMONITOR_HOME') or os.path.join(os.path.expanduser("~"), ".it_monitor")
+CONFIG_FILE = os.path.join(AGENT_HOME, "config.json")
+LOG_FILE = os.path.join(AGENT_HOME, "agent.log")
+# Machine-wide, so an administrator's status command finds the record of the agent running
+# as the LocalSystem service, whose ~ is a different profile
+STATUS_DIR = (os.path.join(os.environ['PROGRAMDATA'], "ITNetworkMonitor")
+              if os.environ.get('PROGRAMDATA') and not os.environ.get('ITMONITOR_HOME') else AGENT_HOME)
+STATUS_FILE = os.path.join(STATUS_DIR, "status.bin")  # live status, see StatusSegment
+RULES_FILE = os.path.join(AGENT_HOME, "rules.bin")  # compiled rules bundle cache
+RULES_INTERVAL = 3600  # seconds between conditional fetches of the classification rules
+RULES_CACHE_FORMAT = 1
+UPDATE_STATE_FILE = os.path.join(AGENT_HOME, "update.json")  # see SelfUpdater
+UPDATE_CHECK_INTERVAL = 21600  # seconds between update manifest checks (an 'update' command checks at once)
+UPDATE_CONFIRM_SECONDS = 1800  # an update without a successful upload within this long is rolled back...
+UPDATE_MAX_UNCONFIRMED_STARTS = 3  # ...as is one that was started this often without confirming
+UPDATE_PUBLIC_KEY_FILE = "update_public_key.txt"  # hex Ed25519 key next to the agent; manifests must be signed with it
+LOG_LEVEL = "INFO"  # config: log_level; DEBUG also logs every successful upload/heartbeat
+LOG_MAX_BYTES = 5 * 1024 * 1024  # rotate agent.log at this size...
+LOG_ROTATE_SECONDS = 86400  # ...or once a day, whichever comes first
+LOG_BACKUP_COUNT = 7  # gzip-compressed segments kept (agent.log.1.gz ...)
 BACKEND_URL = "http://localhost:5001/api"  # Development environment
 BACKUP_BACKEND_URL = "https://itmanagement.bylinelms.com/api"  # Production fallback
 UPDATE_INTERVAL = 10  # seconds
-HEARTBEAT_INTERVAL = 60  # seconds
+HEARTBEAT_INTERVAL = 60  # seconds; heartbeats are only sent while the command channel is down
+UDP_HEARTBEAT_ACK_TIMEOUT = 2  # seconds to wait for the collector's acknowledgement per attempt
+UDP_HEARTBEAT_ATTEMPTS = 2  # datagrams sent before falling back to an HTTPS heartbeat
+UDP_HEARTBEAT_MAX_SKEW = 300  # seconds a heartbeat timestamp may differ from the receiver's clock
+RELAY_PORT = 5002  # LAN port the relay command listens on
+RELAY_FLUSH_SECONDS = 60  # merged uploads are forwarded upstream this often
+RELAY_ALLOWLIST_TTL = 3600  # seconds a token confirmed by the backend stays allowed
+RELAY_DENYLIST_TTL = 300  # seconds a rejected token is refused without asking the backend again
+RELAY_MAX_AGENTS = 2000  # agents with pending data; uploads from more are answered 503
+RELAY_BULK_BATCH = 200  # agents per logs/bulk request
+RELAY_POLL_POOL = 256  # upstream connections kept for agents' command long-polls
+RELAY_RESOLVE_MAX_IPS = 512  # addresses per resolve request
+RELAY_RESOLVE_TIMEOUT = 1  # seconds an agent waits for its relay's resolver
+RELAY_MAX_BODY_BYTES = 8 * 1024 * 1024  # request bodies (also after gzip decoding); larger ones are answered 413
+COMMAND_POLL_SECONDS = 240  # how long the backend holds a command long-poll open (config: command_poll_seconds)
+COMMAND_BACKOFF_MIN = 5  # seconds before re-polling after a failed poll, doubling...
+COMMAND_BACKOFF_MAX = 300  # ...up to this
+# Settings a config command may change and the values each takes: (type, minimum, maximum), a list
+# of allowed values, bool or str. The ones not applied live take effect on the next start
+PUSHED_CONFIG_KEYS = {'update_interval': (int, 1, 3600), 'cpu_budget_percent': (float, 0.1, 100.0),
+                      'rss_budget_mb': (int, 32, 4096), 'command_poll_seconds': (int, 10, 900),
+                      'metrics_port': (int, 1024, 65535), 'log_level': ['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                      'service_seeding': bool, 'memory_profiling': bool, 'auto_update': bool,
+                      'packet_capture': str, 'dns_server': str, 'udp_heartbeat': str, 'relay_url': str}
+PUSHED_CONFIG_OPTIONAL = {'metrics_port', 'packet_capture', 'dns_server', 'udp_heartbeat', 'relay_url'}  # null turns off
+RATE_SKETCH_ACCURACY = 0.05  # relative error of per-label rate percentiles
+RATE_SKETCH_MAX_BINS = 128  # bounds each serialized sketch to well under 1 KB
+RATE_SKETCH_MIN_BPS = 1.0  # rates below this count as idle seconds
+HLL_PRECISION = 10  # 1024 one-byte registers per sketch, ~3.3% standard error
+MIN_SAMPLE_INTERVAL = 1  # seconds, cadence while traffic is active
+MAX_SAMPLE_INTERVAL = 15  # seconds, cadence after a sustained idle period
+IDLE_BYTES_PER_SEC = 2048  # below this (and with no connection churn) a tick is idle
+IDLE_TICKS_BEFORE_BACKOFF = 5  # consecutive idle ticks before the interval doubles
+BATTERY_SAMPLE_INTERVAL = 30  # seconds, single aligned wakeup while on battery
+BATTERY_UPDATE_INTERVAL = 120  # seconds
+BATTERY_HEARTBEAT_INTERVAL = 300  # seconds
+POWER_CHECK_INTERVAL = 60  # seconds between sensors_battery() polls
+RESUME_GAP_THRESHOLD = 30  # seconds a wait may overrun before it counts as a sleep
+DNS_CACHE_TTL = 3600  # seconds an IP -> label resolution is reused
+DNS_CACHE_MAX_ENTRIES = 4096
+DNS_CACHE_LOW_WATER = 0.9  # fraction of the cache kept when a full cache is pruned
+PASSIVE_DNS_MAX_ENTRIES = 8192  # IP -> name entries learned from observed DNS answers
+PASSIVE_DNS_MIN_TTL = 60  # seconds; answers often carry TTLs shorter than the first sample interval
+PASSIVE_DNS_MAX_TTL = 86400
+CAPTURE_RING = 4096  # captured DNS answers and flow openings buffered between ticks (oldest dropped)
+CAPTURE_MAX_RECORDS = 2048  # captured records processed per tick
+CAPTURE_FLOW_TRACK = 8192  # TCP flows remembered as already inspected
+SERVER_NAME_INSPECT_BYTES = 512  # leading bytes of a flow's first segment searched for SNI / Host
+FLOW_NAME_MAX_ENTRIES = 4096  # flow -> server name labels
+FLOW_NAME_TTL = 3600  # seconds
+SEED_SUBDOMAINS = ('', 'www', 'api', 'app')  # forward-resolved under every mapped domain
+SEED_CONCURRENCY = 4  # lookups in flight at once
+SEED_BATCH = 16  # names resolved per seeding round
+SEED_ROUND_TIMEOUT = 10  # seconds a round waits for its lookups
+SEED_POLL_MIN = 5  # seconds between seeding rounds, at least...
+SEED_POLL_MAX = 300  # ...and at most
+SEED_MIN_REFRESH = 300  # seconds; answer TTLs are clamped into this range for re-resolution
+SEED_MAX_REFRESH = 21600
+SEED_NEGATIVE_REFRESH = 21600  # names without addresses (NXDOMAIN) are retried this rarely
+SEED_RETRY = 600  # after a failed or timed-out lookup
+SEED_DEFAULT_TTL = 1800  # for answers from the OS resolver, which does not report TTLs
+SEED_QUERY_TIMEOUT = 2  # seconds per UDP query to the configured DNS server
+CPU_BUDGET_PERCENT = 2.0  # agent CPU budget, percent of one core (config: cpu_budget_percent)
+RSS_BUDGET_MB = 150  # agent memory budget (config: rss_budget_mb)
+GOVERNOR_WINDOW = 30  # seconds of CPU usage averaged per budget check
+GOVERNOR_RECOVERY_WINDOWS = 2  # windows comfortably under budget before stepping back
+DEGRADATION_LEVELS = ['normal', 'skip-enrichment', 'sampled-scans', 'long-intervals']
+SAMPLED_SCAN_EVERY = 5  # ticks between connection table scans when sampling
+SAMPLED_SCAN_LIMIT = 256  # connections attributed per tick when sampling
+DEGRADED_INTERVAL_FACTOR = 4  # sampling interval multiplier at the last level
+# Latency histogram bucket upper bounds in seconds (last bucket is open-ended)
+LATENCY_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+WATCHDOG_INTERVAL = 5  # minimum seconds between worker liveness checks (shortest stage deadline)
+# Longest a worker may stay inside a stage before it is treated as stalled and replaced
+STAGE_DEADLINES = {'io_counters': 5, 'connections': 5, 'capture': 5, 'resolution': 5, 'classification': 5,
+                   'seeding': 30, 'rules_fetch': 45, 'command_poll': 600, 'update': 600, 'aggregation': 10, 'tick': 60, 'payload_build': 30, 'http_post': 45, 'heartbeat': 30}
+STAGE_DEADLINE_DEFAULT = 30
+WORKER_JOIN_TIMEOUT = 5  # seconds run() waits for each worker on shutdown
+TRACE_MAX_EVENTS = 100000  # cap on buffered Chrome-trace events
+METRICS_HOST = "127.0.0.1"  # self-metrics endpoint only listens on loopback
+MAX_PENDING_LABELS = 2000  # labels kept in network_stats while uploads are failing
+OVERFLOW_LABEL = "other"  # label for traffic beyond MAX_PENDING_LABELS
+MEMORY_PROFILE_INTERVAL = 300  # seconds between tracemalloc snapshots (config: memory_profiling)
+MEMORY_PROFILE_TOP = 10  # allocation sites reported per snapshot
+MEMORY_GROWTH_STREAK = 6  # consecutive growing snapshots before a site is a leak suspect
+STATUS_TOP_LABELS = 5  # labels with the most pending traffic kept in the status record
+STATUS_LABEL_BYTES = 40  # UTF-8 bytes per label in the status record (longer labels are cut)
+STATUS_STALE_SECONDS = 180  # a status record not updated for this long means the agent is not running
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Size- and age-based rotating file handler that gzips rotated segments"""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, rotate_seconds=LOG_ROTATE_SECONDS,
+                 backup_count=LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.rotate_seconds = rotate_seconds
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+        self.opened_at = self._segment_started()
+
+    def _segment_started(self):
+        """When the current log file was started: the last rollover, else the file's creation
+
+        Restarting the agent must not restart the age clock, or a service that is
+        restarted daily would never rotate by age.
+        """
+        try:
+            return os.stat(self.rotation_filename(f"{self.baseFilename}.1")).st_mtime
+        except OSError:
+            pass
+        try:
+            stat = os.stat(self.baseFilename)
+        except OSError:
+            return time.time()
+        # Only Windows (st_ctime) and some platforms (st_birthtime) report creation time
+        return getattr(stat, 'st_birthtime', stat.st_ctime if os.name == 'nt' else stat.st_mtime)
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and time.time() - self.opened_at >= self.rotate_seconds:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.opened_at = time.time()
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+_log_listener = None
+
+def setup_logging(level=LOG_LEVEL, log_file=LOG_FILE):
+    """Configure the shared 'itmonitor' logger (idempotent)
+
+    Callers only enqueue records; a single QueueListener thread owns the open log
+    file (and the console when interactive), so logging never blocks the sampling
+    loop on file or console I/O.
+    """
+    global _log_listener
+    logger = logging.getLogger('itmonitor')
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    if _log_listener is not None:
+        return logger
+    
+    formatter = logging.Formatter('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S')
+    handlers = []
+    try:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        handlers.append(CompressingRotatingFileHandler(log_file))
+    except Exception as e:
+        print(f"Failed to open log file: {e}")
+    if sys.stdout is not None and sys.stdout.isatty():
+        handlers.append(logging.StreamHandler(sys.stdout))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(shutdown_logging)
+    return logger
+
+def shutdown_logging():
+    """Flush queued records and close the log file"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+class RateSketch:
+    """Fixed-size DDSketch of per-second throughput samples (bytes/sec)
+
+    Values are bucketed on a logarithmic scale so every quantile is within
+    RATE_SKETCH_ACCURACY of the true value. Two sketches with the same accuracy
+    merge exactly by adding bucket counts, so intervals and hosts can be combined.
+    """
+
+    def __init__(self, relative_accuracy=RATE_SKETCH_ACCURACY, max_bins=RATE_SKETCH_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value, weight=1):
+        """Record a rate sample"""
+        self.count += weight
+        if value > self.max:
+            self.max = float(value)
+        if value < RATE_SKETCH_MIN_BPS:
+            self.zero_count += weight
+            return
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.bins[key] = self.bins.get(key, 0) + weight
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        """Fold the lowest buckets together so the sketch stays within max_bins"""
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            self.bins[target] += self.bins.pop(key)
+
+    def merge(self, other):
+        """Merge another sketch into this one"""
+        if abs(other.gamma - self.gamma) > 1e-12:
+            raise ValueError("Cannot merge rate sketches with different accuracy")
+        for key, weight in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + weight
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        return self
+
+    def quantile(self, q):
+        """Estimate the q-th quantile (0 <= q <= 1)"""
+        if self.count == 0:
+            return 0.0
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                estimate = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(estimate, self.max)
+        return self.max
+
+    def summary(self):
+        """Percentile summary included in each upload"""
+        return {
+            'p50': round(self.quantile(0.50), 1),
+            'p95': round(self.quantile(0.95), 1),
+            'p99': round(self.quantile(0.99), 1),
+            'max': round(self.max, 1)
+        }
+
+    def to_dict(self):
+        """Serialize to a compact JSON-friendly form (dense counts from 'offset')"""
+        offset = min(self.bins) if self.bins else 0
+        top = max(self.bins) if self.bins else -1
+        return {
+            'alpha': self.relative_accuracy,
+            'n': self.count,
+            'zero': self.zero_count,
+            'max': round(self.max, 1),
+            'offset': offset,
+            'counts': [self.bins.get(key, 0) for key in range(offset, top + 1)]
+        }
+
+    @classmethod
+    def from_dict(cls, data, max_bins=RATE_SKETCH_MAX_BINS):
+        """Rebuild a sketch serialized with to_dict()"""
+        sketch = cls(data.get('alpha', RATE_SKETCH_ACCURACY), max_bins)
+        sketch.count = data.get('n', 0)
+        sketch.zero_count = data.get('zero', 0)
+        sketch.max = float(data.get('max', 0.0))
+        offset = int(data.get('offset', 0))
+        sketch.bins = {offset + i: weight for i, weight in enumerate(data.get('counts', [])) if weight}
+        if len(sketch.bins) > sketch.max_bins:
+            sketch._collapse()
+        return sketch
+
+_HLL_INVERSE_POWERS = [2.0 ** -r for r in range(66)]
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with a fixed 2**precision byte footprint
+
+    Used to count distinct remote IPs and ports per label without storing them.
+    Sketches with the same precision merge by taking the register-wise maximum.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self.inverse_sum = float(self.size)
+        self.zeros = self.size
+
+    def _recount(self):
+        # Running harmonic sum and zero count keep estimate() O(1)
+        self.inverse_sum = sum(map(_HLL_INVERSE_POWERS.__getitem__, self.registers))
+        self.zeros = self.registers.count(0)
+
+    def add(self, value):
+        """Add a string value to the sketch"""
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest()
+        x = int.from_bytes(digest, 'big')
+        index = x >> (64 - self.precision)
+        rest = (x << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.precision + 1 if rest == 0 else 65 - rest.bit_length()
+        previous = self.registers[index]
+        if rank > previous:
+            self.registers[index] = rank
+            self.inverse_sum += _HLL_INVERSE_POWERS[rank] - _HLL_INVERSE_POWERS[previous]
+            if previous == 0:
+                self.zeros -= 1
+
+    def merge(self, other):
+        """Merge another sketch into this one"""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLog sketches with different precision")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        self._recount()
+        return self
+
+    def estimate(self):
+        """Estimated number of distinct values added"""
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / self.inverse_sum
+        if raw <= 2.5 * m and self.zeros:
+            return int(round(m * math.log(m / self.zeros)))
+        return int(round(raw))
+
+    def to_string(self):
+        """Serialize as base64 of the zlib-compressed registers"""
+        return base64.b64encode(zlib.compress(bytes(self.registers))).decode('ascii')
+
+    @classmethod
+    def from_string(cls, data, precision=HLL_PRECISION):
+        """Rebuild a sketch serialized with to_string()"""
+        sketch = cls(precision)
+        registers = zlib.decompress(base64.b64decode(data))
+        if len(registers) != sketch.size:
+            raise ValueError("HyperLogLog register size does not match precision")
+        sketch.registers = bytearray(registers)
+        sketch._recount()
+        return sketch
+
+class AdaptiveCadence:
+    """Chooses the sampling interval from recent traffic activity
+
+    Backs off exponentially towards MAX_SAMPLE_INTERVAL while byte deltas and
+    connection churn stay near zero and snaps back to MIN_SAMPLE_INTERVAL as soon
+    as activity returns. Byte totals stay exact at any interval because they are
+    computed from counter deltas.
+    """
+
+    def __init__(self, min_interval=MIN_SAMPLE_INTERVAL, max_interval=MAX_SAMPLE_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.idle_ticks = 0
+        self.ticks = 0
+        self.skipped_ticks = 0
+        self.tick_cpu_seconds = 0.0
+
+    def update(self, bytes_per_sec, churn, tick_cpu_seconds=0.0):
+        """Record one tick's activity and return the next sampling interval"""
+        self.ticks += 1
+        self.tick_cpu_seconds += tick_cpu_seconds
+        if bytes_per_sec > IDLE_BYTES_PER_SEC or churn > 0:
+            self.idle_ticks = 0
+            self.interval = self.min_interval
+        else:
+            self.idle_ticks += 1
+            if self.idle_ticks >= IDLE_TICKS_BEFORE_BACKOFF:
+                self.interval = min(self.interval * 2, self.max_interval)
+        # Ticks a fixed one-second loop would have run during this interval
+        self.skipped_ticks += max(self.interval / self.min_interval - 1, 0)
+        return self.interval
+
+    def metrics(self):
+        """Cadence section of the agent's self-metrics"""
+        ticks = self.ticks or 1
+        avg_tick_cpu = self.tick_cpu_seconds / ticks
+        return {
+            'sampleIntervalSec': self.interval,
+            'avgSampleIntervalSec': round((self.ticks + self.skipped_ticks) * self.min_interval / ticks, 2),
+            'ticks': self.ticks,
+            'skippedTicks': int(self.skipped_ticks),
+            'cpuSavedSec': round(self.skipped_ticks * avg_tick_cpu, 4)
+        }
+
+class PowerPolicy:
+    """Tracks AC/battery state and detects resume from sleep
+
+    While on battery the agent folds sampling, upload and heartbeat work into one
+    wall-clock aligned wakeup with longer intervals. A wait that overruns by more
+    than RESUME_GAP_THRESHOLD on either the monotonic or the wall clock means the
+    machine was suspended.
+    """
+
+    def __init__(self):
+        self.on_battery = False
+        self.ac_power = threading.Event()  # set while on AC power
+        self.ac_power.set()
+        self.last_check = None
+        self.wait_started = None
+        self.resumes = 0
+
+    def refresh(self):
+        """Poll the battery state (rate limited); returns True if it changed"""
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < POWER_CHECK_INTERVAL:
+            return False
+        self.last_check = now
+        try:
+            import psutil
+            battery = psutil.sensors_battery()
+        except Exception:
+            battery = None
+        on_battery = battery is not None and battery.power_plugged is False
+        if on_battery == self.on_battery:
+            return False
+        self.on_battery = on_battery
+        if on_battery:
+            self.ac_power.clear()
+        else:
+            self.ac_power.set()
+        return True
+
+    def next_wakeup(self, interval):
+        """Delay until the next tick; aligned to the wall clock on battery"""
+        if not self.on_battery:
+            return interval
+        return BATTERY_SAMPLE_INTERVAL - (time.time() % BATTERY_SAMPLE_INTERVAL)
+
+    def mark_wait(self, interval):
+        """Record the start of a wait of the given length"""
+        self.wait_started = (time.time(), time.monotonic(), interval)
+
+    def detect_resume(self):
+        """Return True if the last wait was interrupted by a suspend"""
+        if self.wait_started is None:
+            return False
+        wall, mono, interval = self.wait_started
+        self.wait_started = None
+        overrun = max(time.time() - wall, time.monotonic() - mono) - interval
+        if overrun > RESUME_GAP_THRESHOLD:
+            self.resumes += 1
+            return True
+        return False
+
+    def metrics(self):
+        """Power section of the agent's self-metrics"""
+        return {
+            'onBattery': self.on_battery,
+            'resumes': self.resumes
+        }
+
+class ResourceGovernor:
+    """Measures the agent's own CPU time and RSS and sheds optional work over budget
+
+    Each stage is timed with the calling thread's CPU clock. Every GOVERNOR_WINDOW
+    seconds the process CPU share and RSS are checked against the budget: over
+    budget raises the degradation level by one, and GOVERNOR_RECOVERY_WINDOWS
+    comfortably under budget lower it again.
+    """
+
+    def __init__(self, cpu_budget_percent=CPU_BUDGET_PERCENT, rss_budget_mb=RSS_BUDGET_MB):
+        self.cpu_budget_percent = cpu_budget_percent
+        self.rss_budget_mb = rss_budget_mb
+        import psutil
+        self.process = psutil.Process()
+        self.level = 0
+        self.stage_cpu = defaultdict(float)
+        self.last_stage_cpu = {}
+        self.cpu_percent = 0.0
+        self.rss_mb = 0.0
+        self.recovery_windows = 0
+        self.window_start = None
+
+    def _process_cpu(self):
+        times = self.process.cpu_times()
+        return times.user + times.system
+
+    def evaluate(self):
+        """Check the budget once per window; returns True if the level changed"""
+        now = time.monotonic()
+        if self.window_start is None:
+            self.window_start = (now, self._process_cpu())
+            return False
+        started, cpu_start = self.window_start
+        if now - started < GOVERNOR_WINDOW:
+            return False
+        cpu_now = self._process_cpu()
+        self.window_start = (now, cpu_now)
+        self.cpu_percent = (cpu_now - cpu_start) / (now - started) * 100
+        self.rss_mb = self.process.memory_info().rss / (1024 * 1024)
+        self.last_stage_cpu = dict(self.stage_cpu)
+        self.stage_cpu.clear()
+        
+        previous = self.level
+        if self.cpu_percent > self.cpu_budget_percent or self.rss_mb > self.rss_budget_mb:
+            self.recovery_windows = 0
+            self.level = min(self.level + 1, len(DEGRADATION_LEVELS) - 1)
+        elif self.cpu_percent < self.cpu_budget_percent / 2 and self.rss_mb < self.rss_budget_mb * 0.9:
+            self.recovery_windows += 1
+            if self.recovery_windows >= GOVERNOR_RECOVERY_WINDOWS and self.level > 0:
+                self.level -= 1
+                self.recovery_windows = 0
+        return self.level != previous
+
+    @property
+    def skip_enrichment(self):
+        return self.level >= 1
+
+    @property
+    def sampled_scans(self):
+        return self.level >= 2
+
+    @property
+    def long_intervals(self):
+        return self.level >= 3
+
+    def metrics(self):
+        """Governor section of the agent's self-metrics"""
+        return {
+            'level': self.level,
+            'levelName': DEGRADATION_LEVELS[self.level],
+            'cpuPercent': round(self.cpu_percent, 2),
+            'rssMB': round(self.rss_mb, 1),
+            'cpuBudgetPercent': self.cpu_budget_percent,
+            'rssBudgetMB': self.rss_budget_mb,
+            'stageCpuSec': {name: round(value, 4) for name, value in self.last_stage_cpu.items()}
+        }
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (bounds in LATENCY_BUCKETS)"""
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Record one duration"""
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (capped at max)"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(LATENCY_BUCKETS[index], self.max)
+        return self.max
+
+    def summary(self):
+        """p50/p95/max in milliseconds"""
+        return {
+            'count': self.count,
+            'p50': round(self.quantile(0.50) * 1000, 3),
+            'p95': round(self.quantile(0.95) * 1000, 3),
+            'max': round(self.max * 1000, 3)
+        }
+
+class PipelineProfiler:
+    """Per-stage latency histograms with optional Chrome-trace event capture"""
+
+    def __init__(self, tracing=False):
+        self.histograms = defaultdict(LatencyHistogram)
+        self.tracing = tracing
+        self.trace_events = []
+        self.origin = time.monotonic()
+
+    def record(self, name, start, duration):
+        """Record a stage that started at monotonic time start"""
+        self.histograms[name].add(duration)
+        if self.tracing and len(self.trace_events) < TRACE_MAX_EVENTS:
+            self.trace_events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': round((start - self.origin) * 1e6, 1),
+                'dur': round(duration * 1e6, 1),
+                'pid': os.getpid(),
+                'tid': threading.get_ident()
+            })
+
+    def summary(self):
+        """Latency summary per stage"""
+        return {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+
+    def report(self):
+        """Human readable per-stage table"""
+        lines = [f"{'stage':<16}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:<16}{stats['count']:>8}{stats['p50']:>12.3f}"
+                         f"{stats['p95']:>12.3f}{stats['max']:>12.3f}")
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """Write buffered events as Chrome-trace JSON (chrome://tracing, Perfetto)"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+
+class _StageTimer:
+    """Times a with-block: thread CPU to the governor, wall latency to the profiler,
+    entry and exit to the watchdog"""
+
+    def __init__(self, governor, profiler, watchdog, name):
+        self.governor = governor
+        self.profiler = profiler
+        self.watchdog = watchdog
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.cpu_start = time.thread_time()
+        self.watchdog.enter(self.name, self.start)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.watchdog.exit()
+        self.governor.stage_cpu[self.name] += time.thread_time() - self.cpu_start
+        self.profiler.record(self.name, self.start, time.monotonic() - self.start)
+        return False
+
+class _WorkerLease:
+    """A worker thread's claim to its role; invalidated when the watchdog replaces it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.valid = True
+        self.thread = None
+        self.error = None
+
+class Watchdog:
+    """Supervises the agent's worker threads with per-stage liveness deadlines
+
+    Stages report entry and exit through NetworkMonitorAgent.stage. A worker that
+    has been inside a stage for longer than its STAGE_DEADLINES entry, or that died
+    with an exception, is replaced by a fresh thread running the same loop. Python
+    cannot kill the stuck thread, so it is abandoned: its lease is invalidated and
+    it exits as soon as the blocking call returns. All state lives on the agent,
+    so pending stats and caches carry over to the new thread.
+    """
+
+    def __init__(self, deadlines=STAGE_DEADLINES):
+        self.deadlines = deadlines
+        self.stacks = {}  # thread ident -> [(stage, entered at)]
+        self.workers = {}  # worker name -> lease of its current thread
+        self.local = threading.local()
+        self.restarts = defaultdict(int)
+        self.abandoned = []  # replaced threads that had not returned yet
+        self.wakeup = threading.Event()  # set when a worker crashes or the agent stops
+
+    def enter(self, stage, now):
+        self.stacks.setdefault(threading.get_ident(), []).append((stage, now))
+
+    def exit(self):
+        stack = self.stacks.get(threading.get_ident())
+        if stack:
+            stack.pop()
+
+    def spawn(self, name, target):
+        """Start target(lease) on a new daemon thread as worker name"""
+        lease = _WorkerLease(name)
+        
+        def run():
+            self.local.lease = lease
+            try:
+                target(lease)
+            except Exception as e:
+                lease.error = e
+                self.wakeup.set()
+            finally:
+                self.stacks.pop(threading.get_ident(), None)
+        
+        lease.thread = threading.Thread(target=run, name=f"itmonitor-{name}", daemon=True)
+        self.workers[name] = lease
+        lease.thread.start()
+        return lease
+
+    def stalled(self):
+        """(worker, stage, seconds in stage) for stalled workers; stage is None for crashed ones"""
+        now = time.monotonic()
+        found = []
+        for name, lease in list(self.workers.items()):
+            if not lease.thread.is_alive():
+                if lease.error is not None:
+                    found.append((name, None, 0.0))
+                continue
+            for stage, entered in list(self.stacks.get(lease.thread.ident, ())):
+                if now - entered > self.deadlines.get(stage, STAGE_DEADLINE_DEFAULT):
+                    found.append((name, stage, now - entered))
+                    break
+        return found
+
+    def restart(self, name, target):
+        """Abandon the worker's current thread and start a replacement"""
+        old = self.workers[name]
+        old.valid = False
+        if old.thread.is_alive():
+            self.abandoned.append(old.thread)
+        self.restarts[name] += 1
+        return self.spawn(name, target)
+
+    def superseded(self):
+        """True when called on a worker thread that has already been replaced"""
+        lease = getattr(self.local, 'lease', None)
+        return lease is not None and not lease.valid
+
+    def join(self, timeout=WORKER_JOIN_TIMEOUT):
+        for lease in list(self.workers.values()):
+            lease.thread.join(timeout)
+
+    def metrics(self):
+        """Watchdog section of the agent's self-metrics"""
+        self.abandoned = [thread for thread in self.abandoned if thread.is_alive()]
+        return {
+            'restarts': dict(self.restarts),
+            'abandonedThreads': len(self.abandoned)
+        }
+
+class MetricsExporter:
+    """Opt-in localhost endpoint serving agent self-metrics in Prometheus text format
+
+    The sampling loop publishes a snapshot of pre-aggregated metric families once
+    per tick by swapping a reference; scrapes only format that snapshot (plus the
+    process CPU/RSS gauges), so they never take locks or wait on the loop.
+    """
+
+    def __init__(self, port, host=METRICS_HOST):
+        self.host = host
+        self.port = port
+        self.families = []
+        import psutil
+        self.process = psutil.Process()
+        self.server = None
+
+    def publish(self, families):
+        """Replace the snapshot served to scrapers"""
+        self.families = families
+
+    def start(self):
+        """Start serving /metrics on a daemon thread"""
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((self.host, self.port), metrics_handler())
+        self.server.daemon_threads = True
+        self.server.exporter = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Stop serving"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def render(self):
+        """Prometheus text exposition of the latest snapshot"""
+        families = list(self.families)
+        try:
+            cpu = self.process.cpu_times()
+            families.append(('itmonitor_process_cpu_seconds_total', 'counter',
+                             'CPU time used by the agent process', [('', {}, cpu.user + cpu.system)]))
+            families.append(('itmonitor_process_resident_memory_bytes', 'gauge',
+                             'Resident set size of the agent process',
+                             [('', {}, self.process.memory_info().rss)]))
+        except Exception:
+            pass
+        
+        lines = []
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {name} {escape_metric_text(help_text, quotes=False)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_metric_text(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text
+                             else f"{name}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+def escape_metric_text(value, quotes=True):
+    """Escape a label value (or HELP text, without quotes) for the Prometheus text format"""
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quotes else value
+
+def metrics_handler():
+    """Request handler class serving GET /metrics for MetricsExporter
+
+    Built on first use so http.server is only imported when the endpoint is enabled.
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = self.server.exporter.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+def histogram_samples(histogram, labels=None):
+    """Prometheus histogram samples (seconds) for a LatencyHistogram"""
+    labels = labels or {}
+    samples = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        samples.append(('_bucket', dict(labels, le=le), cumulative))
+    samples.append(('_sum', labels, round(histogram.total, 6)))
+    samples.append(('_count', labels, histogram.count))
+    return samples
+
+class SystemCollector:
+    """Live sources of the agent's raw inputs (IO counters, connection table, reverse DNS)"""
+
+    def net_io_counters(self):
+        import psutil
+        return psutil.net_io_counters()
+
+    def net_connections(self):
+        import psutil
+        return psutil.net_connections(kind='inet')
+
+    def gethostbyaddr(self, ip):
+        return socket.gethostbyaddr(ip)
+
+NetIOCounters = namedtuple('NetIOCounters', 'bytes_sent bytes_recv')
+Address = namedtuple('Address', 'ip port')
+Connection = namedtuple('Connection', 'laddr raddr status pid')
+
+class MemoryProfiler:
+    """Diagnostic tracemalloc sampler that flags allocation sites which keep growing
+
+    Each sample diffs a snapshot against the previous one by allocation site
+    (file:line). A site whose size grew in MEMORY_GROWTH_STREAK consecutive
+    samples is reported as a leak suspect, together with its growth since the
+    first snapshot.
+    """
+
+    def __init__(self, top=MEMORY_PROFILE_TOP):
+        self.top = top
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.baseline = None
+        self.previous = None
+        self.streaks = {}
+        self.top_growers = []
+        self.suspects = []
+        self.samples = 0
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+        ))
+
+    def sample(self):
+        """Take a snapshot, update growth streaks and return the current suspects"""
+        snapshot = self._snapshot()
+        self.samples += 1
+        if self.baseline is None:
+            self.baseline = self.previous = snapshot
+            return []
+        
+        streaks = {}
+        for stat in snapshot.compare_to(self.previous, 'lineno'):
+            if stat.size_diff > 0:
+                site = str(stat.traceback[0])
+                streaks[site] = self.streaks.get(site, 0) + 1
+        self.streaks = streaks
+        self.previous = snapshot
+        
+        since_baseline = snapshot.compare_to(self.baseline, 'lineno')
+        growth = {str(stat.traceback[0]): stat.size_diff for stat in since_baseline}
+        self.top_growers = [(str(stat.traceback[0]), stat.size_diff) for stat in since_baseline[:self.top]
+                            if stat.size_diff > 0]
+        self.suspects = sorted(((site, growth.get(site, 0), streak) for site, streak in streaks.items()
+                                if streak >= MEMORY_GROWTH_STREAK and growth.get(site, 0) > 0),
+                               key=lambda item: -item[1])[:self.top]
+        return self.suspects
+
+    def traced_memory(self):
+        """(current, peak) bytes allocated under tracemalloc"""
+        return tracemalloc.get_traced_memory()
+
+    def metrics(self):
+        """Memory section of the agent's self-metrics"""
+        current, peak = self.traced_memory()
+        return {
+            'tracedMB': round(current / (1024 * 1024), 2),
+            'peakMB': round(peak / (1024 * 1024), 2),
+            'samples': self.samples,
+            'suspects': [{'site': site, 'growthKB': round(size / 1024, 1), 'streak': streak}
+                         for site, size, streak in self.suspects]
+        }
+
+    def stop(self):
+        """Stop tracing"""
+        tracemalloc.stop()
+
+# pcap link types understood by the capture sources
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+HTTP_METHODS = {b'GET', b'POST', b'PUT', b'HEAD', b'DELETE', b'PATCH', b'OPTIONS', b'CONNECT'}
+PCAP_MAGIC = {b'\xd4\xc3\xb2\xa1': '<', b'\xa1\xb2\xc3\xd4': '>',  # microsecond timestamps
+              b'\x4d\x3c\xb2\xa1': '<', b'\xa1\xb2\x3c\x4d': '>'}  # nanosecond timestamps
+
+def parse_packet(packet, linktype):
+    """(protocol, source, source port, destination, destination port, tcp flags, payload) or None"""
+    try:
+        if linktype == LINKTYPE_ETHERNET:
+            ethertype, offset = struct.unpack_from('!H', packet, 12)[0], 14
+            while ethertype in (0x8100, 0x88a8):  # VLAN tags
+                ethertype, offset = struct.unpack_from('!H', packet, offset + 2)[0], offset + 4
+            if ethertype not in (0x0800, 0x86dd):
+                return None
+            packet = packet[offset:]
+        elif linktype == LINKTYPE_LINUX_SLL:
+            packet = packet[16:]
+        elif linktype == LINKTYPE_NULL:
+            packet = packet[4:]
+        elif linktype not in (LINKTYPE_RAW, 12, 14):
+            return None
+    
+        version = packet[0] >> 4
+        if version == 4:
+            header = (packet[0] & 0x0f) * 4
+            protocol = packet[9]
+            if struct.unpack_from('!H', packet, 6)[0] & 0x1fff:
+                return None  # non-first fragment
+            end = struct.unpack_from('!H', packet, 2)[0]  # excludes Ethernet padding
+            source = socket.inet_ntop(socket.AF_INET, packet[12:16])
+            destination = socket.inet_ntop(socket.AF_INET, packet[16:20])
+        elif version == 6:
+            header = 40
+            protocol = packet[6]  # extension headers are not followed
+            end = 40 + struct.unpack_from('!H', packet, 4)[0]
+            source = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+            destination = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+        else:
+            return None
+        
+        source_port, destination_port = struct.unpack_from('!HH', packet, header)
+        if protocol == 17:
+            return 'udp', source, source_port, destination, destination_port, 0, packet[header + 8:end]
+        if protocol == 6:
+            data = header + (packet[header + 12] >> 4) * 4
+            flags = packet[header + 13]
+            return 'tcp', source, source_port, destination, destination_port, flags, packet[data:end]
+        return None
+    except (IndexError, ValueError, struct.error):
+        return None
+
+def _dns_name(message, offset):
+    """Decode a possibly compressed DNS name; returns (name, offset after it)"""
+    labels = []
+    end = None
+    for _ in range(128):  # bounds pointer loops
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3f) << 8) | message[offset + 1]
+            continue
+        if length == 0:
+            return '.'.join(labels).lower(), end if end is not None else offset + 1
+        labels.append(message[offset + 1:offset + 1 + length].decode('ascii', 'replace'))
+        offset += 1 + length
+    raise ValueError("DNS name compression loop")
+
+def parse_dns_answers(message):
+    """(queried name, [(address, ttl)]) from a DNS response, None if it has no usable answer
+
+    The address records at the end of a CNAME chain are attributed to the name the
+    client asked for, which is the name that identifies the service.
+    """
+    try:
+        _, flags, questions, answers = struct.unpack_from('!HHHH', message, 0)
+        if not flags & 0x8000 or flags & 0x000f or questions != 1 or not answers:
+            return None  # not a response, an error response, or nothing answered
+        name, offset = _dns_name(message, 12)
+        offset += 4
+        addresses = []
+        for _ in range(answers):
+            _, offset = _dns_name(message, offset)
+            rtype, rclass, ttl, length = struct.unpack_from('!HHIH', message, offset)
+            offset += 10
+            if rclass == 1 and rtype == 1 and length == 4:
+                addresses.append((socket.inet_ntop(socket.AF_INET, message[offset:offset + 4]), ttl))
+            elif rclass == 1 and rtype == 28 and length == 16:
+                addresses.append((socket.inet_ntop(socket.AF_INET6, message[offset:offset + 16]), ttl))
+            offset += length
+    except (IndexError, ValueError, struct.error, OSError):
+        return None
+    if not addresses or not name:
+        return None
+    return name, addresses
+
+def parse_server_name(data):
+    """Server name from a TLS ClientHello (SNI) or an HTTP request (Host), else None"""
+    try:
+        if data[0] == 0x16 and data[1] == 3 and data[5] == 1:
+            # TLS record -> handshake header -> version, random, session id, ciphers, compression
+            offset = 5 + 4 + 2 + 32
+            offset += 1 + data[offset]
+            offset += 2 + struct.unpack_from('!H', data, offset)[0]
+            offset += 1 + data[offset]
+            end = offset + 2 + struct.unpack_from('!H', data, offset)[0]
+            offset += 2
+            while offset + 4 <= min(end, len(data)):
+                kind, length = struct.unpack_from('!HH', data, offset)
+                if kind == 0:  # server_name: list length, name type, name length, name
+                    if data[offset + 6] != 0:
+                        return None
+                    size = struct.unpack_from('!H', data, offset + 7)[0]
+                    name = data[offset + 9:offset + 9 + size]
+                    return name.decode('ascii').lower() if len(name) == size else None
+                offset += 4 + length
+            return None
+        if data[:data.find(b' ')] in HTTP_METHODS:
+            for line in data.split(b'\r\n')[1:]:
+                if line[:5].lower() == b'host:':
+                    host = line[5:].strip().decode('ascii').lower()
+                    return host.rsplit(':', 1)[0] if not host.startswith('[') else None
+        return None
+    except (IndexError, UnicodeDecodeError, struct.error):
+        return None
+
+class PassiveDnsTable:
+    """IP -> queried name learned from observed DNS answers, expiring with the answer TTL
+
+    One dict keyed by the address string (what the connection table reports), with
+    interned names so the many addresses of a CDN-hosted service share one string.
+    """
+
+    def __init__(self, max_entries=PASSIVE_DNS_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = {}  # ip -> (name, expires at monotonic time)
+        self.names = {}
+        self.learned = 0
+        self.hits = 0
+
+    def learn(self, ip, name, ttl, now):
+        """Record an answer; returns True if the address now maps to a different name"""
+        ttl = min(max(ttl, PASSIVE_DNS_MIN_TTL), PASSIVE_DNS_MAX_TTL)
+        name = self.names.setdefault(name, name)
+        previous = self.entries.get(ip)
+        if previous is None and len(self.entries) >= self.max_entries:
+            self.prune(now)
+        self.entries[ip] = (name, now + ttl)
+        self.learned += 1
+        return previous is None or previous[0] != name
+
+    def lookup(self, ip, now):
+        entry = self.entries.get(ip)
+        if entry and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+        return None
+
+    def prune(self, now):
+        """Drop expired entries, then the oldest down to the low-water mark"""
+        self.entries = {ip: entry for ip, entry in self.entries.items() if entry[1] > now}
+        excess = len(self.entries) - int(self.max_entries * DNS_CACHE_LOW_WATER)
+        for ip in list(itertools.islice(self.entries, max(excess, 0))):
+            del self.entries[ip]
+        live = {entry[0] for entry in self.entries.values()}
+        self.names = {name: name for name in live}
+
+    def metrics(self):
+        return {
+            'entries': len(self.entries),
+            'learned': self.learned,
+            'hits': self.hits
+        }
+
+class CaptureFilter:
+    """Reduces captured packets to the records the agent learns from
+
+    ('dns', payload) for DNS responses, and ('flow', local, remote, data) for the first
+    payload segment of each TCP flow, cut to SERVER_NAME_INSPECT_BYTES. Flows are
+    remembered once inspected so later segments are dropped without a copy; a SYN
+    forgets the flow again so a reused port pair is inspected afresh.
+    """
+
+    def __init__(self, linktype):
+        self.linktype = linktype
+        self.flows = {}
+        self.packets = 0
+        self.dropped = 0
+
+    def record(self, packet):
+        parsed = parse_packet(packet, self.linktype)
+        if not parsed:
+            return None
+        protocol, source, source_port, destination, destination_port, flags, payload = parsed
+        if protocol == 'udp':
+            return ('dns', payload) if source_port == 53 and payload else None
+        
+        key = (source, source_port, destination, destination_port)
+        if flags & 0x12 == 0x02:  # SYN without ACK: a new flow
+            self.flows.pop(key, None)
+            return None
+        if not payload or key in self.flows:
+            return None
+        if len(self.flows) >= CAPTURE_FLOW_TRACK:
+            for stale in list(itertools.islice(self.flows, CAPTURE_FLOW_TRACK // 10)):
+                del self.flows[stale]
+        self.flows[key] = True
+        return ('flow', f"{source}:{source_port}", f"{destination}:{destination_port}",
+                bytes(payload[:SERVER_NAME_INSPECT_BYTES]))
+
+class PcapSource(CaptureFilter):
+    """Capture records read from a classic libpcap file (not pcapng), a chunk per drain"""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        header = self.file.read(24)
+        if len(header) < 24 or header[:4] not in PCAP_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not a libpcap capture file")
+        order = PCAP_MAGIC[header[:4]]
+        super().__init__(struct.unpack(order + 'I', header[20:24])[0] & 0x0fffffff)
+        self.header = struct.Struct(order + 'IIII')
+
+    def drain(self, limit=CAPTURE_MAX_RECORDS):
+        """Up to limit records from the next packets in the file"""
+        records = []
+        while self.file and len(records) < limit:
+            header = self.file.read(self.header.size)
+            if len(header) < self.header.size:
+                self.close()
+                break
+            packet = self.file.read(self.header.unpack(header)[2])
+            self.packets += 1
+            record = self.record(packet)
+            if record:
+                records.append(record)
+        return records
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class LiveCapture(CaptureFilter):
+    """Raw-socket packet capture into a bounded ring, drained once per tick
+
+    Windows uses a raw IP socket with SIO_RCVALL on the primary interface, Linux an
+    AF_PACKET socket; both need administrator / CAP_NET_RAW rights. The capture
+    thread keeps only DNS answers and flow openings, so the ring stays small.
+    """
+
+    def __init__(self, local_ip, ring_size=CAPTURE_RING):
+        if os.name == 'nt':
+            super().__init__(LINKTYPE_RAW)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_IP)
+            self.sock.bind((local_ip, 0))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+            self.sock.ioctl(socket.SIO_RCVALL, socket.RCVALL_ON)
+        elif hasattr(socket, 'AF_PACKET'):
+            super().__init__(LINKTYPE_ETHERNET)
+            self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x0003))
+        else:
+            raise OSError("live packet capture is not supported on this platform")
+        self.ring = deque(maxlen=ring_size)
+        self.sock.settimeout(1.0)
+        self.running = True
+        threading.Thread(target=self._capture, name="itmonitor-capture", daemon=True).start()
+
+    def _capture(self):
+        while self.running:
+            try:
+                packet = self.sock.recv(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.packets += 1
+            record = self.record(packet)
+            if record:
+                if len(self.ring) == self.ring.maxlen:
+                    self.dropped += 1
+                self.ring.append(record)
+
+    def drain(self, limit=CAPTURE_MAX_RECORDS):
+        records = []
+        while self.ring and len(records) < limit:
+            records.append(self.ring.popleft())
+        return records
+
+    def close(self):
+        self.running = False
+        try:
+            if os.name == 'nt':
+                self.sock.ioctl(socket.SIO_RCVALL, socket.RCVALL_OFF)
+            self.sock.close()
+        except OSError:
+            pass
+
+def open_capture_source(spec, local_ip=None):
+    """Capture source for the packet_capture setting: 'live' or the path of a pcap file"""
+    if spec == 'live':
+        return LiveCapture(local_ip or '0.0.0.0')
+    return PcapSource(spec)
+
+def system_nameserver():
+    """First nameserver in /etc/resolv.conf, None where there is none (Windows)"""
+    try:
+        with open('/etc/resolv.conf') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1].split('%')[0]
+    except OSError:
+        pass
+    return None
+
+class SystemResolver:
+    """Forward lookups through the OS resolver; it does not report TTLs, so answers get SEED_DEFAULT_TTL"""
+
+    def resolve(self, name):
+        try:
+            infos = socket.getaddrinfo(name, 443, type=socket.SOCK_STREAM)
+        except socket.gaierror:
+            return []
+        return sorted({(info[4][0], SEED_DEFAULT_TTL) for info in infos})
+
+class DnsResolver:
+    """Forward lookups sent as A and AAAA queries straight to a DNS server, keeping the TTLs"""
+
+    def __init__(self, server, timeout=SEED_QUERY_TIMEOUT):
+        self.server = server
+        self.family = socket.AF_INET6 if ':' in server else socket.AF_INET
+        self.timeout = timeout
+
+    def resolve(self, name):
+        question = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.')) + b'\0'
+        answers = []
+        for record_type in (1, 28):
+            query_id = random.getrandbits(16)
+            query = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question + struct.pack('!HH', record_type, 1)
+            with socket.socket(self.family, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect((self.server, 53))
+                sock.send(query)
+                response = sock.recv(4096)
+            if response[:2] != query[:2]:
+                raise OSError(f"mismatched DNS response for {name}")
+            parsed = parse_dns_answers(response)
+            if parsed:
+                answers.extend(parsed[1])
+        return answers
+
+class ServiceSeeder:
+    """Forward-resolves the domains of known services so their addresses are labelled up front
+
+    Every name has a due time; each round resolves up to SEED_BATCH due names on a
+    small thread pool and reschedules them by the answer TTL, clamped between
+    SEED_MIN_REFRESH and SEED_MAX_REFRESH. The resolver is anything with
+    resolve(name) -> [(address, ttl)], so a stub can stand in for the network.
+    """
+
+    def __init__(self, names, resolver, concurrency=SEED_CONCURRENCY):
+        self.resolver = resolver
+        self.concurrency = concurrency
+        self.schedule = {name: 0.0 for name in names}  # name -> monotonic time it is due
+        self.lock = threading.Lock()
+        self.pool = None
+        self.resolved = 0
+        self.failed = 0
+
+    def run_round(self, now, timeout=SEED_ROUND_TIMEOUT):
+        """Resolve the names that are due; returns [(address, name, ttl)]"""
+        with self.lock:
+            names = sorted((due, name) for name, due in self.schedule.items() if due <= now)[:SEED_BATCH]
+            for _, name in names:
+                self.schedule[name] = now + SEED_RETRY  # until an answer says otherwise
+        if not names:
+            return []
+        from concurrent.futures import ThreadPoolExecutor, wait
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix='itmonitor-seed')
+        futures = {self.pool.submit(self.resolver.resolve, name): name for _, name in names}
+        done, _ = wait(futures, timeout)
+        
+        results = []
+        for future in done:
+            name = futures[future]
+            try:
+                answers = future.result()
+            except Exception:
+                self.failed += 1
+                continue
+            self.resolved += 1
+            if not answers:
+                refresh = SEED_NEGATIVE_REFRESH
+            else:
+                refresh = min(max(min(ttl for _, ttl in answers), SEED_MIN_REFRESH), SEED_MAX_REFRESH)
+            with self.lock:
+                self.schedule[name] = now + refresh
+            results.extend((address, name, refresh) for address, _ in answers)
+        return results
+
+    def set_names(self, names):
+        """Replace the names to resolve, keeping the schedule of those that remain"""
+        with self.lock:
+            self.schedule = {name: self.schedule.get(name, 0.0) for name in names}
+    
+    def next_due(self):
+        with self.lock:
+            return min(self.schedule.values(), default=float('inf'))
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def metrics(self):
+        return {
+            'names': len(self.schedule),
+            'resolved': self.resolved,
+            'failed': self.failed
+        }
+
+# Built-in classification rules, used until a bundle has been fetched from the backend
+CDN_DOMAINS = ['amazonaws.com', 'cloudfront.net', 'akamai.net', 'fastly.com',
+               'cloudflare.com', 'maxcdn.com', 'jsdelivr.net', 'unpkg.com',
+               'cdnjs.com', 'googleapis.com', 'gstatic.com', 'googleusercontent.com',
+               'linodeusercontent.com', 'digitaloceanspaces.com', 'azureedge.net']
+SERVICE_INDICATORS = ['api', 'www', 'app', 'service', 'cdn', 'static', 'assets']
+SERVICE_IP_RANGES = {
+    '142.250.0.0/16': 'Google Services', '142.251.0.0/16': 'Google Services',
+    '172.217.0.0/16': 'Google Services', '216.58.0.0/16': 'Google Services', '74.125.0.0/16': 'Google Services',
+    '13.107.0.0/16': 'Microsoft Services', '20.42.0.0/16': 'Microsoft Services', '40.126.0.0/16': 'Microsoft Services',
+    '104.18.0.0/16': 'Cloudflare', '172.64.0.0/16': 'Cloudflare',
+    '52.201.0.0/16': 'Amazon Web Services', '52.202.0.0/16': 'Amazon Web Services',
+    '52.203.0.0/16': 'Amazon Web Services', '52.204.0.0/16': 'Amazon Web Services',
+    '52.205.0.0/16': 'Amazon Web Services', '54.236.0.0/16': 'Amazon Web Services',
+    '54.237.0.0/16': 'Amazon Web Services', '54.238.0.0/16': 'Amazon Web Services',
+    '54.239.0.0/16': 'Amazon Web Services', '54.240.0.0/16': 'Amazon Web Services',
+    '159.41.0.0/16': 'Akamai CDN',
+    '31.13.0.0/16': 'Facebook Services', '66.220.0.0/16': 'Facebook Services'
+}
+
+def compile_ip_ranges(ranges):
+    """{'a.b.c.d/len': label} -> [(len, {network >> (32 - len): label})], longest prefixes first"""
+    tables = defaultdict(dict)
+    for cidr, label in ranges.items():
+        network, length = cidr.split('/')
+        length = int(length)
+        if not 0 < length <= 32:
+            raise ValueError(f"bad prefix length in {cidr}")
+        address = struct.unpack('!I', socket.inet_pton(socket.AF_INET, network))[0]
+        tables[length][address >> (32 - length)] = label
+    return sorted(tables.items(), reverse=True)
+
+class ClassificationRules:
+    """One version of the domain, CDN and address rules, compiled for lookups
+
+    Instances are never modified: a new bundle from the backend is compiled into a
+    new instance and swapped in with a single assignment, so a classification sees
+    either the old rules or the new ones. The compiled form is cached on disk with
+    marshal and loads without recompiling.
+    """
+
+    def __init__(self, domains, cdn_domains, service_indicators, ip_ranges, version='builtin', etag=None,
+                 compiled=False):
+        self.domains = dict(domains)
+        self.cdn_domains = frozenset(cdn_domains)
+        self.service_indicators = frozenset(service_indicators)
+        self.ranges = ip_ranges if compiled else compile_ip_ranges(ip_ranges)
+        self.version = version
+        self.etag = etag
+
+    @classmethod
+    def from_bundle(cls, bundle, etag=None):
+        """Compile a rules bundle as served by GET /network-monitoring/rules"""
+        if not isinstance(bundle.get('domains'), dict) or not isinstance(bundle.get('ipRanges'), dict):
+            raise ValueError("rules bundle needs domains and ipRanges objects")
+        return cls(bundle['domains'], bundle.get('cdnDomains', CDN_DOMAINS),
+                   bundle.get('serviceIndicators', SERVICE_INDICATORS), bundle['ipRanges'],
+                   str(bundle.get('version', 'unknown')), etag)
+
+    @classmethod
+    def load(cls, path=RULES_FILE):
+        """Rules from the on-disk cache, None if it is missing or from another format"""
+        try:
+            with open(path, 'rb') as f:
+                cached = marshal.load(f)
+            if cached[0] != RULES_CACHE_FORMAT:
+                return None
+            _, version, etag, domains, cdn_domains, service_indicators, ranges = cached
+            return cls(domains, cdn_domains, service_indicators, ranges, version, etag, compiled=True)
+        except (OSError, EOFError, ValueError, TypeError, IndexError):
+            return None
+
+    def save(self, path=RULES_FILE):
+        """Write the compiled rules to the cache, replacing it atomically"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            marshal.dump((RULES_CACHE_FORMAT, self.version, self.etag, self.domains, tuple(self.cdn_domains),
+                          tuple(self.service_indicators), self.ranges), f)
+        os.replace(temporary, path)
+
+    def service_for_ip(self, ip):
+        """Label of the longest matching address range, None for no match or IPv6"""
+        try:
+            address = struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+        except OSError:
+            return None
+        for length, table in self.ranges:
+            label = table.get(address >> (32 - length))
+            if label:
+                return label
+        return None
+
+# Datagram heartbeat: header, system id, then a truncated HMAC-SHA256 of both
+HEARTBEAT_MAGIC = b'ITHB'
+HEARTBEAT_ACK_MAGIC = b'ITHA'
+HEARTBEAT_VERSION = 1
+HEARTBEAT_MAC_BYTES = 16
+# magic, version, sequence, timestamp (ms), pending bytes, system id length
+HEARTBEAT_HEADER = struct.Struct('!4sBIQQB')
+HEARTBEAT_ACK = struct.Struct('!4sBI')  # magic, version, sequence being acknowledged
+
+def heartbeat_key(token):
+    """HMAC key for datagram heartbeats, derived from the agent token"""
+    return hashlib.sha256(b'itmonitor-udp-heartbeat:' + token.encode()).digest()
+
+def _heartbeat_mac(key, body):
+    return hmac.new(key, body, hashlib.sha256).digest()[:HEARTBEAT_MAC_BYTES]
+
+def pack_heartbeat(key, system_id, sequence, timestamp, pending_bytes):
+    """Signed heartbeat datagram"""
+    system = system_id.encode()
+    body = HEARTBEAT_HEADER.pack(HEARTBEAT_MAGIC, HEARTBEAT_VERSION, sequence & 0xffffffff,
+                                 int(timestamp * 1000), max(int(pending_bytes), 0), len(system)) + system
+    return body + _heartbeat_mac(key, body)
+
+def unpack_heartbeat(packet, key_for):
+    """(system id, sequence, timestamp, pending bytes, key) of an authentic heartbeat, else None
+
+    key_for(system_id) returns the HMAC key of a known system, or None.
+    """
+    try:
+        magic, version, sequence, timestamp_ms, pending_bytes, length = HEARTBEAT_HEADER.unpack_from(packet)
+        end = HEARTBEAT_HEADER.size + length
+        if magic != HEARTBEAT_MAGIC or version != HEARTBEAT_VERSION or len(packet) != end + HEARTBEAT_MAC_BYTES:
+            return None
+        system_id = packet[HEARTBEAT_HEADER.size:end].decode()
+    except (struct.error, UnicodeDecodeError):
+        return None
+    key = key_for(system_id)
+    if key is None or not hmac.compare_digest(packet[end:], _heartbeat_mac(key, packet[:end])):
+        return None
+    return system_id, sequence, timestamp_ms / 1000, pending_bytes, key
+
+def pack_heartbeat_ack(key, sequence):
+    body = HEARTBEAT_ACK.pack(HEARTBEAT_ACK_MAGIC, HEARTBEAT_VERSION, sequence)
+    return body + _heartbeat_mac(key, body)
+
+def is_heartbeat_ack(packet, key, sequence):
+    """True if packet is the collector's signed acknowledgement of sequence"""
+    body = packet[:HEARTBEAT_ACK.size]
+    return (len(packet) == HEARTBEAT_ACK.size + HEARTBEAT_MAC_BYTES
+            and body == HEARTBEAT_ACK.pack(HEARTBEAT_ACK_MAGIC, HEARTBEAT_VERSION, sequence)
+            and hmac.compare_digest(packet[HEARTBEAT_ACK.size:], _heartbeat_mac(key, body)))
+
+STATUS_MAGIC = b'ITMS'
+STATUS_LAYOUT_VERSION = 1
+STATUS_STATES = ['starting', 'running', 'stopped']
+# magic, layout version, reserved, sequence (odd while a write is in progress)
+STATUS_HEADER = struct.Struct('<4sHHI')
+# version, pid, state, degradation level, on battery, updated at, last tick, last successful
+# upload (wall clock, 0 = never), pending bytes, failed uploads, pending labels, sample interval,
+# then STATUS_TOP_LABELS x (label, pending bytes)
+STATUS_BODY = struct.Struct('<16sIBBBxdddQIIf' + f'{STATUS_LABEL_BYTES}sQ' * STATUS_TOP_LABELS)
+STATUS_SIZE = STATUS_HEADER.size + STATUS_BODY.size
+
+class StatusSegment:
+    """Fixed-layout live status record in a memory-mapped file, rewritten once per tick
+
+    Readers (the status command, the service wrapper) map the same file read-only.
+    The header's sequence number works as a seqlock: it is odd while the body is
+    being written, so a reader retries instead of returning a torn record.
+    """
+
+    def __init__(self, path=STATUS_FILE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a+b')
+        if os.path.getsize(path) != STATUS_SIZE:
+            self.file.truncate(STATUS_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), STATUS_SIZE)
+        self.sequence = 0
+        STATUS_HEADER.pack_into(self.map, 0, STATUS_MAGIC, STATUS_LAYOUT_VERSION, 0, self.sequence)
+
+    def write(self, state, level, on_battery, last_tick, last_upload, pending_bytes, failed_uploads,
+              labels, interval, top_labels):
+        """Publish one record; top_labels is a list of (label, pending bytes)"""
+        top = []
+        for label, size in (list(top_labels) + [('', 0)] * STATUS_TOP_LABELS)[:STATUS_TOP_LABELS]:
+            top.extend((label.encode('utf-8')[:STATUS_LABEL_BYTES], int(size)))
+        self.sequence += 1
+        STATUS_HEADER.pack_into(self.map, 0, STATUS_MAGIC, STATUS_LAYOUT_VERSION, 0, self.sequence)
+        STATUS_BODY.pack_into(self.map, STATUS_HEADER.size, AGENT_VERSION.encode('utf-8'), os.getpid(),
+                              STATUS_STATES.index(state), level, bool(on_battery), time.time(), last_tick,
+                              last_upload or 0.0, int(pending_bytes), failed_uploads, labels, interval, *top)
+        self.sequence += 1
+        STATUS_HEADER.pack_into(self.map, 0, STATUS_MAGIC, STATUS_LAYOUT_VERSION, 0, self.sequence)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def read_status(path=STATUS_FILE, attempts=100):
+    """Latest record published by a running agent as a dict, None if there is none"""
+    try:
+        with open(path, 'rb') as f:
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if len(view) < STATUS_SIZE:
+            return None
+        for _ in range(attempts):
+            magic, layout, _, sequence = STATUS_HEADER.unpack_from(view, 0)
+            if magic != STATUS_MAGIC or layout != STATUS_LAYOUT_VERSION:
+                return None
+            if sequence % 2:
+                continue
+            body = STATUS_BODY.unpack_from(view, STATUS_HEADER.size)
+            if STATUS_HEADER.unpack_from(view, 0)[3] == sequence:
+                break
+        else:
+            return None
+    finally:
+        view.close()
+    
+    (version, pid, state, level, on_battery, updated_at, last_tick, last_upload,
+     pending_bytes, failed_uploads, labels, interval), top = body[:12], body[12:]
+    if sequence == 0:
+        return None
+    return {
+        'version': version.rstrip(b'\0').decode('utf-8', 'replace'),
+        'pid': pid,
+        'state': STATUS_STATES[state] if state < len(STATUS_STATES) else 'unknown',
+        'degradationLevel': level,
+        'degradation': DEGRADATION_LEVELS[level] if level < len(DEGRADATION_LEVELS) else 'unknown',
+        'onBattery': bool(on_battery),
+        'updatedAt': updated_at,
+        'lastTick': last_tick,
+        'lastUpload': last_upload or None,
+        'pendingBytes': pending_bytes,
+        'failedUploads': failed_uploads,
+        'pendingLabels': labels,
+        'sampleInterval': round(interval, 2),
+        'topLabels': [(top[i].rstrip(b'\0').decode('utf-8', 'replace'), top[i + 1])
+                      for i in range(0, len(top), 2) if top[i].strip(b'\0')]
+    }
+
+def status_lines(record, now=None):
+    """Human readable lines for a read_status() record"""
+    if record is None:
+        return ["Agent State: no live status (agent has not run on this account)"]
+    now = time.time() if now is None else now
+    
+    def ago(timestamp):
+        if not timestamp:
+            return "never"
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        return f"{stamp} ({max(now - timestamp, 0):.0f}s ago)"
+    
+    state = record['state']
+    if state != 'stopped' and now - record['updatedAt'] > STATUS_STALE_SECONDS:
+        state = 'not responding (status not updated recently)'
+    lines = [
+        f"Agent State: {state} (pid {record['pid']}, v{record['version']}{', on battery' if record['onBattery'] else ''})",
+        f"Last Tick: {ago(record['lastTick'])}",
+        f"Last Upload: {ago(record['lastUpload'])}",
+        f"Pending: {record['pendingBytes'] / (1024 * 1024):.2f} MB in {record['pendingLabels']} labels "
+        f"({record['failedUploads']} failed upload attempts)",
+        f"Degradation: {record['degradation']}, sampling every {record['sampleInterval']:g}s"
+    ]
+    if record['topLabels']:
+        lines.append("Top Labels: " + ", ".join(f"{label} {size / (1024 * 1024):.2f} MB"
+                                                for label, size in record['topLabels']))
+    return lines
+
+def new_label_stats():
+    """Empty per-label accumulator used by network_stats"""
+    return {
+        'upload': 0, 'download': 0, 'count': 0,
+        'rate': RateSketch(),
+        'remote_ips': HyperLogLog(),
+        'remote_ports': HyperLogLog()
+    }
+
+def new_system_id():
+    """Fresh random system ID"""
+    import uuid
+    return f"sys-{uuid.uuid4().hex[:12]}"
+
+def read_config():
+    """Saved configuration as a dict ({} if missing or unreadable), without creating an agent"""
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def register_agent(token):
+    """Store the agent token in the configuration file without constructing an agent
+
+    Keeps every other saved setting; a new system ID is created on first registration.
+    """
+    config = read_config()
+    if not config.get('system_id'):
+        config['system_id'] = new_system_id()
+        config['system_name'] = socket.gethostname()
+    config.setdefault('backend_url', BACKEND_URL)
+    config['agent_token'] = token
+    config['agent_version'] = AGENT_VERSION
+    os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
+    with open(CONFIG_FILE, 'w') as f:
+        json.dump(config, f, indent=2)
+    return config
+
+# magic, format version, sha256 of the source file, sha256 of the result, result size;
+# followed by zlib-compressed copy ('C', offset, length) and insert ('I', length, bytes) ops
+DELTA_MAGIC = b'ITDL'
+DELTA_VERSION = 1
+DELTA_HEADER = struct.Struct('!4sB32s32sI')
+DELTA_COPY = struct.Struct('!cII')
+DELTA_INSERT = struct.Struct('!cI')
+
+def make_delta(old, new):
+    """Binary delta that rebuilds new from old
+
+    Unchanged runs are matched line by line, which suits the agent's text files
+    and still works (less compactly) for arbitrary bytes.
+    """
+    import difflib
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    old_offsets = list(itertools.accumulate(map(len, old_lines), initial=0))
+    new_offsets = list(itertools.accumulate(map(len, new_lines), initial=0))
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(DELTA_COPY.pack(b'C', old_offsets[i1], old_offsets[i2] - old_offsets[i1]))
+        elif j2 > j1:
+            data = new[new_offsets[j1]:new_offsets[j2]]
+            ops.append(DELTA_INSERT.pack(b'I', len(data)) + data)
+    header = DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, hashlib.sha256(old).digest(),
+                               hashlib.sha256(new).digest(), len(new))
+    return header + zlib.compress(b''.join(ops), 9)
+
+def apply_delta(old, delta):
+    """Rebuild a file from its previous contents and a make_delta delta; ValueError on any mismatch"""
+    if len(delta) < DELTA_HEADER.size:
+        raise ValueError("truncated delta")
+    magic, version, source, target, size = DELTA_HEADER.unpack_from(delta)
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+        raise ValueError("not an agent delta")
+    if hashlib.sha256(old).digest() != source:
+        raise ValueError("delta was built against a different file")
+    try:
+        ops = zlib.decompress(delta[DELTA_HEADER.size:])
+    except zlib.error as e:
+        raise ValueError(f"corrupt delta: {e}")
+    result = bytearray()
+    pos = 0
+    try:
+        while pos < len(ops):
+            if ops[pos:pos + 1] == b'C':
+                _, offset, length = DELTA_COPY.unpack_from(ops, pos)
+                pos += DELTA_COPY.size
+                if offset + length > len(old):
+                    raise ValueError("copy outside the source file")
+                result += old[offset:offset + length]
+            else:
+                _, length = DELTA_INSERT.unpack_from(ops, pos)
+                pos += DELTA_INSERT.size
+                result += ops[pos:pos + length]
+                pos += length
+    except struct.error as e:
+        raise ValueError(f"corrupt delta: {e}")
+    if len(result) != size or hashlib.sha256(result).digest() != target:
+        raise ValueError("patched file does not match the expected hash")
+    return bytes(result)
+
+def parse_version(version):
+    """'1.10.2' -> (1, 10, 2) for ordering; non-numeric parts count as 0"""
+    return tuple(int(part) if part.isdigit() else 0 for part in str(version).split('.'))
+
+def ed25519_verify(public, message, signature):
+    """True if signature is a valid Ed25519 signature of message by public
+
+    Needs the cryptography package (requirements.txt); raises ImportError without it.
+    """
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    try:
+        Ed25519PublicKey.from_public_bytes(public).verify(signature, message)
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+def manifest_signing_payload(manifest):
+    """Bytes an update manifest's signature covers: its version and files, canonically encoded.
+
+    rolloutPercent is left out so the backend can widen a rollout without the
+    signing key; it can only change who takes a release that was signed.
+    """
+    return json.dumps({'version': manifest.get('version'), 'files': manifest.get('files')},
+                      sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def rollout_bucket(system_id, version):
+    """Stable 0-99 bucket of a machine for one release; salted with the version so the
+    same machines are not always the first to update"""
+    digest = hashlib.sha256(f"{system_id}:{version}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % 100
+
+class SelfUpdater:
+    """Differential self-update of the agent's installed files
+
+    The update manifest names a version, a rollout percentage and, per file,
+    its sha256, size, full download and deltas keyed by the sha256 of the
+    installed file they apply to. A machine takes a release once its
+    rollout_bucket falls under the percentage. Every changed file is rebuilt
+    in a staging directory (from a matching delta, else the full download),
+    checked against its hash and, for Python sources, compiled; only then are
+    the installed copies backed up and replaced with os.replace. The backups
+    are kept until the new version confirms itself with a successful upload;
+    an update that does not confirm within UPDATE_CONFIRM_SECONDS, keeps
+    failing to start, or was interrupted mid-swap is rolled back and its
+    version is not taken again.
+
+    Staging and installing hold the process-wide lock, so the replacement of
+    an updater worker the watchdog gave up on cannot clear the staging
+    directory under it; the abandoned worker stops at its next file once its
+    lease is invalid.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, install_dir=None, state_file=UPDATE_STATE_FILE):
+        self.install_dir = install_dir or os.path.dirname(os.path.abspath(__file__))
+        self.public_key = None  # shipped by the installer; without it every manifest is rejected
+        try:
+            with open(os.path.join(self.install_dir, UPDATE_PUBLIC_KEY_FILE)) as f:
+                self.public_key = bytes.fromhex(f.read().strip())
+        except (OSError, ValueError):
+            pass
+        self.staging_dir = os.path.join(self.install_dir, '.update-staging')
+        self.backup_dir = os.path.join(self.install_dir, '.update-backup')
+        self.state_file = state_file
+        self.state = {}
+        self.stats = defaultdict(int)  # files patched / downloaded in full, bytes fetched and saved
+        try:
+            with open(state_file) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def save_state(self):
+        temp = self.state_file + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp, self.state_file)
+
+    @property
+    def pending(self):
+        """An installed update that has not confirmed yet"""
+        return self.state.get('status') == 'pending'
+
+    def verify(self, manifest):
+        """True if the manifest carries a valid signature by the installed public key"""
+        try:
+            signature = bytes.fromhex(manifest.get('signature', ''))
+        except (TypeError, ValueError):
+            return False
+        return bool(self.public_key) and ed25519_verify(self.public_key, manifest_signing_payload(manifest),
+                                                        signature)
+
+    def wanted(self, manifest, system_id):
+        """True if this machine should install the manifest's release now"""
+        version = str(manifest.get('version', ''))
+        if not version or parse_version(version) <= parse_version(AGENT_VERSION):
+            return False
+        if version in self.state.get('rejected', []) or self.pending:
+            return False
+        return rollout_bucket(system_id, version) < float(manifest.get('rolloutPercent', 100))
+
+    def on_start(self):
+        """Count a start of an unconfirmed update; True if it was rolled back (restart needed)"""
+        status = self.state.get('status')
+        if status == 'swapping':
+            self.rollback("interrupted while installing")
+            return True
+        if status != 'pending':
+            return False
+        if self.state.get('version') != AGENT_VERSION:
+            # Running something else than the update installed (replaced by hand)
+            self.state['status'] = 'superseded'
+            self.save_state()
+            return False
+        self.state['starts'] = self.state.get('starts', 0) + 1
+        if self.state['starts'] > UPDATE_MAX_UNCONFIRMED_STARTS:
+            self.rollback(f"not confirmed after {self.state['starts'] - 1} starts")
+            return True
+        self.save_state()
+        return False
+
+    def confirm_deadline(self):
+        return self.state.get('installedAt', 0) + UPDATE_CONFIRM_SECONDS
+
+    def confirm(self):
+        """The updated agent works: drop the backups; True if there was something to confirm"""
+        if not self.pending or self.state.get('version') != AGENT_VERSION:
+            return False
+        self.state['status'] = 'confirmed'
+        self.state['confirmedAt'] = time.time()
+        self.save_state()
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+        return True
+
+    def stage(self, manifest, fetch, lease=None):
+        """Build every changed file of the release in the staging directory
+
+        fetch(url) returns a file's bytes. Returns the staged file names (empty
+        when the installed files already match); raises if a file cannot be
+        built or verified, or once lease (the worker's) is no longer valid.
+        Call with lock held.
+        """
+        if not self.verify(manifest):
+            raise ValueError("update manifest is not signed with the installed key")
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        os.makedirs(self.staging_dir)
+        staged = []
+        for name, entry in manifest.get('files', {}).items():
+            if os.path.basename(name) != name or name.startswith('.'):
+                raise ValueError(f"unsafe file name in manifest: {name}")
+            if lease is not None and not lease.valid:
+                raise RuntimeError("update worker was replaced")
+            try:
+                with open(os.path.join(self.install_dir, name), 'rb') as f:
+                    current = f.read()
+            except FileNotFoundError:
+                current = b''
+            current_hash = hashlib.sha256(current).hexdigest()
+            if current_hash == entry['sha256']:
+                continue
+            
+            data = None
+            delta = entry.get('deltas', {}).get(current_hash)
+            if delta:
+                try:
+                    patch = fetch(delta['url'])
+                    self.stats['bytesFetched'] += len(patch)
+                    data = apply_delta(current, patch)
+                    if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                        raise ValueError(f"patched {name} does not match the manifest hash")
+                    self.stats['filesPatched'] += 1
+                    self.stats['bytesSaved'] += max(0, int(entry.get('size', len(data))) - len(patch))
+                except Exception:
+                    data = None  # fall back to the full file
+            if data is None:
+                data = fetch(entry['url'])
+                self.stats['bytesFetched'] += len(data)
+                self.stats['filesDownloaded'] += 1
+                if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                    raise ValueError(f"{name} does not match the manifest hash")
+            if name.endswith('.py'):
+                compile(data, name, 'exec')
+            with open(os.path.join(self.staging_dir, name), 'wb') as f:
+                f.write(data)
+            staged.append(name)
+        return staged
+
+    def install(self, version, names, lease=None):
+        """Back up and replace the staged files; everything is restored if any step fails
+
+        Call with lock held; nothing is touched once lease is no longer valid.
+        """
+        if lease is not None and not lease.valid:
+            raise RuntimeError("update worker was replaced")
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+        os.makedirs(self.backup_dir)
+        rejected = self.state.get('rejected', [])
+        self.state = {'status': 'swapping', 'version': version, 'previous': AGENT_VERSION,
+                      'files': names, 'created': [], 'installedAt': time.time(), 'starts': 0,
+                      'rejected': rejected}
+        for name in names:
+            target = os.path.join(self.install_dir, name)
+            if os.path.exists(target):
+                shutil.copy2(target, os.path.join(self.backup_dir, name))
+            else:
+                self.state['created'].append(name)
+        self.save_state()
+        try:
+            for name in names:
+                os.replace(os.path.join(self.staging_dir, name), os.path.join(self.install_dir, name))
+        except Exception as e:
+            self.rollback(f"install failed: {e}")
+            raise
+        self.state['status'] = 'pending'
+        self.save_state()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def rollback(self, reason):
+        """Put the backed-up files back and never take this version again"""
+        for name in self.state.get('files', []):
+            target = os.path.join(self.install_dir, name)
+            backup = os.path.join(self.backup_dir, name)
+            try:
+                if os.path.exists(backup):
+                    os.replace(backup, target)
+                elif name in self.state.get('created', []) and os.path.exists(target):
+                    os.remove(target)
+            except OSError:
+                pass
+        version = self.state.get('version')
+        rejected = self.state.setdefault('rejected', [])
+        if version and version not in rejected:
+            rejected.append(version)
+        self.state.update(status='rolled-back', reason=reason, rolledBackAt=time.time())
+        self.save_state()
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+
+    def metrics(self):
+        return dict(self.stats, status=self.state.get('status'), version=self.state.get('version'))
+
+RESTART_WAIT_SECONDS = 120  # how long the relaunch helper waits for the old process to exit
+
+def python_executable():
+    """python.exe, also when running inside the pythonservice.exe service host"""
+    if os.path.basename(sys.executable).lower() == 'pythonservice.exe':
+        candidate = os.path.join(sys.exec_prefix, 'python.exe')
+        if os.path.exists(candidate):
+            return candidate
+    return sys.executable
+
+def restart_process(command=None):
+    """Run command in a fresh process once this one has exited
+
+    The one restart path after an update or rollback, for the console agent
+    (command defaults to this script with the same arguments) and the service
+    wrapper (which passes its own 'start'). A detached 'relaunch' helper waits
+    for this process to exit first, so nothing of it - loaded modules, abandoned
+    worker threads, open files in the install directory - carries over. Returns
+    at once; the caller exits.
+    """
+    import subprocess
+    command = command or [python_executable(), os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    flags = getattr(subprocess, 'DETACHED_PROCESS', 0) | getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0)
+    subprocess.Popen([python_executable(), os.path.abspath(__file__), 'relaunch', str(os.getpid())] + command,
+                     creationflags=flags, close_fds=True, start_new_session=os.name != 'nt')
+
+def wait_for_exit(pid, timeout=RESTART_WAIT_SECONDS):
+    """Block until process pid has exited, or for timeout seconds"""
+    import psutil
+    try:
+        psutil.Process(pid).wait(timeout)
+    except (psutil.NoSuchProcess, psutil.TimeoutExpired):
+        pass
+
+def pushed_config_value(key, value):
+    """A config command's value for key, converted to the setting's type; ValueError if not allowed"""
+    rule = PUSHED_CONFIG_KEYS[key]
+    if value is None and key in PUSHED_CONFIG_OPTIONAL:
+        return None
+    if isinstance(rule, list):
+        if str(value).upper() not in rule:
+            raise ValueError(f"{key} must be one of {', '.join(rule)}, not {value!r}")
+        return str(value).upper()
+    if rule in (bool, str):
+        if not isinstance(value, rule) or (rule is str and not 0 < len(value) <= 255):
+            raise ValueError(f"{key} must be {'true or false' if rule is bool else 'a string'}, not {value!r}")
+        if key == 'relay_url' and not value.startswith('https://'):
+            raise ValueError(f"relay_url must be an https URL, not {value!r}")
+        if key == 'udp_heartbeat' and not value.rpartition(':')[2].isdigit():
+            raise ValueError(f"udp_heartbeat must be host:port, not {value!r}")
+        return value
+    kind, low, high = rule
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        number = kind(value)
+        if number != float(value) or not low <= number <= high:
+            raise ValueError
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{key} must be a number from {low} to {high}, not {value!r}")
+    return number
 
 class NetworkMonitorAgent:
     def __init__(self):
@@ -40,11 +2092,66 @@ class NetworkMonitorAgent:
         self.agent_token = None
         self.backend_url = BACKEND_URL
         self.is_running = True
-        self.network_stats = defaultdict(lambda: {'upload': 0, 'download': 0, 'count': 0})
+        self.network_stats = defaultdict(new_label_stats)
         self.last_net_io = None
-        self.session = requests.Session()
+        self.last_sample_time = None
+        self.last_connection_keys = set()
+        self.last_activity = (0.0, 0)  # (bytes/sec, connection churn) of the last tick
+        self.cadence = AdaptiveCadence()
+        self.power = PowerPolicy()
+        self.last_heartbeat_time = 0
+        self.last_send_time = None
+        self.stop_event = threading.Event()
+        self.upload_requested = threading.Event()
+        self.stats_lock = threading.Lock()  # network_stats between the sampler and the uploader
+        self.watchdog = Watchdog()
+        self.resolving_ip = None  # address inside gethostbyaddr, for the watchdog
+        self.domain_cache = {}  # ip -> (label, expires at monotonic time)
+        self.cached_connections = []
+        self.ticks_since_scan = 0
+        self.cpu_budget_percent = CPU_BUDGET_PERCENT
+        self.rss_budget_mb = RSS_BUDGET_MB
+        self.update_interval = UPDATE_INTERVAL
+        self.command_poll_seconds = COMMAND_POLL_SECONDS
+        self.udp_heartbeat = None  # "host:port" of a datagram heartbeat collector; HTTPS only if unset
+        self.relay_url = None  # branch-office relay (https://host:5002/api); the backend is the fallback
+        self.relay_ca_file = None  # config: certificate(s) the relay's is checked against; system store if unset
+        self.auto_update = True  # config: auto_update; the updater worker installs rolled-out releases
+        self.updater = SelfUpdater()
+        self.update_requested = threading.Event()  # set by an 'update' command to check right away
+        self.update_etag = None
+        self.restart_requested = False  # set after an update or rollback; main() relaunches the agent (restart_process)
+        self.heartbeat_sequence = 0
+        self.profiler = PipelineProfiler()
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        # (method, endpoint, base URL) -> request counts and latency (long-polls are not timed)
+        self.endpoint_stats = defaultdict(lambda: {'requests': 0, 'failures': 0, 'latency': LatencyHistogram()})
+        self.failed_uploads = 0  # upload attempts since the last successful one
+        self.last_upload_time = None  # wall clock of the last successful upload
+        self.last_tick_time = None
+        self.status_segment = None
+        self.metrics_port = None
+        self.exporter = None
+        self.packet_capture = None  # None, 'live', or the path of a pcap file to learn from
+        self.capture_source = None
+        self.passive_dns = PassiveDnsTable()
+        self.flow_names = {}  # (local, remote) address:port -> (label, expires) from SNI / Host
+        self.flow_names_learned = 0
+        self.service_seeding = True
+        self.dns_server = None  # DNS server queried by the seeder; the OS resolver (no TTLs) if unset
+        self.seed_resolver = None  # anything with resolve(name) -> [(address, ttl)]; chosen in run() if None
+        self.seeder = None
+        self.seed_results = queue.Queue()  # seeder rounds waiting to be applied by the sampler
+        self.collector = SystemCollector()
+        self.clock = time  # anything with monotonic() and time(); replaced in soak/replay runs
+        self.memory_profiling = False
+        self.memory_profiler = None
+        self.log_level = LOG_LEVEL
+        self.logger = setup_logging(self.log_level)
+        self.session = None  # requests.Session, created on the first upload
         
-        # Domain mapping for better service identification
+        # Built-in domain mapping; a rules bundle from the backend supersedes it
         self.domain_mapping = {
             # Social Media
             'facebook.com': 'Facebook',
@@ -124,6 +2231,11 @@ class NetworkMonitorAgent:
             'hubspot.com': 'HubSpot',
             'mailchimp.com': 'Mailchimp'
         }
+        self.rules = ClassificationRules.load() or ClassificationRules(
+            self.domain_mapping, CDN_DOMAINS, SERVICE_INDICATORS, SERVICE_IP_RANGES)
+        self.pending_rules = None  # fetched by the rules worker, swapped in by the sampler
+        self.rules_requested = threading.Event()  # set by a 'rules' command to fetch right away
+        self.push_connected = False  # command channel up: it is the liveness signal, no heartbeats
         
         # Ensure config directory exists
         os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
@@ -131,18 +2243,18 @@ class NetworkMonitorAgent:
         
         # Load or create configuration
         self.load_config()
+        self.logger = setup_logging(self.log_level)
         
-    def log(self, message):
-        """Log message to file and console"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_message = f"[{timestamp}] {message}"
-        print(log_message)
+        # Resource governor enforces the budgets from the configuration
+        self.governor = ResourceGovernor(self.cpu_budget_percent, self.rss_budget_mb)
         
-        try:
-            with open(LOG_FILE, 'a', encoding='utf-8') as f:
-                f.write(log_message + "\n")
-        except Exception as e:
-            print(f"Failed to write to log file: {e}")
+    def log(self, message, level=logging.INFO):
+        """Queue a log message for the background log writer"""
+        self.logger.log(level, message)
+    
+    def stage(self, name):
+        """Context manager that times the enclosed pipeline stage"""
+        return _StageTimer(self.governor, self.profiler, self.watchdog, name)
     
     def load_config(self):
         """Load configuration from file or create new"""
@@ -154,9 +2266,28 @@ class NetworkMonitorAgent:
                     self.system_name = config.get('system_name')
                     self.agent_token = config.get('agent_token')
                     self.backend_url = config.get('backend_url', BACKEND_URL)
+                    self.cpu_budget_percent = config.get('cpu_budget_percent', CPU_BUDGET_PERCENT)
+                    self.rss_budget_mb = config.get('rss_budget_mb', RSS_BUDGET_MB)
+                    self.update_interval = config.get('update_interval', UPDATE_INTERVAL)
+                    self.command_poll_seconds = config.get('command_poll_seconds', COMMAND_POLL_SECONDS)
+                    self.udp_heartbeat = config.get('udp_heartbeat')
+                    self.relay_url = config.get('relay_url')
+                    self.relay_ca_file = config.get('relay_ca_file')
+                    if self.relay_url and not str(self.relay_url).startswith('https://'):
+                        # The agent's bearer token must not cross the LAN in the clear
+                        self.log(f"Ignoring relay_url {self.relay_url}: the relay must be reached over https",
+                                 logging.WARNING)
+                        self.relay_url = None
+                    self.auto_update = config.get('auto_update', True)
+                    self.metrics_port = config.get('metrics_port')
+                    self.packet_capture = config.get('packet_capture')
+                    self.service_seeding = config.get('service_seeding', True)
+                    self.dns_server = config.get('dns_server')
+                    self.memory_profiling = config.get('memory_profiling', False)
+                    self.log_level = config.get('log_level', LOG_LEVEL)
                     self.log(f"Configuration loaded for system: {self.system_name}")
             except Exception as e:
-                self.log(f"Error loading config: {e}")
+                self.log(f"Error loading config: {e}", logging.ERROR)
                 self.create_new_config()
         else:
             self.create_new_config()
@@ -164,7 +2295,7 @@ class NetworkMonitorAgent:
     def create_new_config(self):
         """Create new system configuration"""
         self.system_name = socket.gethostname()
-        self.system_id = f"sys-{uuid.uuid4().hex[:12]}"
+        self.system_id = new_system_id()
         self.log(f"Created new system ID: {self.system_id}")
     
     def save_config(self):
@@ -174,19 +2305,35 @@ class NetworkMonitorAgent:
             'system_name': self.system_name,
             'agent_token': self.agent_token,
             'backend_url': self.backend_url,
+            'cpu_budget_percent': self.cpu_budget_percent,
+            'rss_budget_mb': self.rss_budget_mb,
+            'update_interval': self.update_interval,
+            'command_poll_seconds': self.command_poll_seconds,
+            'udp_heartbeat': self.udp_heartbeat,
+            'relay_url': self.relay_url,
+            'relay_ca_file': self.relay_ca_file,
+            'auto_update': self.auto_update,
+            'metrics_port': self.metrics_port,
+            'packet_capture': self.packet_capture,
+            'service_seeding': self.service_seeding,
+            'dns_server': self.dns_server,
+            'memory_profiling': self.memory_profiling,
+            'log_level': self.log_level,
             'agent_version': AGENT_VERSION
         }
         
         try:
             with open(CONFIG_FILE, 'w') as f:
                 json.dump(config, f, indent=2)
-            self.log("Configuration saved successfully")
+            self.log("Configuration saved successfully", logging.DEBUG)
         except Exception as e:
-            self.log(f"Error saving config: {e}")
+            self.log(f"Error saving config: {e}", logging.ERROR)
     
     def get_system_info(self):
         """Get system information"""
         try:
+            import psutil
+            import platform
             cpu_info = platform.processor()
             ram_info = f"{psutil.virtual_memory().total / (1024**3):.1f} GB"
             
@@ -199,7 +2346,7 @@ class NetworkMonitorAgent:
                 'macAddress': self.get_mac_address()
             }
         except Exception as e:
-            self.log(f"Error getting system info: {e}")
+            self.log(f"Error getting system info: {e}", logging.ERROR)
             return {}
     
     def get_local_ip(self):
@@ -216,6 +2363,7 @@ class NetworkMonitorAgent:
     def get_mac_address(self):
         """Get MAC address"""
         try:
+            import uuid
             mac = ':'.join(['{:02x}'.format((uuid.getnode() >> elements) & 0xff)
                            for elements in range(0, 2*6, 2)][::-1])
             return mac
@@ -242,7 +2390,7 @@ class NetworkMonitorAgent:
         connections = []
         
         try:
-            for conn in psutil.net_connections(kind='inet'):
+            for conn in self.collector.net_connections():
                 if conn.status == 'ESTABLISHED' and conn.raddr:
                     connections.append({
                         'local': f"{conn.laddr.ip}:{conn.laddr.port}",
@@ -250,17 +2398,101 @@ class NetworkMonitorAgent:
                         'pid': conn.pid
                     })
         except Exception as e:
-            self.log(f"Error getting connections: {e}")
+            self.log(f"Error getting connections: {e}", logging.ERROR)
         
         return connections
     
-    def resolve_ip_to_domain(self, ip):
+    def resolve_ip_to_domain(self, ip, allow_lookup=True):
+        """Resolve IP address to a label, reusing cached resolutions"""
+        now = self.clock.monotonic()
+        cached = self.domain_cache.get(ip)
+        if cached and cached[1] > now:
+            self.dns_cache_hits += 1
+            return cached[0]
+        self.dns_cache_misses += 1
+        
+        if not allow_lookup:
+            # Enrichment shed by the resource governor: cheap label, not cached
+            if self.is_private_ip(ip):
+                return ip
+            learned = self.passive_dns.lookup(ip, now)
+            if learned:
+                return self.classify_domain(ip, learned)
+            return self.get_service_name_by_ip(ip) or f"service-{ip.split('.')[-1]}"
+        
+        domain = self.lookup_domain(ip)
+        self.cache_label(ip, domain, now + DNS_CACHE_TTL, now)
+        return domain
+    
+    def cache_label(self, ip, label, expires, now):
+        """Store a resolved label, pruning a full cache"""
+        if len(self.domain_cache) >= DNS_CACHE_MAX_ENTRIES:
+            # Drop expired entries, then the oldest ones down to the low-water mark so
+            # the rebuild is amortized over many inserts instead of repeated per miss
+            self.domain_cache = {key: value for key, value in self.domain_cache.items() if value[1] > now}
+            excess = len(self.domain_cache) - int(DNS_CACHE_MAX_ENTRIES * DNS_CACHE_LOW_WATER)
+            for key in list(itertools.islice(self.domain_cache, max(excess, 0))):
+                del self.domain_cache[key]
+        self.domain_cache[ip] = (label, expires)
+    
+    def seed_names(self):
+        """Domains the seeder forward-resolves: every mapped domain under SEED_SUBDOMAINS"""
+        return [f"{sub}.{domain}" if sub else domain for domain in self.rules.domains for sub in SEED_SUBDOMAINS]
+    
+    def apply_seeds(self):
+        """Cache the labels of addresses the seeder resolved since the last tick"""
+        now = self.clock.monotonic()
+        while True:
+            try:
+                results = self.seed_results.get_nowait()
+            except queue.Empty:
+                break
+            for ip, name, refresh in results:
+                # Valid until a little after the seeder's next refresh of the name
+                self.cache_label(ip, self.classify_domain(ip, name), now + refresh + SEED_POLL_MAX, now)
+    
+    def learn_from_capture(self):
+        """Learn from captured DNS answers and flow openings since the last tick"""
+        now = self.clock.monotonic()
+        for record in self.capture_source.drain():
+            if record[0] == 'dns':
+                answer = parse_dns_answers(record[1])
+                if not answer:
+                    continue
+                name, addresses = answer
+                for ip, ttl in addresses:
+                    if self.passive_dns.learn(ip, name, ttl, now):
+                        self.domain_cache.pop(ip, None)  # the cached label predates the answer
+            else:
+                name = parse_server_name(record[3])
+                if name:
+                    self.learn_flow_name(record[1], record[2], name, now)
+    
+    def learn_flow_name(self, local, remote, name, now):
+        """Label one connection by the server name its client sent (SNI or Host)"""
+        if len(self.flow_names) >= FLOW_NAME_MAX_ENTRIES:
+            self.flow_names = {key: value for key, value in self.flow_names.items() if value[1] > now}
+            excess = len(self.flow_names) - int(FLOW_NAME_MAX_ENTRIES * DNS_CACHE_LOW_WATER)
+            for key in list(itertools.islice(self.flow_names, max(excess, 0))):
+                del self.flow_names[key]
+        with self.stage('classification'):
+            label = self.classify_domain(remote.rsplit(':', 1)[0], name)
+        self.flow_names[(local, remote)] = (label, now + FLOW_NAME_TTL)
+        self.flow_names_learned += 1
+    
+    def lookup_domain(self, ip):
         """Resolve IP address to domain name with improved logic and fallback"""
         try:
             # Skip private IP addresses
             if self.is_private_ip(ip):
                 return ip
             
+            # The name this machine actually asked for beats both the IP ranges and PTR
+            learned = self.passive_dns.lookup(ip, self.clock.monotonic())
+            if learned:
+                with self.stage('classification'):
+                    return self.classify_domain(ip, learned)
+            
             # Check if we have a known service mapping for this IP
             service_name = self.get_service_name_by_ip(ip)
             if service_name:
@@ -268,14 +2500,27 @@ class NetworkMonitorAgent:
             
             # Try reverse DNS lookup with timeout
             try:
-                domain = socket.gethostbyaddr(ip)[0]
+                self.resolving_ip = ip
+                with self.stage('resolution'):
+                    domain = self.collector.gethostbyaddr(ip)[0]
             except (socket.herror, socket.gaierror, OSError):
                 # DNS resolution failed, use IP with generic service name
                 return f"service-{ip.split('.')[-1]}"
             except Exception:
                 # Any other DNS error, use IP with generic service name
                 return f"service-{ip.split('.')[-1]}"
+            finally:
+                self.resolving_ip = None
             
+            with self.stage('classification'):
+                return self.classify_domain(ip, domain)
+        except Exception as e:
+            # Final fallback - use IP with generic service name
+            return f"service-{ip.split('.')[-1]}"
+    
+    def classify_domain(self, ip, domain):
+        """Turn a host name seen for ip into a service label"""
+        try:
             # Clean up domain name
             domain = domain.lower().strip()
             
@@ -290,25 +2535,18 @@ class NetworkMonitorAgent:
                 main_domain = '.'.join(parts[-2:])
                 
                 # Skip CDN and cloud provider domains that don't represent the actual service
-                cdn_domains = [
-                    'amazonaws.com', 'cloudfront.net', 'akamai.net', 'fastly.com',
-                    'cloudflare.com', 'maxcdn.com', 'jsdelivr.net', 'unpkg.com',
-                    'cdnjs.com', 'googleapis.com', 'gstatic.com', 'googleusercontent.com',
-                    'linodeusercontent.com', 'digitaloceanspaces.com', 'azureedge.net'
-                ]
-                
-                if main_domain in cdn_domains:
+                rules = self.rules
+                if main_domain in rules.cdn_domains:
                     # Try to get more specific info from the full domain
                     if len(parts) >= 3:
                         # Check if there's a service identifier in the subdomain
                         subdomain = parts[0]
-                        service_indicators = ['api', 'www', 'app', 'service', 'cdn', 'static', 'assets']
-                        if subdomain not in service_indicators:
+                        if subdomain not in rules.service_indicators:
                             return f"{subdomain}.{main_domain}"
                     return main_domain
                 
                 # Check if we have a friendly name for this domain
-                friendly_name = self.domain_mapping.get(main_domain)
+                friendly_name = rules.domains.get(main_domain)
                 if friendly_name:
                     return friendly_name
                 
@@ -320,58 +2558,7 @@ class NetworkMonitorAgent:
     
     def get_service_name_by_ip(self, ip):
         """Get service name based on IP address ranges"""
-        try:
-            # Common service IP ranges
-            ip_parts = ip.split('.')
-            if len(ip_parts) != 4:
-                return None
-            
-            first_octet = int(ip_parts[0])
-            second_octet = int(ip_parts[1])
-            
-            # Google services
-            if first_octet == 142 and second_octet in [250, 251]:
-                return "Google Services"
-            elif first_octet == 172 and second_octet == 217:
-                return "Google Services"
-            elif first_octet == 216 and second_octet == 58:
-                return "Google Services"
-            elif first_octet == 74 and second_octet == 125:
-                return "Google Services"
-            
-            # Microsoft services
-            elif first_octet == 13 and second_octet == 107:
-                return "Microsoft Services"
-            elif first_octet == 20 and second_octet == 42:
-                return "Microsoft Services"
-            elif first_octet == 40 and second_octet == 126:
-                return "Microsoft Services"
-            
-            # Cloudflare
-            elif first_octet == 104 and second_octet == 18:
-                return "Cloudflare"
-            elif first_octet == 172 and second_octet == 64:
-                return "Cloudflare"
-            
-            # AWS
-            elif first_octet == 52 and second_octet in [201, 202, 203, 204, 205]:
-                return "Amazon Web Services"
-            elif first_octet == 54 and second_octet in [236, 237, 238, 239, 240]:
-                return "Amazon Web Services"
-            
-            # Akamai
-            elif first_octet == 159 and second_octet == 41:
-                return "Akamai CDN"
-            
-            # Facebook/Meta
-            elif first_octet == 31 and second_octet == 13:
-                return "Facebook Services"
-            elif first_octet == 66 and second_octet == 220:
-                return "Facebook Services"
-            
-            return None
-        except:
-            return None
+        return self.rules.service_for_ip(ip)
     
     def is_private_ip(self, ip):
         """Check if IP is private/internal"""
@@ -404,12 +2591,17 @@ class NetworkMonitorAgent:
         """Monitor network traffic and categorize by domain"""
         try:
             # Get current network I/O stats
-            net_io = psutil.net_io_counters()
+            with self.stage('io_counters'):
+                net_io = self.collector.net_io_counters()
+            now = self.clock.monotonic()
             
             if self.last_net_io is None:
                 self.last_net_io = net_io
+                self.last_sample_time = now
                 return
             
+            elapsed = max(now - self.last_sample_time, 1e-3)
+            
             # Calculate differences (bytes sent/received since last check)
             bytes_sent = net_io.bytes_sent - self.last_net_io.bytes_sent
             bytes_recv = net_io.bytes_recv - self.last_net_io.bytes_recv
@@ -418,25 +2610,72 @@ class NetworkMonitorAgent:
             upload_mb = bytes_sent / (1024 * 1024)
             download_mb = bytes_recv / (1024 * 1024)
             
-            # Get active connections
-            connections = self.get_network_connections()
+            # Get active connections (rescanned only every few ticks when sampling)
+            with self.stage('connections'):
+                self.ticks_since_scan += 1
+                if not self.governor.sampled_scans or self.ticks_since_scan >= SAMPLED_SCAN_EVERY:
+                    self.cached_connections = self.get_network_connections()
+                    self.ticks_since_scan = 0
+                connections = self.cached_connections
+            
+            # Activity signal for the adaptive sampling cadence
+            connection_keys = {(conn['local'], conn['remote']) for conn in connections}
+            churn = len(connection_keys ^ self.last_connection_keys)
+            self.last_connection_keys = connection_keys
+            self.last_activity = ((bytes_sent + bytes_recv) / elapsed, churn)
+            
+            # A rules version fetched since the last tick takes effect between ticks
+            rules = self.pending_rules
+            if rules is not None:
+                self.pending_rules = None
+                self.apply_rules(rules)
+            
+            # Addresses of known services forward-resolved in the background
+            if not self.seed_results.empty():
+                with self.stage('classification'):
+                    self.apply_seeds()
+            
+            # Learn IP -> name mappings and per-connection server names from captured traffic
+            if self.capture_source and not self.governor.skip_enrichment:
+                with self.stage('capture'):
+                    self.learn_from_capture()
             
             # Map connections to domains and estimate data usage
             domain_usage = defaultdict(lambda: {'upload': 0, 'download': 0, 'count': 0})
+            destinations = []  # (label, remote ip, remote port) for the distinct-destination sketches
             
             if connections and len(connections) > 0:
+                if self.governor.sampled_scans and len(connections) > SAMPLED_SCAN_LIMIT:
+                    connections = random.sample(connections, SAMPLED_SCAN_LIMIT)
+                
                 # Distribute bandwidth across active connections
                 upload_per_conn = upload_mb / len(connections)
                 download_per_conn = download_mb / len(connections)
+                allow_lookup = not self.governor.skip_enrichment
+                now = self.clock.monotonic()
+                
+                # With a relay, this tick's cache misses are resolved by it in one round trip
+                if self.relay_url and allow_lookup:
+                    misses = {conn['remote'].rsplit(':', 1)[0] for conn in connections}
+                    misses = [ip for ip in misses if self.domain_cache.get(ip, (None, 0))[1] <= now]
+                    if misses:
+                        with self.stage('resolution'):
+                            self.prefetch_from_relay(misses, now)
                 
                 for conn in connections:
                     try:
-                        remote_ip = conn['remote'].split(':')[0]
-                        domain = self.resolve_ip_to_domain(remote_ip)
+                        remote_ip, remote_port = conn['remote'].rsplit(':', 1)
+                        # The server name the client sent splits shared CDN addresses by service
+                        flow = self.flow_names.get((conn['local'], conn['remote']))
+                        if flow and flow[1] > now:
+                            domain = flow[0]
+                        else:
+                            domain = self.resolve_ip_to_domain(remote_ip, allow_lookup)
                         
                         domain_usage[domain]['upload'] += upload_per_conn
                         domain_usage[domain]['download'] += download_per_conn
                         domain_usage[domain]['count'] += 1
+                        destinations.append((domain, remote_ip, remote_port))
                     except Exception as e:
                         pass
             elif upload_mb > 0 or download_mb > 0:
@@ -445,192 +2684,1322 @@ class NetworkMonitorAgent:
                 domain_usage['system-activity']['download'] = download_mb
                 domain_usage['system-activity']['count'] = 1
             
+            # A sampler replaced by the watchdog while stuck drops its tick: the new
+            # sampler re-baselines the counters, so this interval is not counted twice
+            if self.watchdog.superseded():
+                return
+            
             # Update cumulative stats
-            for domain, usage in domain_usage.items():
-                self.network_stats[domain]['upload'] += usage['upload']
-                self.network_stats[domain]['download'] += usage['download']
-                self.network_stats[domain]['count'] += usage['count']
+            with self.stage('aggregation'), self.stats_lock:
+                for domain, remote_ip, remote_port in destinations:
+                    stats = self.label_stats(domain)
+                    stats['remote_ips'].add(remote_ip)
+                    stats['remote_ports'].add(remote_port)
+                self.aggregate_usage(domain_usage, elapsed)
             
             self.last_net_io = net_io
+            self.last_sample_time = now
             
         except Exception as e:
-            self.log(f"Error monitoring network: {e}")
+            self.log(f"Error monitoring network: {e}", logging.ERROR)
+    
+    def aggregate_usage(self, domain_usage, elapsed):
+        """Fold one tick's per-label usage into the cumulative network_stats"""
+        for domain, usage in domain_usage.items():
+            stats = self.label_stats(domain)
+            stats['upload'] += usage['upload']
+            stats['download'] += usage['download']
+            stats['count'] += usage['count']
+            
+            # Per-second throughput for this label (bytes/sec), weighted by the tick's
+            # length so percentiles are over seconds whatever the sampling cadence
+            rate = (usage['upload'] + usage['download']) * 1024 * 1024 / elapsed
+            stats['rate'].add(rate, max(1, round(elapsed)))
+    
+    def label_stats(self, domain):
+        """network_stats entry for a label, folding new labels into OVERFLOW_LABEL when full"""
+        if domain not in self.network_stats and len(self.network_stats) >= MAX_PENDING_LABELS:
+            domain = OVERFLOW_LABEL
+        return self.network_stats[domain]
     
     def send_data_to_backend(self):
         """Send collected network data to backend"""
         if not self.agent_token:
-            self.log("No agent token configured. Please register this agent.")
+            self.log("No agent token configured. Please register this agent.", logging.WARNING)
             return False
         
+        # Take the pending stats; the sampler keeps filling a fresh dict meanwhile
+        with self.stats_lock:
+            pending, self.network_stats = self.network_stats, defaultdict(new_label_stats)
+        
         try:
-            # Prepare website data
-            websites = []
-            for domain, stats in self.network_stats.items():
-                total_data = stats['upload'] + stats['download']
-                if total_data > 0:  # Only send if there's actual data
-                    websites.append({
-                        'domain': domain,
-                        'dataUsedMB': round(total_data, 2),
-                        'uploadMB': round(stats['upload'], 2),
-                        'downloadMB': round(stats['download'], 2),
-                        'requestCount': int(stats['count'])
-                    })
-            
-            # Calculate totals
-            total_upload = sum(w['uploadMB'] for w in websites)
-            total_download = sum(w['downloadMB'] for w in websites)
-            
-            # Prepare payload
-            payload = {
-                'totalUploadMB': round(total_upload, 2),
-                'totalDownloadMB': round(total_download, 2),
-                'websites': websites,
-                'agentVersion': AGENT_VERSION,
-                'systemInfo': self.get_system_info()
-            }
+            with self.stage('payload_build'):
+                payload = self.build_payload(pending)
             
             # Send to backend
-            headers = {
-                'Authorization': f'Bearer {self.agent_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # Try primary backend URL
-            try:
-                response = self.session.post(
-                    f"{self.backend_url}/network-monitoring/logs",
-                    json=payload,
-                    headers=headers,
-                    timeout=10,
-                    verify=True  # Verify SSL in production
-                )
-            except:
-                # Fallback to backup URL (localhost for development)
-                response = self.session.post(
-                    f"{BACKUP_BACKEND_URL}/network-monitoring/logs",
-                    json=payload,
-                    headers=headers,
-                    timeout=10,
-                    verify=False
-                )
+            self.failed_uploads += 1
+            with self.stage('http_post'):
+                response = self.post_to_backend('logs', payload, timeout=10)
             
             if response.status_code == 201:
-                self.log(f"Data sent successfully: {total_upload + total_download:.2f} MB total")
-                # Clear stats after successful send
-                self.network_stats.clear()
+                total_data = payload['totalUploadMB'] + payload['totalDownloadMB']
+                self.log(f"Data sent successfully: {total_data:.2f} MB total", logging.DEBUG)
+                self.failed_uploads = 0
+                self.last_upload_time = time.time()
+                if self.updater.pending and self.updater.confirm():
+                    self.log(f"Update to v{AGENT_VERSION} confirmed")
                 return True
             else:
-                self.log(f"Failed to send data: {response.status_code} - {response.text}")
+                self.log(f"Failed to send data: {response.status_code} - {response.text}", logging.WARNING)
+                self.restore_pending(pending)
                 return False
                 
         except Exception as e:
-            self.log(f"Error sending data to backend: {e}")
+            self.log(f"Error sending data to backend: {e}", logging.ERROR)
+            self.restore_pending(pending)
             return False
     
+    def restore_pending(self, pending):
+        """Merge stats from a failed upload back into network_stats"""
+        with self.stats_lock:
+            for domain, stats in pending.items():
+                target = self.label_stats(domain)
+                target['upload'] += stats['upload']
+                target['download'] += stats['download']
+                target['count'] += stats['count']
+                target['rate'].merge(stats['rate'])
+                target['remote_ips'].merge(stats['remote_ips'])
+                target['remote_ports'].merge(stats['remote_ports'])
+    
+    def backend_urls(self):
+        """(primary, verify, fallback, verify on fallback): the LAN relay first when one is configured"""
+        if self.relay_url:
+            return self.relay_url, self.relay_ca_file or True, self.backend_url, True
+        return self.backend_url, True, BACKUP_BACKEND_URL, False
+    
+    def post_to_backend(self, endpoint, payload=None, timeout=10):
+        """POST to a network-monitoring endpoint, falling back to the backup URL"""
+        headers = {
+            'Authorization': f'Bearer {self.agent_token}',
+            'Content-Type': 'application/json'
+        }
+        primary, verify, fallback, verify_fallback = self.backend_urls()
+        
+        # Try primary backend URL
+        try:
+            return self._timed_request('post', primary, endpoint, payload, headers, timeout,
+                                       verify=verify)  # Verify SSL in production
+        except:
+            # Fallback to backup URL (or straight to the backend when the relay is down)
+            return self._timed_request('post', fallback, endpoint, payload, headers, timeout,
+                                       verify=verify_fallback)
+    
+    def get_from_backend(self, endpoint, headers=None, timeout=10, long_poll=False):
+        """GET a network-monitoring endpoint, falling back to the backup URL"""
+        headers = dict(headers or {}, Authorization=f'Bearer {self.agent_token}')
+        primary, verify, fallback, verify_fallback = self.backend_urls()
+        try:
+            return self._timed_request('get', primary, endpoint, None, headers, timeout, verify=verify,
+                                       long_poll=long_poll)
+        except:
+            return self._timed_request('get', fallback, endpoint, None, headers, timeout, verify=verify_fallback,
+                                       long_poll=long_poll)
+    
+    def prefetch_from_relay(self, ips, now):
+        """Resolve cache misses in one request to the relay's shared resolver"""
+        try:
+            response = self._timed_request('post', self.relay_url, 'resolve', {'ips': ips[:RELAY_RESOLVE_MAX_IPS]},
+                                           {'Authorization': f'Bearer {self.agent_token}'},
+                                           RELAY_RESOLVE_TIMEOUT, verify=self.relay_ca_file or True)
+            if response.status_code != 200:
+                return
+            for ip, label in response.json().get('labels', {}).items():
+                self.cache_label(ip, label, now + DNS_CACHE_TTL, now)
+        except Exception as e:
+            self.log(f"Relay resolve failed: {e}", logging.DEBUG)
+    
+    def _timed_request(self, method, base_url, endpoint, payload, headers, timeout, verify, long_poll=False):
+        """Single request attempt, recording latency and failures per endpoint
+
+        A long-poll's duration is how long the server held it open, not latency,
+        so it is counted but left out of the histogram.
+        """
+        stats = self.endpoint_stats[(method.upper(), endpoint.split('?')[0], base_url)]
+        stats['requests'] += 1
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        start = time.monotonic()
+        try:
+            response = getattr(self.session, method)(
+                f"{base_url}/network-monitoring/{endpoint}",
+                json=payload,
+                headers=headers,
+                timeout=timeout,
+                verify=verify
+            )
+        except Exception:
+            stats['failures'] += 1
+            raise
+        finally:
+            if not long_poll:
+                stats['latency'].add(time.monotonic() - start)
+        if response.status_code >= 400:
+            stats['failures'] += 1
+        return response
+    
+    def build_payload(self, network_stats=None):
+        """Build the upload payload from network_stats (the agent's own by default)"""
+        if network_stats is None:
+            network_stats = self.network_stats
+        
+        # Prepare website data
+        websites = []
+        for domain, stats in network_stats.items():
+            total_data = stats['upload'] + stats['download']
+            if total_data > 0:  # Only send if there's actual data
+                websites.append({
+                    'domain': domain,
+                    'dataUsedMB': round(total_data, 2),
+                    'uploadMB': round(stats['upload'], 2),
+                    'downloadMB': round(stats['download'], 2),
+                    'requestCount': int(stats['count']),
+                    'rateBps': stats['rate'].summary(),
+                    'rateSketch': stats['rate'].to_dict(),
+                    'distinctRemoteIps': stats['remote_ips'].estimate(),
+                    'distinctRemotePorts': stats['remote_ports'].estimate(),
+                    'destinationSketch': {
+                        'p': HLL_PRECISION,
+                        'ips': stats['remote_ips'].to_string(),
+                        'ports': stats['remote_ports'].to_string()
+                    }
+                })
+        
+        # Calculate totals
+        total_upload = sum(w['uploadMB'] for w in websites)
+        total_download = sum(w['downloadMB'] for w in websites)
+        
+        # Prepare payload
+        payload = {
+            'totalUploadMB': round(total_upload, 2),
+            'totalDownloadMB': round(total_download, 2),
+            'websites': websites,
+            'agentVersion': AGENT_VERSION,
+            'systemInfo': self.get_system_info(),
+            'agentMetrics': self.get_self_metrics()
+        }
+        
+        return payload
+    
+    def get_self_metrics(self):
+        """Agent self-metrics included in each upload"""
+        return {
+            'cadence': self.cadence.metrics(),
+            'power': self.power.metrics(),
+            'governor': self.governor.metrics(),
+            'stageLatencyMs': self.profiler.summary(),
+            'dnsCache': {
+                'hits': self.dns_cache_hits,
+                'misses': self.dns_cache_misses,
+                'size': len(self.domain_cache)
+            },
+            'capture': self.capture_metrics(),
+            'seeder': self.seeder.metrics() if self.seeder else None,
+            'rulesVersion': self.rules.version,
+            'update': self.updater.metrics(),
+            'memory': self.memory_profiler.metrics() if self.memory_profiler else None,
+            'watchdog': self.watchdog.metrics()
+        }
+    
+    def capture_metrics(self):
+        """Passive DNS, flow name and capture counters, None when capture is off"""
+        if not self.capture_source:
+            return None
+        metrics = self.passive_dns.metrics()
+        metrics['flowNames'] = len(self.flow_names)
+        metrics['flowNamesLearned'] = self.flow_names_learned
+        metrics['packets'] = self.capture_source.packets
+        metrics['dropped'] = self.capture_source.dropped
+        return metrics
+    
+    def sample_memory(self):
+        """Take a tracemalloc sample and log the top growers and leak suspects"""
+        suspects = self.memory_profiler.sample()
+        current, peak = self.memory_profiler.traced_memory()
+        self.log(f"Memory profile: {current / 1024:.0f} KB traced (peak {peak / 1024:.0f} KB)")
+        for site, size in self.memory_profiler.top_growers[:3]:
+            self.log(f"  grower {site}: +{size / 1024:.1f} KB since start")
+        for site, size, streak in suspects:
+            self.log(f"  LEAK SUSPECT {site}: +{size / 1024:.1f} KB, grew in {streak} consecutive samples", logging.WARNING)
+    
+    def publish_status(self, state, interval=None):
+        """Rewrite the memory-mapped status record (no-op when there is none)"""
+        if not self.status_segment:
+            return
+        try:
+            pending = [(label, (stats['upload'] + stats['download']) * 1024 * 1024)
+                       for label, stats in list(self.network_stats.items())]
+            self.status_segment.write(
+                state, self.governor.level, self.power.on_battery, self.last_tick_time or 0.0,
+                self.last_upload_time, sum(size for _, size in pending), self.failed_uploads, len(pending),
+                interval if interval is not None else self.cadence.interval,
+                heapq.nlargest(STATUS_TOP_LABELS, pending, key=lambda item: item[1]))
+        except Exception as e:
+            self.log(f"Error writing status file: {e}", logging.DEBUG)
+    
+    def pending_bytes(self):
+        """Traffic counted but not yet uploaded, in bytes"""
+        return sum(stats['upload'] + stats['download'] for stats in list(self.network_stats.values())) * 1024 * 1024
+    
+    def collect_metric_families(self):
+        """Pre-aggregated metric families published to the metrics endpoint"""
+        pending_bytes = self.pending_bytes()
+        families = [
+            ('itmonitor_agent_info', 'gauge', 'Agent version and system',
+             [('', {'version': AGENT_VERSION, 'system_id': self.system_id or ''}, 1)]),
+            ('itmonitor_dns_cache_hits_total', 'counter', 'Resolution cache hits',
+             [('', {}, self.dns_cache_hits)]),
+            ('itmonitor_dns_cache_misses_total', 'counter', 'Resolution cache misses',
+             [('', {}, self.dns_cache_misses)]),
+            ('itmonitor_dns_cache_entries', 'gauge', 'Entries in the resolution cache',
+             [('', {}, len(self.domain_cache))]),
+            ('itmonitor_network_stats_labels', 'gauge', 'Labels pending in network_stats',
+             [('', {}, len(self.network_stats))]),
+            ('itmonitor_spool_pending_bytes', 'gauge', 'Traffic collected but not yet uploaded',
+             [('', {}, round(pending_bytes))]),
+            ('itmonitor_spool_pending_uploads', 'gauge', 'Upload attempts since the last successful upload',
+             [('', {}, self.failed_uploads)]),
+            ('itmonitor_sample_interval_seconds', 'gauge', 'Current sampling interval',
+             [('', {}, self.cadence.interval)]),
+            ('itmonitor_degradation_level', 'gauge', 'Resource governor degradation level',
+             [('', {'level': DEGRADATION_LEVELS[self.governor.level]}, self.governor.level)]),
+            ('itmonitor_tick_duration_seconds', 'histogram', 'Duration of one sampling tick',
+             histogram_samples(self.profiler.histograms['tick']))
+        ]
+        
+        requests_samples, failure_samples, latency_samples = [], [], []
+        for (method, endpoint, base_url), stats in list(self.endpoint_stats.items()):
+            labels = {'method': method, 'endpoint': endpoint, 'backend': base_url}
+            requests_samples.append(('', labels, stats['requests']))
+            failure_samples.append(('', labels, stats['failures']))
+            if stats['latency'].count:
+                latency_samples.extend(histogram_samples(stats['latency'], labels))
+        families.append(('itmonitor_backend_requests_total', 'counter',
+                         'Backend requests per method and endpoint', requests_samples))
+        families.append(('itmonitor_backend_request_failures_total', 'counter',
+                         'Failed backend requests per method and endpoint', failure_samples))
+        families.append(('itmonitor_backend_request_latency_seconds', 'histogram',
+                         'Backend request latency per method and endpoint, excluding command long-polls',
+                         latency_samples))
+        
+        if self.memory_profiler:
+            current, peak = self.memory_profiler.traced_memory()
+            families.append(('itmonitor_traced_memory_bytes', 'gauge', 'Memory allocated under tracemalloc',
+                             [('', {}, current)]))
+            families.append(('itmonitor_memory_growth_bytes', 'gauge', 'Growth of leak-suspect allocation sites',
+                             [('', {'site': site}, size) for site, size, streak in self.memory_profiler.suspects]))
+        return families
+    
     def send_heartbeat(self):
         """Send heartbeat to backend"""
-        if not self.agent_token:
+        if not self.agent_token or self.push_connected:
             return
         
+        self.last_heartbeat_time = time.time()
+        if self.udp_heartbeat:
+            with self.stage('heartbeat'):
+                acknowledged = self.send_udp_heartbeat()
+            if acknowledged:
+                self.log("UDP heartbeat acknowledged", logging.DEBUG)
+                return
+            self.log("No UDP heartbeat acknowledgement, falling back to HTTPS", logging.DEBUG)
+        
         try:
-            headers = {
-                'Authorization': f'Bearer {self.agent_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            try:
-                response = self.session.post(
-                    f"{self.backend_url}/network-monitoring/heartbeat",
-                    headers=headers,
-                    timeout=5,
-                    verify=True
-                )
-            except:
-                response = self.session.post(
-                    f"{BACKUP_BACKEND_URL}/network-monitoring/heartbeat",
-                    headers=headers,
-                    timeout=5,
-                    verify=False
-                )
+            with self.stage('heartbeat'):
+                response = self.post_to_backend('heartbeat', timeout=5)
             
             if response.status_code == 200:
-                self.log("Heartbeat sent successfully")
+                self.log("Heartbeat sent successfully", logging.DEBUG)
             
         except Exception as e:
-            self.log(f"Heartbeat failed: {e}")
+            self.log(f"Heartbeat failed: {e}", logging.WARNING)
+    
+    def send_udp_heartbeat(self):
+        """Signed datagram heartbeat; True once the collector has acknowledged it"""
+        key = heartbeat_key(self.agent_token)
+        self.heartbeat_sequence += 1
+        sequence = self.heartbeat_sequence & 0xffffffff
+        packet = pack_heartbeat(key, self.system_id, sequence, time.time(), self.pending_bytes())
+        try:
+            host, port = self.udp_heartbeat.rsplit(':', 1)
+            family, _, _, _, address = socket.getaddrinfo(host.strip('[]'), int(port), type=socket.SOCK_DGRAM)[0]
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(UDP_HEARTBEAT_ACK_TIMEOUT)
+                sock.connect(address)
+                for _ in range(UDP_HEARTBEAT_ATTEMPTS):
+                    sock.send(packet)
+                    try:
+                        if is_heartbeat_ack(sock.recv(64), key, sequence):
+                            return True
+                    except socket.timeout:
+                        continue
+        except (OSError, ValueError) as e:
+            self.log(f"UDP heartbeat failed: {e}", logging.DEBUG)
+        return False
     
-    def heartbeat_loop(self):
-        """Background thread for sending heartbeats"""
-        while self.is_running:
+    def heartbeat_loop(self, lease):
+        """Heartbeat worker"""
+        while self.is_running and lease.valid:
+            if self.power.on_battery:
+                # On battery heartbeats ride on the sampler's aligned wakeup; the bounded
+                # wait lets a replaced worker exit even if the power state never changes
+                self.power.ac_power.wait(BATTERY_HEARTBEAT_INTERVAL)
+                if self.stop_event.is_set():
+                    break
+                continue
             self.send_heartbeat()
-            time.sleep(HEARTBEAT_INTERVAL)
+            if self.stop_event.wait(HEARTBEAT_INTERVAL):
+                break
+    
+    def command_loop(self, lease):
+        """Command worker: long-polls the backend for pushed commands, backing off on failure"""
+        backoff = COMMAND_BACKOFF_MIN
+        while self.is_running and lease.valid:
+            if not self.agent_token:
+                self.stop_event.wait(HEARTBEAT_INTERVAL)
+                continue
+            with self.stage('command_poll'):
+                connected = self.poll_commands()
+            if not lease.valid:
+                break
+            if connected:
+                backoff = COMMAND_BACKOFF_MIN
+                continue
+            # Heartbeats cover liveness until the channel is back
+            if self.stop_event.wait(backoff * random.uniform(0.5, 1.0)):
+                break
+            backoff = min(backoff * 2, COMMAND_BACKOFF_MAX)
+    
+    def poll_commands(self):
+        """One long-poll for commands; True if the channel answered normally"""
+        wait = int(self.command_poll_seconds)
+        try:
+            response = self.get_from_backend(f'commands?wait={wait}', timeout=wait + 30, long_poll=True)
+        except Exception as e:
+            self.push_connected = False
+            self.log(f"Command channel unavailable: {e}", logging.DEBUG)
+            return False
+        if response.status_code not in (200, 204):
+            # 404 from a backend without the channel: heartbeats stay on, polls back off
+            self.push_connected = False
+            return False
+        
+        self.push_connected = True
+        if response.status_code == 200:
+            for command in response.json().get('commands', []):
+                self.handle_command(command)
+        return True
+    
+    def handle_command(self, command):
+        """Apply one pushed command"""
+        kind = command.get('type')
+        self.log(f"Command received: {kind}")
+        if kind == 'flush':
+            self.upload_requested.set()
+        elif kind == 'rules':
+            self.rules_requested.set()
+        elif kind == 'config':
+            self.apply_pushed_config(command.get('config') or {})
+        elif kind == 'update':
+            self.update_requested.set()
+        else:
+            self.log(f"Ignoring unknown command: {kind}", logging.WARNING)
+    
+    def apply_pushed_config(self, config):
+        """Apply and persist the supported settings from a config command; nothing if any value is invalid"""
+        changed = [key for key in PUSHED_CONFIG_KEYS if key in config]
+        try:
+            values = {key: pushed_config_value(key, config[key]) for key in changed}
+        except ValueError as e:
+            self.log(f"Rejected config command: {e}", logging.WARNING)
+            return
+        for key, value in values.items():
+            setattr(self, key, value)
+        if 'cpu_budget_percent' in changed:
+            self.governor.cpu_budget_percent = self.cpu_budget_percent
+        if 'rss_budget_mb' in changed:
+            self.governor.rss_budget_mb = self.rss_budget_mb
+        if 'log_level' in changed:
+            self.logger.setLevel(getattr(logging, str(self.log_level).upper(), logging.INFO))
+        ignored = sorted(set(config) - set(changed))
+        if ignored:
+            self.log(f"Ignoring unsupported config keys: {', '.join(ignored)}", logging.WARNING)
+        if changed:
+            self.save_config()
+            self.log(f"Configuration updated: {', '.join(changed)}")
+    
+    def rules_loop(self, lease):
+        """Rules worker: conditional fetch of the classification rules at a slow cadence"""
+        while self.is_running and lease.valid:
+            if self.agent_token:
+                with self.stage('rules_fetch'):
+                    self.fetch_rules()
+            # Jittered so a fleet restarted together does not poll in lockstep; a
+            # 'rules' command (or stop) cuts the wait short
+            self.rules_requested.wait(RULES_INTERVAL * random.uniform(0.9, 1.1))
+            self.rules_requested.clear()
+    
+    def fetch_rules(self):
+        """GET the rules bundle with If-None-Match; True when a new version was received"""
+        headers = {'If-None-Match': self.rules.etag} if self.rules.etag else {}
+        try:
+            response = self.get_from_backend('rules', headers)
+            if response.status_code == 304:
+                return False
+            if response.status_code != 200:
+                self.log(f"Rules fetch failed: HTTP {response.status_code}", logging.WARNING)
+                return False
+            rules = ClassificationRules.from_bundle(response.json(), response.headers.get('ETag'))
+        except Exception as e:
+            self.log(f"Rules fetch failed: {e}", logging.WARNING)
+            return False
+        
+        self.pending_rules = rules
+        try:
+            rules.save()
+        except Exception as e:
+            self.log(f"Could not cache rules: {e}", logging.WARNING)
+        self.log(f"Classification rules version {rules.version} received")
+        return True
+    
+    def update_loop(self, lease):
+        """Updater worker: installs rolled-out releases, rolls back ones that never confirm"""
+        while self.is_running and lease.valid:
+            if self.updater.pending:
+                if time.time() >= self.updater.confirm_deadline():
+                    self.log(f"Update to v{AGENT_VERSION} not confirmed, rolling back", logging.WARNING)
+                    self.updater.rollback("not confirmed in time")
+                    self.request_restart()
+                    break
+                wait = self.updater.confirm_deadline() - time.time()
+            else:
+                if self.agent_token and self.auto_update:
+                    with self.stage('update'):
+                        installed = self.check_for_update(lease)
+                    if installed and lease.valid:
+                        self.request_restart()
+                        break
+                wait = UPDATE_CHECK_INTERVAL * random.uniform(0.9, 1.1)
+            self.update_requested.wait(max(wait, 1))
+            self.update_requested.clear()
+    
+    def check_for_update(self, lease=None):
+        """Fetch the update manifest and install its release if this machine is in the rollout"""
+        headers = {'If-None-Match': self.update_etag} if self.update_etag else {}
+        headers['Authorization'] = f'Bearer {self.agent_token}'
+        try:
+            response = self.update_request(lambda base_url: f"{base_url}/network-monitoring/update/manifest",
+                                           headers, timeout=10, retry_status=False)
+            if response.status_code in (304, 404):
+                return False
+            if response.status_code != 200:
+                self.log(f"Update check failed: HTTP {response.status_code}", logging.WARNING)
+                return False
+            manifest = response.json()
+            self.update_etag = response.headers.get('ETag')
+        except Exception as e:
+            self.log(f"Update check failed: {e}", logging.WARNING)
+            return False
+        try:
+            verified = self.updater.verify(manifest)
+        except ImportError as e:
+            self.log(f"Cannot check update signatures ({e}); repair the installation", logging.WARNING)
+            return False
+        if not verified:
+            self.log(f"Ignoring update manifest v{manifest.get('version')}: missing or invalid signature",
+                     logging.WARNING)
+            return False
+        if not self.updater.wanted(manifest, self.system_id):
+            return False
+        
+        version = str(manifest['version'])
+        if not SelfUpdater.lock.acquire(blocking=False):
+            # An abandoned updater thread is still staging or installing
+            self.update_etag = None
+            self.log(f"Update to v{version} postponed: an earlier attempt is still running", logging.WARNING)
+            return False
+        try:
+            names = self.updater.stage(manifest, self.download_update_file, lease)
+            if not names:
+                return False
+            self.updater.install(version, names, lease)
+        except Exception as e:
+            self.update_etag = None  # retry the same manifest at the next check
+            self.log(f"Update to v{version} failed: {e}", logging.ERROR)
+            return False
+        finally:
+            SelfUpdater.lock.release()
+        stats = self.updater.stats
+        self.log(f"Updated to v{version} ({', '.join(names)}; {stats['bytesFetched']} bytes downloaded, "
+                 f"{stats['bytesSaved']} saved by deltas), restarting")
+        return True
+    
+    def update_request(self, url_for, headers=None, timeout=60, retry_status=True):
+        """GET for the updater: straight from the backend (never the relay), TLS always verified
+
+        Tries the backend, then the backup URL, on connection errors (and on
+        non-200 answers when retry_status is set); raises if neither answers.
+        """
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        last_error = None
+        for base_url in dict.fromkeys((self.backend_url, BACKUP_BACKEND_URL)):
+            try:
+                response = self.session.get(url_for(base_url), headers=headers or {}, timeout=timeout, verify=True)
+                if response.status_code == 200 or not retry_status:
+                    return response
+                last_error = f"HTTP {response.status_code}"
+            except Exception as e:
+                last_error = e
+        raise ConnectionError(last_error)
+    
+    def download_update_file(self, url):
+        """GET a file named in the update manifest, relative to the backend's root (/downloads/...)"""
+        def url_for(base_url):
+            root = base_url[:-len('/api')] if base_url.endswith('/api') else base_url
+            return f"{root}/{url.lstrip('/')}"
+        try:
+            return self.update_request(url_for).content
+        except ConnectionError as e:
+            raise ConnectionError(f"could not download {url}: {e}")
+    
+    def request_restart(self):
+        """Stop the agent so main() (or the service wrapper) starts the installed version"""
+        self.restart_requested = True
+        self.stop()
+    
+    def apply_rules(self, rules):
+        """Swap in a new rules version; labels resolved under the old one are dropped"""
+        self.rules = rules
+        self.domain_cache = {}
+        self.flow_names = {}
+        if self.seeder:
+            self.seeder.set_names(self.seed_names())
+    
+    def seeding_loop(self, lease):
+        """Seeder worker: keeps the resolver cache filled with known service addresses"""
+        while self.is_running and lease.valid:
+            if self.power.on_battery:
+                # No seeding on battery: sleep until AC power is back (stop() sets it too);
+                # bounded so a replaced worker exits even if the power state never changes
+                self.power.ac_power.wait(SEED_POLL_MAX)
+                if self.stop_event.is_set():
+                    break
+                continue
+            if self.governor.skip_enrichment:
+                # Names stay due while the governor sheds enrichment, so do not wake for them
+                wait = SEED_POLL_MAX
+            else:
+                with self.stage('seeding'):
+                    results = self.seeder.run_round(self.clock.monotonic())
+                if results and lease.valid:
+                    self.seed_results.put(results)
+                wait = self.seeder.next_due() - self.clock.monotonic()
+            if self.stop_event.wait(min(max(wait, SEED_POLL_MIN), SEED_POLL_MAX)):
+                break
+    
+    def upload_loop(self, lease):
+        """Uploader worker: sends the pending stats whenever the sampler asks for it"""
+        while self.is_running and lease.valid:
+            self.upload_requested.wait()
+            self.upload_requested.clear()
+            if self.is_running and lease.valid:
+                self.send_data_to_backend()
+    
+    def sampling_loop(self, lease):
+        """Sampler worker: ticks, cadence, budgets, upload scheduling and status"""
+        last_memory_sample = 0
+        if self.last_send_time is None:
+            self.last_send_time = time.time()
+        
+        while self.is_running and lease.valid:
+            if self.power.detect_resume():
+                # Flush what was collected before the suspend and re-baseline the
+                # counters so the sleep gap is not attributed to the first tick
+                self.log("Resume from sleep detected, flushing pending data")
+                self.upload_requested.set()
+                self.send_heartbeat()
+                self.last_send_time = time.time()
+                self.last_net_io = None
+            
+            if self.power.refresh():
+                self.log(f"Power source changed: {'battery' if self.power.on_battery else 'AC'}")
+            
+            # Monitor network traffic
+            cpu_start = time.process_time()
+            with self.stage('tick'):
+                self.monitor_network_traffic()
+            if not lease.valid:
+                break
+            self.last_tick_time = time.time()
+            interval = self.cadence.update(*self.last_activity,
+                                           tick_cpu_seconds=time.process_time() - cpu_start)
+            
+            if self.governor.evaluate():
+                self.log(f"Resource governor level: {DEGRADATION_LEVELS[self.governor.level]} "
+                         f"(CPU {self.governor.cpu_percent:.1f}%, RSS {self.governor.rss_mb:.0f} MB)")
+            if self.governor.long_intervals:
+                interval *= DEGRADED_INTERVAL_FACTOR
+            
+            update_interval = self.update_interval
+            if self.power.on_battery:
+                update_interval = BATTERY_UPDATE_INTERVAL
+                if time.time() - self.last_heartbeat_time >= BATTERY_HEARTBEAT_INTERVAL:
+                    self.send_heartbeat()
+            
+            # Hand the data to the uploader every update_interval seconds
+            if time.time() - self.last_send_time >= update_interval:
+                self.upload_requested.set()
+                self.last_send_time = time.time()
+            
+            if self.memory_profiler and time.time() - last_memory_sample >= MEMORY_PROFILE_INTERVAL:
+                self.sample_memory()
+                last_memory_sample = time.time()
+            
+            if self.exporter:
+                self.exporter.publish(self.collect_metric_families())
+            
+            self.publish_status('running', interval)
+            
+            # Sample every second while active, less often when idle or on battery
+            interval = self.power.next_wakeup(interval)
+            self.power.mark_wait(interval)
+            self.stop_event.wait(interval)
+    
+    def recover_worker(self, name, stage):
+        """Repair shared state before a stalled or crashed worker is replaced"""
+        if name != 'sampler':
+            return
+        # The replacement re-baselines the counters; the stuck tick is discarded
+        self.last_net_io = None
+        self.power.wait_started = None
+        ip = self.resolving_ip
+        if stage == 'resolution' and ip:
+            # Don't let the new sampler block on the same address again
+            self.domain_cache[ip] = (f"service-{ip.split('.')[-1]}", self.clock.monotonic() + DNS_CACHE_TTL)
+            self.resolving_ip = None
+    
+    def supervise(self, workers):
+        """Replace stalled or crashed workers; called by run() every supervision_wait()"""
+        for name, stage, stalled_for in self.watchdog.stalled():
+            if stage:
+                self.log(f"Watchdog: {name} stuck in {stage} for {stalled_for:.0f}s, restarting it", logging.WARNING)
+            else:
+                self.log(f"Watchdog: {name} crashed ({self.watchdog.workers[name].error}), restarting it",
+                         logging.ERROR)
+            self.recover_worker(name, stage)
+            self.watchdog.restart(name, workers[name])
+    
+    def supervision_wait(self):
+        """Seconds until the next liveness check
+
+        Follows the sampler's cadence (and its aligned wakeup on battery) so an
+        idle agent is not woken just to look at its workers; crashes wake run()
+        through the watchdog instead of waiting for the next check.
+        """
+        return self.power.next_wakeup(max(self.cadence.interval, WATCHDOG_INTERVAL))
     
     def run(self):
-        """Main agent loop"""
+        """Main agent loop: start the workers and supervise them until stopped"""
         self.log(f"Starting IT Network Monitor Agent v{AGENT_VERSION}")
         self.log(f"System: {self.system_name} ({self.system_id})")
+        if self.is_running:
+            self.stop_event.clear()
+            self.rules_requested.clear()
+            self.update_requested.clear()
+            self.upload_requested.clear()
+            self.watchdog.wakeup.clear()
+        
+        # An update that keeps failing to start is rolled back before anything else runs
+        try:
+            if self.updater.on_start():
+                self.log(f"Update to v{AGENT_VERSION} rolled back: {self.updater.state.get('reason')}",
+                         logging.WARNING)
+                self.restart_requested = True
+                self.is_running = False
+                return
+        except Exception as e:
+            self.log(f"Could not check update state: {e}", logging.WARNING)
+        
+        # Optional localhost self-metrics endpoint
+        if self.metrics_port and self.exporter is None:
+            try:
+                self.exporter = MetricsExporter(int(self.metrics_port))
+                self.exporter.start()
+                self.log(f"Metrics endpoint listening on http://{METRICS_HOST}:{self.metrics_port}/metrics")
+            except Exception as e:
+                self.log(f"Could not start metrics endpoint: {e}", logging.WARNING)
+                self.exporter = None
         
-        # Start heartbeat thread
-        heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
-        heartbeat_thread.start()
+        # Optional passive DNS and server name learning (live capture needs administrator rights)
+        if self.packet_capture and self.capture_source is None:
+            try:
+                self.capture_source = open_capture_source(self.packet_capture, self.get_local_ip())
+                self.log(f"Packet capture enabled ({self.packet_capture})")
+            except Exception as e:
+                self.log(f"Could not start packet capture: {e}", logging.WARNING)
+                self.capture_source = None
+        
+        # Background forward resolution of the mapped service domains
+        if self.service_seeding and self.seeder is None:
+            resolver = self.seed_resolver
+            if resolver is None:
+                server = self.dns_server or system_nameserver()
+                resolver = DnsResolver(server) if server else SystemResolver()
+            self.seeder = ServiceSeeder(self.seed_names(), resolver)
+        
+        # Optional long-running memory diagnostics
+        if self.memory_profiling and self.memory_profiler is None:
+            self.memory_profiler = MemoryProfiler()
+            self.log("Memory profiling enabled (tracemalloc)")
         
-        last_send_time = time.time()
+        # Live status record read by the status command
+        try:
+            self.status_segment = StatusSegment()
+            self.publish_status('starting')
+        except Exception as e:
+            self.log(f"Could not create status file: {e}", logging.WARNING)
+            self.status_segment = None
+        
+        # Sampling, uploads and heartbeats run on separate workers so a hung DNS
+        # lookup or HTTP call stalls only one of them, and the watchdog replaces it
+        workers = {
+            'sampler': self.sampling_loop,
+            'uploader': self.upload_loop,
+            'heartbeat': self.heartbeat_loop,
+            'commands': self.command_loop,
+            'rules': self.rules_loop,
+            'updater': self.update_loop
+        }
+        if self.seeder:
+            workers['seeder'] = self.seeding_loop
+        for name, target in workers.items():
+            self.watchdog.spawn(name, target)
         
         try:
             while self.is_running:
-                # Monitor network traffic
-                self.monitor_network_traffic()
-                
-                # Send data every UPDATE_INTERVAL seconds
-                if time.time() - last_send_time >= UPDATE_INTERVAL:
-                    self.send_data_to_backend()
-                    last_send_time = time.time()
-                
-                time.sleep(1)  # Check every second
+                self.watchdog.wakeup.wait(self.supervision_wait())
+                self.watchdog.wakeup.clear()
+                if self.stop_event.is_set():
+                    break
+                self.supervise(workers)
                 
         except KeyboardInterrupt:
             self.log("Agent stopped by user")
         except Exception as e:
-            self.log(f"Agent error: {e}")
+            self.log(f"Agent error: {e}", logging.ERROR)
         finally:
             self.is_running = False
+            self.stop_event.set()
+            self.power.ac_power.set()
+            self.rules_requested.set()
+            self.update_requested.set()
+            self.upload_requested.set()
+            self.push_connected = False
+            self.watchdog.join()
+            if self.exporter:
+                self.exporter.stop()
+                self.exporter = None
+            if self.capture_source:
+                self.capture_source.close()
+                self.capture_source = None
+            if self.seeder:
+                self.seeder.close()
+                self.seeder = None
+            if self.status_segment:
+                self.publish_status('stopped')
+                self.status_segment.close()
+                self.status_segment = None
             self.log("Agent shutdown complete")
     
     def stop(self):
         """Stop the agent"""
         self.is_running = False
+        self.stop_event.set()
+        self.power.ac_power.set()
+        self.rules_requested.set()
+        self.update_requested.set()
+        self.upload_requested.set()
+        self.watchdog.wakeup.set()
+
+def merge_upload(merged, payload):
+    """Fold one upload payload into an earlier one from the same agent
+
+    Byte and request counts add up; the rate and destination sketches are merged,
+    so the summaries stay exact for the combined interval. Version, system info
+    and self-metrics are taken from the newer payload.
+    """
+    websites = {site['domain']: site for site in merged.get('websites', [])}
+    for site in payload.get('websites', []):
+        current = websites.get(site.get('domain'))
+        if current is None:
+            websites[site.get('domain')] = site
+            continue
+        for key in ('dataUsedMB', 'uploadMB', 'downloadMB'):
+            current[key] = round(current.get(key, 0) + site.get(key, 0), 2)
+        current['requestCount'] = current.get('requestCount', 0) + site.get('requestCount', 0)
+        if 'rateSketch' in current and 'rateSketch' in site:
+            rate = RateSketch.from_dict(current['rateSketch'])
+            rate.merge(RateSketch.from_dict(site['rateSketch']))
+            current['rateSketch'] = rate.to_dict()
+            current['rateBps'] = rate.summary()
+        if 'destinationSketch' in current and 'destinationSketch' in site:
+            for name, estimate in (('ips', 'distinctRemoteIps'), ('ports', 'distinctRemotePorts')):
+                sketch = HyperLogLog.from_string(current['destinationSketch'][name])
+                sketch.merge(HyperLogLog.from_string(site['destinationSketch'][name]))
+                current['destinationSketch'][name] = sketch.to_string()
+                current[estimate] = sketch.estimate()
+    merged['websites'] = list(websites.values())
+    for key in ('totalUploadMB', 'totalDownloadMB'):
+        merged[key] = round(float(merged.get(key) or 0) + float(payload.get(key) or 0), 2)
+    for key in ('agentVersion', 'systemInfo', 'agentMetrics'):
+        if key in payload:
+            merged[key] = payload[key]
+    return merged
+
+def gunzip_limited(data, limit):
+    """gzip-decode data, or None when it would inflate to more than limit bytes"""
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decoder.decompress(data, limit + 1)
+    return body if len(body) <= limit else None
+
+def relay_handler():
+    """Request handler class for RelayServer, built on first use like metrics_handler"""
+    from http.server import BaseHTTPRequestHandler
+
+    class RelayHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the agent's requests session
+
+        def setup(self):
+            super().setup()
+            if hasattr(self.request, 'do_handshake'):
+                self.request.do_handshake()  # TLS handshake in this thread, not the accept loop
+
+        def do_POST(self):
+            self.dispatch('POST')
+
+        def do_GET(self):
+            self.dispatch('GET')
+
+        def dispatch(self, method):
+            relay = self.server.relay
+            token = self.headers.get('Authorization', '').replace('Bearer ', '', 1).strip()
+            length = self.headers.get('Content-Length') or '0'
+            
+            # Nothing is read or decoded before the token is on the allow-list
+            status, response, extra = relay.authorize(self.path, token) or (None, None, {})
+            if status is None and not (length.isdigit() and int(length) <= RELAY_MAX_BODY_BYTES):
+                status, response = 413, {'msg': 'Request body too large'}
+            if status is None:
+                try:
+                    body = self.rfile.read(int(length))
+                    if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+                        body = gunzip_limited(body, RELAY_MAX_BODY_BYTES)
+                    if body is None:
+                        status, response = 413, {'msg': 'Request body too large'}
+                    else:
+                        status, response, extra = relay.handle(method, self.path, token, body,
+                                                               self.headers.get('If-None-Match'))
+                except (ValueError, zlib.error):
+                    status, response = 400, {'msg': 'Malformed request body'}
+                except Exception as e:
+                    relay.agent.log(f"Relay request {method} {self.path.split('?')[0]} failed: {e}", logging.WARNING)
+                    status, response = 500, {'msg': 'Relay error'}
+            else:
+                self.close_connection = True  # the unread body would be taken for the next request
+            data = response if isinstance(response, bytes) else json.dumps(response).encode()
+            if status in (204, 304):
+                data = b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in extra.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RelayHandler
+
+RELAY_API_PREFIX = '/api/network-monitoring/'
+
+class RelayServer:
+    """Branch-office relay: one upstream connection on behalf of the agents on a LAN
+
+    Agents with relay_url set send their uploads and heartbeats here, over TLS
+    with the relay's own certificate since they carry the agents' tokens. Tokens are
+    checked against an allow-list cached from the backend (POST relay/verify, which
+    the backend only answers once an admin has marked this machine's agent as a
+    relay), and each agent's uploads are merged (merge_upload) until the next flush, when all
+    of them go upstream as one gzip-compressed POST to logs/bulk over the relay
+    agent's pooled session. The relay also answers resolve requests from its own
+    resolver and classification cache and serves one cached copy of the rules
+    bundle, so a LAN shares those lookups instead of repeating them per machine.
+    Command long-polls are passed through with the agent's own token; a 'rules'
+    command on the way back expires the cached bundle so the agent's refetch sees
+    the new version. Updates do not go through the relay (see update_request).
+    """
+
+    def __init__(self, agent, host='0.0.0.0', port=RELAY_PORT, certfile=None, keyfile=None):
+        self.agent = agent  # the relay machine's agent: token, backend URL, session, resolver
+        self.host = host
+        self.port = port
+        self.certfile = certfile  # PEM certificate chain the relay serves; plain HTTP without one
+        self.keyfile = keyfile
+        self.lock = threading.Lock()
+        self.pending = {}  # agent token -> merged upload
+        self.alive = set()  # tokens heard from since the last flush
+        self.allowed = {}  # sha256 of token -> monotonic time the entry expires
+        self.denied = {}
+        self.resolve_lock = threading.Lock()  # the agent's caches have a single writer
+        self.rules_bundle = None  # (ETag, body, monotonic time fetched)
+        self.rules_lock = threading.Lock()  # one upstream rules fetch at a time
+        self.poll_session = None  # long-polls hold a connection each, so they get their own pool
+        self.stats = defaultdict(int)
+        self.server = None
+
+    def token_allowed(self, token):
+        """True for a token the backend accepts; raises if the backend cannot be asked"""
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        now = time.monotonic()
+        if self.allowed.get(digest, 0) > now:
+            return True
+        if self.denied.get(digest, 0) > now:
+            return False
+        response = self.agent.post_to_backend('relay/verify', {'tokens': [token]}, timeout=10)
+        if response.status_code == 403:
+            raise ConnectionError("the backend has not marked this agent as a relay")
+        if response.status_code != 200:
+            raise ConnectionError(f"token verification failed: HTTP {response.status_code}")
+        valid = bool(response.json().get('valid', [False])[0])
+        if valid:
+            self.allowed[digest] = now + RELAY_ALLOWLIST_TTL
+        else:
+            self.denied[digest] = now + RELAY_DENYLIST_TTL
+        return valid
+
+    def authorize(self, path, token):
+        """None for a relayed endpoint and an allowed token, else the (status, body, headers) to answer"""
+        if not path.split('?', 1)[0].startswith(RELAY_API_PREFIX):
+            return 404, {'msg': 'Not found'}, {}
+        if not token:
+            return 401, {'msg': 'No agent token provided'}, {}
+        try:
+            if not self.token_allowed(token):
+                return 401, {'msg': 'Invalid agent token'}, {}
+        except Exception as e:
+            # Without the allow-list the agent keeps its data and retries
+            self.agent.log(f"Relay cannot verify tokens: {e}", logging.WARNING)
+            return 503, {'msg': 'Relay cannot verify tokens'}, {'Retry-After': '60'}
+        return None
+
+    def handle(self, method, path, token, body, etag=None):
+        """Route one request that authorize() let through; returns (status, JSON body or bytes, extra headers)"""
+        endpoint = path.split('?', 1)[0][len(RELAY_API_PREFIX):]
+        self.stats[endpoint] += 1
+        
+        if endpoint == 'logs' and method == 'POST':
+            payload = json.loads(body or b'{}')
+            if payload.get('totalUploadMB') is None or payload.get('totalDownloadMB') is None:
+                return 400, {'msg': 'Upload and download data are required'}, {}
+            with self.lock:
+                if token not in self.pending and len(self.pending) >= RELAY_MAX_AGENTS:
+                    return 503, {'msg': 'Relay is full'}, {'Retry-After': str(RELAY_FLUSH_SECONDS)}
+                merged = self.pending.get(token)
+                self.pending[token] = merge_upload(merged, payload) if merged else payload
+                self.alive.add(token)
+            return 201, {'success': True, 'message': 'Network data accepted by relay'}, {}
+        if endpoint == 'heartbeat' and method == 'POST':
+            with self.lock:
+                self.alive.add(token)
+            return 200, {'success': True, 'message': 'Heartbeat received'}, {}
+        if endpoint == 'resolve' and method == 'POST':
+            ips = json.loads(body or b'{}').get('ips', [])[:RELAY_RESOLVE_MAX_IPS]
+            with self.resolve_lock:
+                labels = {ip: self.agent.resolve_ip_to_domain(ip) for ip in ips}
+            return 200, {'labels': labels}, {}
+        if endpoint == 'rules' and method == 'GET':
+            with self.rules_lock:
+                return self.rules(etag)
+        if endpoint == 'commands' and method == 'GET':
+            return self.proxy_commands(token, path)
+        return 404, {'msg': 'Not found'}, {}
+
+    def proxy_commands(self, token, path):
+        """Hold an agent's command long-poll open upstream with the agent's own token"""
+        query = dict(part.split('=', 1) for part in path.partition('?')[2].split('&') if '=' in part)
+        wait = min(int(query['wait']) if query.get('wait', '').isdigit() else 0, COMMAND_POLL_SECONDS * 2)
+        try:
+            if self.poll_session is None:
+                import requests
+                self.poll_session = requests.Session()
+                self.poll_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=RELAY_POLL_POOL))
+                self.poll_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=RELAY_POLL_POOL))
+            response = self.poll_session.get(f"{self.agent.backend_url}/network-monitoring/commands?wait={wait}",
+                                             headers={'Authorization': f'Bearer {token}'},
+                                             timeout=wait + 30, verify=True)
+        except Exception as e:
+            self.agent.log(f"Relay command poll failed: {e}", logging.DEBUG)
+            return 502, {'msg': 'Relay cannot reach the backend'}, {}
+        if response.status_code == 200:
+            try:
+                commands = response.json().get('commands', [])
+            except ValueError:
+                commands = []
+            if any(command.get('type') == 'rules' for command in commands):
+                with self.rules_lock:
+                    if self.rules_bundle:
+                        self.rules_bundle = (self.rules_bundle[0], self.rules_bundle[1], float('-inf'))
+        return response.status_code, response.content, {}
+
+    def rules(self, etag):
+        """The backend's rules bundle, fetched at most once per RULES_INTERVAL for the whole LAN"""
+        bundle = self.rules_bundle
+        if bundle is None or time.monotonic() - bundle[2] > RULES_INTERVAL:
+            headers = {'If-None-Match': bundle[0]} if bundle else {}
+            response = self.agent.get_from_backend('rules', headers)
+            if response.status_code == 200:
+                bundle = (response.headers.get('ETag'), response.content, time.monotonic())
+            elif response.status_code == 304 and bundle:
+                bundle = (bundle[0], bundle[1], time.monotonic())
+            else:
+                return response.status_code, {'msg': 'Rules unavailable'}, {}
+            self.rules_bundle = bundle
+        extra = {'ETag': bundle[0]} if bundle[0] else {}
+        if etag and etag == bundle[0]:
+            return 304, b'', extra
+        return 200, bundle[1], extra
+
+    def flush(self):
+        """Forward everything merged since the last flush in one compressed request"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            alive, self.alive = self.alive, set()
+        if not pending and not alive:
+            return True
+        
+        # Chunked so one request stays well under the backend's 10 MB JSON body limit
+        tokens = list(pending)
+        heartbeats = sorted(alive - set(pending))
+        while tokens or heartbeats:
+            chunk, tokens = tokens[:RELAY_BULK_BATCH], tokens[RELAY_BULK_BATCH:]
+            body = {'batches': [{'token': token, 'payload': pending[token]} for token in chunk],
+                    'alive': heartbeats}
+            try:
+                if self.agent.session is None:
+                    import requests
+                    self.agent.session = requests.Session()
+                response = self.agent.session.post(
+                    f"{self.agent.backend_url}/network-monitoring/logs/bulk",
+                    data=gzip.compress(json.dumps(body).encode(), 6),
+                    headers={'Authorization': f'Bearer {self.agent.agent_token}',
+                             'Content-Type': 'application/json', 'Content-Encoding': 'gzip'},
+                    timeout=60)
+                if response.status_code not in (200, 201):
+                    raise ConnectionError(f"HTTP {response.status_code}")
+            except Exception as e:
+                self.agent.log(f"Relay flush failed: {e}", logging.WARNING)
+                break
+            for token in chunk:
+                del pending[token]
+            heartbeats = []
+            self.stats['flushed'] += len(chunk)
+        else:
+            return True
+        
+        # Keep the rest for the next flush, merged with whatever arrived meanwhile
+        with self.lock:
+            for token, payload in pending.items():
+                newer = self.pending.get(token)
+                self.pending[token] = merge_upload(payload, newer) if newer else payload
+            self.alive |= alive
+        return False
+
+    def start(self):
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((self.host, self.port), relay_handler())
+        self.server.daemon_threads = True
+        if self.certfile:
+            import ssl
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True,
+                                                     do_handshake_on_connect=False)
+        self.server.relay = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="itmonitor-relay", daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def serve_forever(self, stop_event):
+        """Serve and flush every RELAY_FLUSH_SECONDS until stop_event is set, then flush once more"""
+        self.start()
+        self.agent.log(f"Relay listening on {self.host}:{self.port}, forwarding to {self.agent.backend_url}")
+        try:
+            while not stop_event.wait(RELAY_FLUSH_SECONDS):
+                self.flush()
+                with self.resolve_lock:
+                    self.agent.apply_seeds()
+        finally:
+            self.stop()
+            self.flush()
+
+def get_cli_option(name, default=None):
+    """Value following a --name option on the command line"""
+    if name in sys.argv:
+        index = sys.argv.index(name)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+    return default
+
+def load_harness():
+    """agent_harness, for the diagnostic commands; imported on demand like the other heavy modules"""
+    # Run as a script this module is __main__; the harness must get this copy, not a second import
+    sys.modules.setdefault('network_monitor_agent', sys.modules[__name__])
+    import agent_harness
+    return agent_harness
 
 def main():
     """Main entry point"""
-    agent = NetworkMonitorAgent()
-    
     # Check for command line arguments
     if len(sys.argv) > 1:
         command = sys.argv[1].lower()
         
+        # register and status only touch the config file: no agent, logging or network
         if command == 'register' and len(sys.argv) > 2:
             # Register with token
-            token = sys.argv[2]
-            agent.set_token(token)
+            config = register_agent(sys.argv[2])
             print(f"Agent registered successfully!")
-            print(f"System ID: {agent.system_id}")
-            print(f"System Name: {agent.system_name}")
+            print(f"System ID: {config['system_id']}")
+            print(f"System Name: {config['system_name']}")
             return
         
         elif command == 'status':
-            print(f"System ID: {agent.system_id}")
-            print(f"System Name: {agent.system_name}")
-            print(f"Token Configured: {'Yes' if agent.agent_token else 'No'}")
+            config = read_config()
+            print(f"System ID: {config.get('system_id')}")
+            print(f"System Name: {config.get('system_name')}")
+            print(f"Token Configured: {'Yes' if config.get('agent_token') else 'No'}")
             print(f"Version: {AGENT_VERSION}")
+            for line in status_lines(read_status()):
+                print(line)
             return
         
         elif command == 'test':
             print("Running in test mode (60 seconds)...")
-            agent.run()
+            NetworkMonitorAgent().run()
             return
-    
-    # Run the agent
+        
+        elif command == 'record':
+            # record [--seconds N] [--output recording.jsonl.gz]
+            seconds = float(get_cli_option('--seconds', 300))
+            output = get_cli_option('--output', 'recording.jsonl.gz')
+            print(f"Recording collector inputs for {seconds:g} seconds...")
+            load_harness().record_agent(seconds, output)
+            return
+        
+        elif command == 'replay':
+            # replay --input recording.jsonl.gz [--output uploads.jsonl]
+            load_harness().replay_agent(get_cli_option('--input', 'recording.jsonl.gz'), get_cli_option('--output'))
+            return
+        
+        elif command == 'replay-diff' and len(sys.argv) > 3:
+            # replay-diff before.jsonl after.jsonl
+            sys.exit(0 if load_harness().diff_replays(sys.argv[2], sys.argv[3]) else 1)
+        
+        elif command == 'soak':
+            # soak [--days N] [--warmup-hours H]: simulated run against fake collectors, exit code 1 on growth
+            harness = load_harness()
+            days = float(get_cli_option('--days', 7))
+            warmup_hours = float(get_cli_option('--warmup-hours', harness.SOAK_WARMUP_HOURS))
+            if not os.environ.get('ITMONITOR_HOME'):
+                # Rerun against a scratch home so the soak neither reads nor writes the real config
+                import tempfile
+                import subprocess
+                with tempfile.TemporaryDirectory(prefix='itmonitor-soak-') as home:
+                    sys.exit(subprocess.call([sys.executable] + sys.argv, env=dict(os.environ, ITMONITOR_HOME=home)))
+            print(f"Soak test: {days:g} simulated days...")
+            sys.exit(0 if harness.soak_agent(days, warmup_hours=warmup_hours) else 1)
+        
+        elif command == 'profile':
+            # profile [--seconds N] [--trace trace.json]
+            seconds = float(get_cli_option('--seconds', 60))
+            print(f"Profiling agent pipeline for {seconds:g} seconds...")
+            load_harness().profile_agent(NetworkMonitorAgent(), seconds, get_cli_option('--trace'))
+            return
+        
+        elif command == 'relay':
+            # relay --cert relay.pem [--key relay.key] [--port 5002]: accept LAN agents' uploads
+            # and forward them upstream merged; agents send their tokens, so only over TLS
+            certfile = get_cli_option('--cert')
+            if not certfile:
+                print("relay needs --cert (PEM certificate chain, and --key unless the key is in it)")
+                sys.exit(1)
+            agent = NetworkMonitorAgent()
+            agent.relay_url = None  # the relay itself always talks to the backend
+            agent.is_running = True
+            relay = RelayServer(agent, port=int(get_cli_option('--port', RELAY_PORT)),
+                                certfile=certfile, keyfile=get_cli_option('--key'))
+            if agent.service_seeding:
+                server = agent.dns_server or system_nameserver()
+                agent.seeder = ServiceSeeder(agent.seed_names(), DnsResolver(server) if server else SystemResolver())
+                threading.Thread(target=agent.seeding_loop, args=(_WorkerLease('seeder'),), daemon=True).start()
+            print(f"Relay listening on port {relay.port} (https), forwarding to {agent.backend_url}")
+            try:
+                relay.serve_forever(agent.stop_event)
+            except KeyboardInterrupt:
+                agent.stop()
+            return
+        
+        elif command == 'relaunch' and len(sys.argv) > 3:
+            # relaunch <pid> <command...>: restart_process's helper, runs command once pid has exited
+            import subprocess
+            wait_for_exit(int(sys.argv[2]))
+            sys.exit(subprocess.call(sys.argv[3:]))
+        
+        elif command == 'capture':
+            # capture --pcap capture.pcap: print the names it teaches (DNS answers, SNI / Host)
+            source = PcapSource(get_cli_option('--pcap', 'capture.pcap'))
+            table = PassiveDnsTable()
+            flows = []
+            now = time.monotonic()
+            while source.file:
+                for record in source.drain():
+                    if record[0] == 'dns':
+                        answer = parse_dns_answers(record[1])
+                        for ip, ttl in (answer[1] if answer else []):
+                            table.learn(ip, answer[0], ttl, now)
+                    elif parse_server_name(record[3]):
+                        flows.append((record[1], record[2], parse_server_name(record[3])))
+            for ip, (name, expires) in sorted(table.entries.items()):
+                print(f"{ip:<40} {name} (ttl {expires - now:.0f}s)")
+            for local, remote, name in flows:
+                print(f"{local} -> {remote:<40} {name}")
+            print(f"{len(table.entries)} addresses and {len(flows)} flow names from {source.packets} packets")
+            return
+
+    # Run the agent; after an update (or a rollback) start again on the installed files
+    agent = NetworkMonitorAgent()
     agent.run()
+    if agent.restart_requested:
+        restart_process()
 
 if __name__ == "__main__":
     main()
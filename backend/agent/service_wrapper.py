@@ -27,16 +27,19 @@ logging.basicConfig(
 )
 
 try:
-    from network_monitor_agent import NetworkMonitorAgent
+    from network_monitor_agent import (NetworkMonitorAgent, read_status, status_lines, restart_process,
+                                      python_executable, STATUS_FILE)
 except ImportError as e:
     logging.error(f"Failed to import NetworkMonitorAgent: {e}")
     # Fallback: try to import from current directory
     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
     try:
-        from network_monitor_agent import NetworkMonitorAgent
+        from network_monitor_agent import (NetworkMonitorAgent, read_status, status_lines, restart_process,
+                                          python_executable, STATUS_FILE)
     except ImportError:
         logging.error("NetworkMonitorAgent not found in any path")
         NetworkMonitorAgent = None
+        read_status = None
 
 class ITNetworkMonitorService(win32serviceutil.ServiceFramework):
     _svc_name_ = "ITNetworkMonitor"
@@ -82,36 +85,32 @@ class ITNetworkMonitorService(win32serviceutil.ServiceFramework):
             logging.info("Creating NetworkMonitorAgent instance")
             self.agent = NetworkMonitorAgent()
             
-            # Override the agent's log method to also log to service log
-            original_log = self.agent.log
-            def service_log(message):
-                original_log(message)
-                logging.info(message)
-            self.agent.log = service_log
-            
+            # service.log only has the wrapper's own lifecycle messages; the agent
+            # writes its rotated agent.log
             logging.info("Starting agent main loop")
             
-            # Run the agent in a loop with error recovery
+            # Stalled or crashed workers are restarted by the agent's own watchdog;
+            # this loop only covers run() itself failing, and keeps the same agent
+            # so pending stats and caches survive the restart
             while self.is_running:
                 try:
                     self.agent.run()
+                    if self.agent.restart_requested and self.is_running:
+                        # The agent installed an update (or rolled one back); the
+                        # agent's relaunch helper starts the service again once this
+                        # process has exited
+                        logging.info("Agent files changed, restarting the service")
+                        restart_process([python_executable(), os.path.abspath(__file__), 'start'])
                     break  # If run() completes normally, exit the loop
                 except Exception as agent_error:
                     error_msg = f"Agent error: {agent_error}"
                     logging.error(error_msg)
                     servicemanager.LogErrorMsg(error_msg)
                     
-                    # Wait before retrying
-                    logging.info("Waiting 30 seconds before retrying...")
-                    time.sleep(30)
-                    
-                    # Reset the agent
-                    try:
-                        self.agent = NetworkMonitorAgent()
-                        self.agent.log = service_log
-                    except Exception as reset_error:
-                        logging.error(f"Failed to reset agent: {reset_error}")
-                        break
+                    # Wait before retrying (returns early if the service is stopped)
+                    logging.info("Waiting 5 seconds before retrying...")
+                    win32event.WaitForSingleObject(self.stop_event, 5000)
+                    self.agent.is_running = self.is_running
             
         except Exception as e:
             error_msg = f"Service error: {e}"
@@ -181,6 +180,11 @@ def service_status():
             win32service.SERVICE_PAUSED: "Paused"
         }
         print(f"Service Status: {status_map.get(status[1], 'Unknown')}")
+        
+        # Live agent status from the machine-wide memory-mapped status file (no network, no agent)
+        if read_status is not None:
+            for line in status_lines(read_status(STATUS_FILE)):
+                print(line)
         return status[1] == win32service.SERVICE_RUNNING
     except Exception as e:
         print(f"✗ Failed to check service status: {e}")
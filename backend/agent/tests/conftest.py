@@ -0,0 +1,13 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+# Keep the agent's config, log, caches and status record out of ~/.it_monitor and
+# %ProgramData%; the module reads ITMONITOR_HOME when it computes those paths
+os.environ['ITMONITOR_HOME'] = tempfile.mkdtemp(prefix='itmonitor-tests-')
+atexit.register(shutil.rmtree, os.environ['ITMONITOR_HOME'], ignore_errors=True)
+
+# The agent is a single script rather than a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,70 @@
+"""Validation of settings pushed with a config command"""
+
+import os
+import logging
+
+import pytest
+
+from network_monitor_agent import PUSHED_CONFIG_KEYS, pushed_config_value
+
+@pytest.mark.parametrize('key, value, expected', [
+    ('update_interval', 30, 30),
+    ('update_interval', '30', 30),
+    ('update_interval', 30.0, 30),
+    ('cpu_budget_percent', 2, 2.0),
+    ('cpu_budget_percent', '1.5', 1.5),
+    ('log_level', 'debug', 'DEBUG'),
+    ('metrics_port', None, None),
+    ('metrics_port', 9464, 9464),
+    ('auto_update', False, False),
+    ('relay_url', 'https://relay.branch.lan:5002/api', 'https://relay.branch.lan:5002/api'),
+    ('udp_heartbeat', 'collector.example.com:5003', 'collector.example.com:5003'),
+])
+def test_valid_values_coerced(key, value, expected):
+    result = pushed_config_value(key, value)
+    assert result == expected and type(result) is type(expected)
+
+@pytest.mark.parametrize('key, value', [
+    ('update_interval', 0),
+    ('update_interval', 10.5),
+    ('update_interval', 'soon'),
+    ('update_interval', None),
+    ('update_interval', True),
+    ('update_interval', [10]),
+    ('update_interval', float('inf')),
+    ('cpu_budget_percent', float('nan')),
+    ('cpu_budget_percent', 1000),
+    ('rss_budget_mb', -1),
+    ('metrics_port', 80),
+    ('log_level', 'TRACE'),
+    ('log_level', None),
+    ('auto_update', 'false'),
+    ('service_seeding', 1),
+    ('dns_server', 8.8),
+    ('dns_server', ''),
+    ('relay_url', 'http://relay.branch.lan:5002/api'),
+    ('udp_heartbeat', 'collector.example.com'),
+])
+def test_invalid_values_rejected(key, value):
+    with pytest.raises(ValueError):
+        pushed_config_value(key, value)
+
+def test_every_pushed_key_has_a_rule():
+    for key, rule in PUSHED_CONFIG_KEYS.items():
+        assert rule in (bool, str) or isinstance(rule, list) or (len(rule) == 3 and rule[1] < rule[2]), key
+
+def test_one_bad_value_rejects_the_whole_command():
+    pytest.importorskip('psutil')
+    from network_monitor_agent import CONFIG_FILE, NetworkMonitorAgent
+    agent = NetworkMonitorAgent()
+    before = (agent.update_interval, agent.cpu_budget_percent, agent.governor.cpu_budget_percent)
+    agent.apply_pushed_config({'update_interval': 30, 'cpu_budget_percent': 'lots'})
+    assert (agent.update_interval, agent.cpu_budget_percent, agent.governor.cpu_budget_percent) == before
+    assert not os.path.exists(CONFIG_FILE)
+    
+    try:
+        agent.apply_pushed_config({'update_interval': '30', 'cpu_budget_percent': 5, 'log_level': 'warning'})
+        assert (agent.update_interval, agent.governor.cpu_budget_percent, agent.log_level) == (30, 5.0, 'WARNING')
+        assert agent.logger.level == logging.WARNING
+    finally:
+        os.remove(CONFIG_FILE)
@@ -0,0 +1,34 @@
+"""Harness runs of the live agent stay offline and leave the installation alone"""
+
+import os
+import json
+
+import pytest
+
+pytest.importorskip('psutil')
+
+from network_monitor_agent import AGENT_VERSION, UPDATE_MAX_UNCONFIRMED_STARTS, UPDATE_STATE_FILE, NetworkMonitorAgent
+from agent_harness import CaptureSession, run_offline
+
+def test_offline_run_sends_nothing_and_installs_nothing():
+    # An unconfirmed update on its last allowed start: a normal start would roll it back
+    state = {'status': 'pending', 'version': AGENT_VERSION, 'starts': UPDATE_MAX_UNCONFIRMED_STARTS}
+    with open(UPDATE_STATE_FILE, 'w') as f:
+        json.dump(state, f)
+    try:
+        agent = NetworkMonitorAgent()
+        agent.update_interval = 1
+        calls = []
+        agent.check_for_update = lambda lease=None: calls.append('update')
+        agent.poll_commands = lambda: calls.append('commands')
+        agent.fetch_rules = lambda: calls.append('rules')
+        run_offline(agent, 2.5)
+
+        assert calls == []
+        assert isinstance(agent.session, CaptureSession)
+        assert agent.session.payloads  # uploads were built and kept
+        assert not agent.restart_requested
+        with open(UPDATE_STATE_FILE) as f:
+            assert json.load(f) == state
+    finally:
+        os.remove(UPDATE_STATE_FILE)
@@ -0,0 +1,95 @@
+"""Signed UDP heartbeats: datagram format and the reference receiver's replay checks"""
+
+import time
+
+import pytest
+
+from network_monitor_agent import (UDP_HEARTBEAT_MAX_SKEW, heartbeat_key, pack_heartbeat, unpack_heartbeat,
+                                   pack_heartbeat_ack, is_heartbeat_ack)
+from heartbeat_receiver import HeartbeatReceiver
+
+KEY = heartbeat_key('token-a')
+KEYS = {'sys-a': KEY}
+
+class Transport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+def test_heartbeat_round_trip():
+    packet = pack_heartbeat(KEY, 'sys-a', 7, 1700000000.25, 4096)
+    assert unpack_heartbeat(packet, KEYS.get) == ('sys-a', 7, 1700000000.25, 4096, KEY)
+
+def flip(packet, index):
+    return packet[:index] + bytes([packet[index] ^ 1]) + packet[index + 1:]
+
+PACKET = pack_heartbeat(KEY, 'sys-a', 7, 1700000000.25, 4096)
+
+@pytest.mark.parametrize('packet', [
+    b'',
+    PACKET[:10],
+    PACKET[:-1],
+    PACKET + b'\x00',
+    flip(PACKET, 0),  # magic
+    flip(PACKET, 4),  # version
+    flip(PACKET, 8),  # sequence
+    flip(PACKET, 15),  # timestamp
+    flip(PACKET, 30),  # system id
+    flip(PACKET, len(PACKET) - 1),  # MAC
+    pack_heartbeat(heartbeat_key('token-b'), 'sys-a', 7, 1700000000.25, 4096),  # another system's key
+    pack_heartbeat(KEY, 'sys-unknown', 7, 1700000000.25, 4096),
+], ids=lambda packet: f"{len(packet)}-bytes")
+def test_forged_or_damaged_heartbeat_rejected(packet):
+    assert unpack_heartbeat(packet, KEYS.get) is None
+
+def test_ack_is_bound_to_key_and_sequence():
+    ack = pack_heartbeat_ack(KEY, 7)
+    assert is_heartbeat_ack(ack, KEY, 7)
+    assert not is_heartbeat_ack(ack, KEY, 8)
+    assert not is_heartbeat_ack(ack, heartbeat_key('token-b'), 7)
+    assert not is_heartbeat_ack(ack[:-1], KEY, 7)
+
+@pytest.fixture
+def receiver():
+    receiver = HeartbeatReceiver(keys={'sys-a': 'token-a'})
+    receiver.transport = Transport()
+    return receiver
+
+def deliver(receiver, sequence, timestamp):
+    receiver.transport.sent = []
+    receiver.datagram_received(pack_heartbeat(KEY, 'sys-a', sequence, timestamp, 0), ('10.0.0.5', 40000))
+    return [data for data, _ in receiver.transport.sent]
+
+def test_receiver_accepts_and_acknowledges(receiver):
+    now = time.time()
+    assert deliver(receiver, 1, now) == [pack_heartbeat_ack(KEY, 1)]
+    assert receiver.last_seen['sys-a'][1:] == (1, 0, '10.0.0.5')
+    assert receiver.counts['accepted'] == 1
+
+def test_retransmission_acknowledged_again_but_not_counted(receiver):
+    now = time.time()
+    deliver(receiver, 1, now)
+    assert deliver(receiver, 1, now) == [pack_heartbeat_ack(KEY, 1)]
+    assert (receiver.counts['accepted'], receiver.counts['duplicate']) == (1, 1)
+
+def test_replayed_heartbeat_dropped(receiver):
+    now = time.time()
+    deliver(receiver, 1, now - 10)
+    deliver(receiver, 2, now)
+    assert deliver(receiver, 1, now - 10) == []
+    assert receiver.last_seen['sys-a'][1] == 2
+    assert receiver.counts['replayed'] == 1
+
+@pytest.mark.parametrize('skew', [UDP_HEARTBEAT_MAX_SKEW + 5, -UDP_HEARTBEAT_MAX_SKEW - 5])
+def test_heartbeat_outside_clock_skew_dropped(receiver, skew):
+    assert deliver(receiver, 1, time.time() + skew) == []
+    assert 'sys-a' not in receiver.last_seen
+    assert receiver.counts['stale'] == 1
+
+def test_forged_heartbeat_not_acknowledged(receiver):
+    packet = pack_heartbeat(heartbeat_key('token-b'), 'sys-a', 1, time.time(), 0)
+    receiver.datagram_received(packet, ('10.0.0.6', 40000))
+    assert receiver.transport.sent == []
+    assert receiver.counts['rejected'] == 1
@@ -0,0 +1,39 @@
+"""Age-based rotation of the agent log survives agent restarts"""
+
+import gzip
+import logging
+import os
+import time
+
+from network_monitor_agent import CompressingRotatingFileHandler
+
+def record(message):
+    return logging.LogRecord('itmonitor', logging.INFO, __file__, 0, message, None, None)
+
+def test_age_counts_from_last_rollover_not_from_start(tmp_path):
+    log_file = str(tmp_path / 'agent.log')
+    handler = CompressingRotatingFileHandler(log_file, rotate_seconds=3600)
+    handler.emit(record('before restart'))
+    handler.close()
+    # The last rollover was two hours ago; a restart now must not reset the clock
+    with gzip.open(log_file + '.1.gz', 'wb'):
+        pass
+    two_hours_ago = time.time() - 7200
+    os.utime(log_file + '.1.gz', (two_hours_ago, two_hours_ago))
+    
+    handler = CompressingRotatingFileHandler(log_file, rotate_seconds=3600)
+    try:
+        assert handler.shouldRollover(record('after restart'))
+        handler.emit(record('after restart'))
+        assert not handler.shouldRollover(record('next'))
+    finally:
+        handler.close()
+    with gzip.open(log_file + '.1.gz', 'rt', encoding='utf-8') as f:
+        assert 'before restart' in f.read()
+
+def test_new_log_not_rotated_at_once(tmp_path):
+    handler = CompressingRotatingFileHandler(str(tmp_path / 'agent.log'), rotate_seconds=3600)
+    try:
+        assert not handler.shouldRollover(record('first'))
+    finally:
+        handler.close()
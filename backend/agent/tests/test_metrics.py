@@ -0,0 +1,52 @@
+"""Prometheus text rendering of the self-metrics endpoint"""
+
+import pytest
+
+from network_monitor_agent import escape_metric_text
+
+def test_label_values_escaped():
+    assert escape_metric_text('C:\\Temp') == 'C:\\\\Temp'
+    assert escape_metric_text('say "hi"') == 'say \\"hi\\"'
+    assert escape_metric_text('two\nlines') == 'two\\nlines'
+
+def test_help_text_keeps_quotes():
+    assert escape_metric_text('a "b"\\\n', quotes=False) == 'a "b"\\\\\\n'
+
+def test_render_escapes_labels():
+    pytest.importorskip('psutil')
+    from network_monitor_agent import MetricsExporter
+    exporter = MetricsExporter(0)
+    exporter.publish([('itmonitor_label_bytes', 'gauge', 'Pending bytes\nper label',
+                       [('', {'label': 'evil"}\nitmonitor_fake 1', 'path': 'C:\\x'}, 10)])])
+    lines = exporter.render().splitlines()
+    assert '# HELP itmonitor_label_bytes Pending bytes\\nper label' in lines
+    assert 'itmonitor_label_bytes{label="evil\\"}\\nitmonitor_fake 1",path="C:\\\\x"} 10' in lines
+    assert not any(line.startswith('itmonitor_fake') for line in lines)
+
+def test_request_metrics_split_by_method_and_skip_long_polls():
+    pytest.importorskip('psutil')
+    from network_monitor_agent import NetworkMonitorAgent
+    from agent_harness import CaptureSession
+    
+    class Session(CaptureSession):
+        def get(self, url, **kwargs):
+            return self.post(url, **kwargs)
+    
+    agent = NetworkMonitorAgent()
+    agent.session = Session()
+    agent.agent_token = 'test'
+    agent.post_to_backend('logs', {})
+    agent.get_from_backend('commands?wait=240', timeout=270, long_poll=True)
+    agent.get_from_backend('commands?wait=120', timeout=150, long_poll=True)
+    
+    posts = agent.endpoint_stats[('POST', 'logs', agent.backend_url)]
+    polls = agent.endpoint_stats[('GET', 'commands', agent.backend_url)]
+    assert (posts['requests'], posts['latency'].count) == (1, 1)
+    assert (polls['requests'], polls['latency'].count) == (2, 0)
+    
+    families = {name: samples for name, _, _, samples in agent.collect_metric_families()}
+    latency_endpoints = {labels['endpoint'] for _, labels, _ in families['itmonitor_backend_request_latency_seconds']}
+    assert latency_endpoints == {'logs'}
+    assert {(labels['method'], labels['endpoint'], value)
+            for _, labels, value in families['itmonitor_backend_requests_total']} == {('POST', 'logs', 1),
+                                                                                     ('GET', 'commands', 2)}
@@ -0,0 +1,109 @@
+"""DNS answer and SNI / Host parsing of captured packets, including malformed input"""
+
+import struct
+
+import pytest
+
+from network_monitor_agent import parse_dns_answers, parse_server_name
+
+def dns_name(name):
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00'
+
+def dns_response(name='example.com', answers=((1, b'\x5d\xb8\xd8\x22', 300),), flags=0x8180, questions=1,
+                 count=None):
+    """Response to an A query for name; answer owners are a pointer to the question name"""
+    message = struct.pack('!HHHHHH', 0x1234, flags, questions, len(answers) if count is None else count, 0, 0)
+    message += dns_name(name) + struct.pack('!HH', 1, 1)
+    for rtype, data, ttl in answers:
+        message += b'\xc0\x0c' + struct.pack('!HHIH', rtype, 1, ttl, len(data)) + data
+    return message
+
+def client_hello(name='example.com', extensions=None):
+    """TLS 1.2 ClientHello record carrying name in a server_name extension"""
+    if extensions is None:
+        entry = b'\x00' + struct.pack('!H', len(name)) + name.encode()
+        server_name = struct.pack('!H', len(entry)) + entry
+        extensions = struct.pack('!HH', 0x0a, 4) + b'\x00\x02\x00\x1d'  # supported_groups first
+        extensions += struct.pack('!HH', 0, len(server_name)) + server_name
+    body = b'\x03\x03' + bytes(32) + b'\x00' + b'\x00\x02\x13\x01' + b'\x01\x00'
+    body += struct.pack('!H', len(extensions)) + extensions
+    handshake = b'\x01' + len(body).to_bytes(3, 'big') + body
+    return b'\x16\x03\x01' + struct.pack('!H', len(handshake)) + handshake
+
+def test_dns_answer_parsed():
+    assert parse_dns_answers(dns_response()) == ('example.com', [('93.184.216.34', 300)])
+
+def test_dns_cname_chain_attributed_to_queried_name():
+    cname = b'\xc0\x0c' + struct.pack('!HHIH', 5, 1, 60, 2) + b'\xc0\x0c'
+    message = dns_response(answers=((28, bytes(15) + b'\x01', 120),), count=2)
+    message = message[:29] + cname + message[29:]
+    assert parse_dns_answers(message) == ('example.com', [('::1', 120)])
+
+def test_sni_parsed():
+    assert parse_server_name(client_hello('Api.Example.COM')) == 'api.example.com'
+
+def test_http_host_parsed():
+    assert parse_server_name(b'GET / HTTP/1.1\r\nHost: example.com:8080\r\n\r\n') == 'example.com'
+
+def self_pointer():
+    # The question name is a compression pointer to itself
+    return struct.pack('!HHHHHH', 1, 0x8180, 1, 1, 0, 0) + b'\xc0\x0c' + bytes(4)
+
+def pointer_pair():
+    # Two pointers that point at each other
+    return struct.pack('!HHHHHH', 1, 0x8180, 1, 1, 0, 0) + b'\xc0\x0e\xc0\x0c' + bytes(4)
+
+@pytest.mark.parametrize('message', [
+    b'',
+    b'\x12\x34',
+    dns_response()[:11],  # truncated header
+    dns_response(flags=0x0100),  # a query, not a response
+    dns_response(flags=0x8183),  # NXDOMAIN
+    dns_response(questions=0),
+    dns_response(answers=()),
+    self_pointer(),
+    pointer_pair(),
+    dns_response()[:12] + b'\x3f' + b'a' * 10,  # question label runs past the end
+    dns_response()[:-6],  # answer record cut inside its data
+    dns_response()[:-12],  # answer record cut inside its header
+    dns_response(count=500),  # more answers than the message holds
+    dns_response(answers=((1, b'\x01\x02', 300),)),  # A record with a 2-byte address
+    dns_response(answers=((5, b'\xc0\x0c', 300),)),  # only a CNAME
+    dns_response()[:-16] + b'\xc0\xff' + dns_response()[-14:],  # answer owner points past the end
+    dns_response()[:12] + b'\x80' + dns_response()[13:],  # reserved label type
+], ids=lambda message: f"{len(message)}-bytes")
+def test_malformed_dns_returns_none(message):
+    assert parse_dns_answers(message) is None
+
+def extension(kind, data, declared=None):
+    return struct.pack('!HH', kind, len(data) if declared is None else declared) + data
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x16',
+    b'\x16\x03\x01\x00',
+    client_hello()[:40],  # cut inside the random
+    client_hello()[:60],  # cut inside the extensions
+    client_hello()[:-3],  # cut inside the name
+    client_hello(extensions=b''),
+    client_hello(extensions=extension(0x0a, b'\x00\x02', declared=0xffff)),  # oversized extension length
+    client_hello(extensions=extension(0, b'\x00\x0e\x00\x00\x0bexample.com', declared=0xfff0)[:8]),
+    client_hello(extensions=extension(0, b'\x00\x0e\x01\x00\x0bexample.com')),  # not a host_name entry
+    client_hello(extensions=extension(0, b'\x00\x0e\x00\xff\xffexample.com')),  # name longer than the record
+    client_hello(extensions=extension(0, b'\x00\x03\x00\x00\x02\xff\xfe')),  # not ASCII
+    client_hello()[:43] + b'\xff' + client_hello()[44:],  # session id length past the end
+    client_hello()[:76] + b'\xff\xff' + client_hello()[78:],  # cipher suites length past the end
+    b'\x16\x03\x01\x00\x05\x02\x00\x00\x01\x00',  # ServerHello
+    b'GET / HTTP/1.1\r\nAccept: */*\r\n\r\n',  # no Host header
+    b'GET / HTTP/1.1\r\nHost: \xff\xfe\r\n\r\n',
+    b'GET / HTTP/1.1\r\nHost: [::1]:8080\r\n\r\n',
+    b'NOTAMETHOD / HTTP/1.1\r\nHost: example.com\r\n\r\n',
+    b'\x00' * 64,
+], ids=lambda data: f"{len(data)}-bytes")
+def test_malformed_server_names_return_none(data):
+    assert parse_server_name(data) is None
+
+def test_truncated_inputs_never_raise():
+    for parser, message in ((parse_dns_answers, dns_response()), (parse_server_name, client_hello())):
+        for length in range(len(message)):
+            assert parser(message[:length]) is None
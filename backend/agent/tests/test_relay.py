@@ -0,0 +1,170 @@
+"""Branch-office relay: upload merging, token checks and request body limits"""
+
+import os
+import ssl
+import gzip
+import json
+import shutil
+import logging
+import subprocess
+import http.client
+
+import pytest
+
+from network_monitor_agent import RELAY_MAX_BODY_BYTES, RateSketch, HyperLogLog, RelayServer, merge_upload
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+class Upstream:
+    """Stands in for the relay machine's agent: answers relay/verify from a token set"""
+
+    def __init__(self, valid=('good',), status=200):
+        self.valid = set(valid)
+        self.status = status
+        self.verified = []
+        self.backend_url = 'https://backend.invalid/api'
+        self.messages = []
+
+    def post_to_backend(self, endpoint, payload=None, timeout=10):
+        assert endpoint == 'relay/verify'
+        self.verified.extend(payload['tokens'])
+        if self.status != 200:
+            return Response(self.status, {'msg': 'Agent is not a relay'})
+        return Response(200, {'valid': [token in self.valid for token in payload['tokens']]})
+
+    def log(self, message, level=logging.INFO):
+        self.messages.append(message)
+
+def site(domain, upload, download, rates, ips):
+    sketch = RateSketch()
+    for rate in rates:
+        sketch.add(rate)
+    addresses = HyperLogLog()
+    for ip in ips:
+        addresses.add(ip)
+    return {'domain': domain, 'uploadMB': upload, 'downloadMB': download, 'dataUsedMB': upload + download,
+            'requestCount': 1, 'rateSketch': sketch.to_dict(), 'rateBps': sketch.summary(),
+            'destinationSketch': {'ips': addresses.to_string(), 'ports': HyperLogLog().to_string()}}
+
+def upload(*sites, version='1.0.0'):
+    return {'totalUploadMB': sum(s['uploadMB'] for s in sites), 'totalDownloadMB': sum(s['downloadMB'] for s in sites),
+            'websites': list(sites), 'agentVersion': version}
+
+def test_merge_upload_adds_counts_and_merges_sketches():
+    first = upload(site('a.com', 1.0, 2.0, [100] * 10, ['10.0.0.1', '10.0.0.2']), site('b.com', 0.5, 0.5, [5], []))
+    second = upload(site('a.com', 0.25, 0.5, [1000] * 30, ['10.0.0.2', '10.0.0.3']), version='1.0.1')
+    merged = merge_upload(first, second)
+    sites = {s['domain']: s for s in merged['websites']}
+
+    assert (merged['totalUploadMB'], merged['totalDownloadMB']) == (1.75, 3.0)
+    assert merged['agentVersion'] == '1.0.1'
+    assert (sites['a.com']['uploadMB'], sites['a.com']['downloadMB'], sites['a.com']['requestCount']) == (1.25, 2.5, 2)
+    assert RateSketch.from_dict(sites['a.com']['rateSketch']).count == 40
+    assert sites['a.com']['distinctRemoteIps'] == 3
+    assert sites['b.com']['uploadMB'] == 0.5
+
+@pytest.fixture
+def relay():
+    server = RelayServer(Upstream(), host='127.0.0.1', port=0)
+    server.start()
+    yield server
+    server.stop()
+
+def send(relay, body, token='good', headers=None, path='/api/network-monitoring/logs'):
+    connection = http.client.HTTPConnection('127.0.0.1', relay.port, timeout=10)
+    try:
+        connection.request('POST', path, body, dict({'Authorization': f'Bearer {token}'}, **(headers or {})))
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+    finally:
+        connection.close()
+
+def test_upload_from_allowed_token_is_merged(relay):
+    body = json.dumps(upload(site('a.com', 1.0, 1.0, [10], ['10.0.0.1']))).encode()
+    assert send(relay, gzip.compress(body), headers={'Content-Encoding': 'gzip'})[0] == 201
+    assert send(relay, body)[0] == 201
+    assert relay.pending['good']['totalUploadMB'] == 2.0
+
+def test_unknown_token_rejected_and_remembered(relay):
+    assert send(relay, b'{}', token='stolen')[0] == 401
+    assert send(relay, b'{}', token='stolen')[0] == 401
+    assert send(relay, b'{}', token='')[0] == 401
+    assert relay.agent.verified == ['stolen']
+    assert not relay.pending
+
+def test_relay_not_marked_by_an_admin_accepts_nothing(relay):
+    relay.agent.status = 403
+    assert send(relay, b'{}') == (503, {'msg': 'Relay cannot verify tokens'})
+    assert not relay.pending and not relay.allowed and not relay.denied
+    assert any('not marked this agent as a relay' in m for m in relay.agent.messages)
+
+def test_body_of_rejected_token_is_never_decoded(relay):
+    status, _ = send(relay, b'not gzip at all', token='stolen', headers={'Content-Encoding': 'gzip'})
+    assert status == 401
+
+def test_oversized_body_rejected_before_reading(relay):
+    connection = http.client.HTTPConnection('127.0.0.1', relay.port, timeout=10)
+    connection.putrequest('POST', '/api/network-monitoring/logs')
+    connection.putheader('Authorization', 'Bearer good')
+    connection.putheader('Content-Length', str(RELAY_MAX_BODY_BYTES + 1))
+    connection.endheaders()
+    assert connection.getresponse().status == 413
+    connection.close()
+
+def test_gzip_bomb_rejected(relay):
+    bomb = gzip.compress(b'0' * (RELAY_MAX_BODY_BYTES + 1024), 9)
+    assert len(bomb) < RELAY_MAX_BODY_BYTES // 100
+    assert send(relay, bomb, headers={'Content-Encoding': 'gzip'})[0] == 413
+
+def test_malformed_bodies_get_generic_errors(relay):
+    assert send(relay, b'\x1f\x8bgarbage', headers={'Content-Encoding': 'gzip'}) == (
+        400, {'msg': 'Malformed request body'})
+    assert send(relay, b'{not json')[0] == 400
+    status, response = send(relay, b'[]')
+    assert (status, response) == (500, {'msg': 'Relay error'})
+    assert any('Relay request POST /api/network-monitoring/logs failed' in m for m in relay.agent.messages)
+
+@pytest.fixture
+def certificate(tmp_path):
+    if not shutil.which('openssl'):
+        pytest.skip('openssl is needed to make a test certificate')
+    cert, key = str(tmp_path / 'relay.pem'), str(tmp_path / 'relay.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-keyout', key,
+                    '-out', cert, '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'],
+                   check=True, capture_output=True)
+    return cert, key
+
+def test_relay_serves_tls(certificate):
+    relay = RelayServer(Upstream(), host='127.0.0.1', port=0, certfile=certificate[0], keyfile=certificate[1])
+    relay.start()
+    try:
+        context = ssl.create_default_context(cafile=certificate[0])
+        connection = http.client.HTTPSConnection('127.0.0.1', relay.port, timeout=10, context=context)
+        connection.request('POST', '/api/network-monitoring/heartbeat', b'', {'Authorization': 'Bearer good'})
+        assert connection.getresponse().status == 200
+        connection.close()
+
+        # A plain-HTTP client never gets as far as sending its token in a readable request
+        with pytest.raises((http.client.HTTPException, ConnectionError)):
+            send(relay, b'{}')
+    finally:
+        relay.stop()
+
+def test_agent_refuses_plain_http_relay():
+    pytest.importorskip('psutil')
+    from network_monitor_agent import CONFIG_FILE, NetworkMonitorAgent
+    os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
+    with open(CONFIG_FILE, 'w') as f:
+        json.dump({'system_id': 'test', 'relay_url': 'http://relay.lan:5002/api'}, f)
+    try:
+        agent = NetworkMonitorAgent()
+        assert agent.relay_url is None
+        assert agent.backend_urls()[0] == agent.backend_url
+    finally:
+        os.remove(CONFIG_FILE)
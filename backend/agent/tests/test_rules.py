@@ -0,0 +1,94 @@
+"""Classification rules: compiled cache and conditional fetches from the backend"""
+
+import os
+import marshal
+
+import pytest
+
+from network_monitor_agent import RULES_FILE, RULES_CACHE_FORMAT, ClassificationRules
+
+BUNDLE = {'version': '7', 'domains': {'zoom.us': 'Zoom', 'slack.com': 'Slack'}, 'cdnDomains': ['cdn.example'],
+          'ipRanges': {'3.7.35.0/25': 'Zoom', '10.0.0.0/8': 'Private', '10.1.0.0/16': 'Example'}}
+
+class Response:
+    def __init__(self, status_code, body=None, etag=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'ETag': etag} if etag else {}
+
+    def json(self):
+        return self.body
+
+def test_compiled_rules_round_trip_through_the_cache(tmp_path):
+    path = str(tmp_path / 'rules.bin')
+    ClassificationRules.from_bundle(BUNDLE, '"v7"').save(path)
+    rules = ClassificationRules.load(path)
+    assert (rules.version, rules.etag, rules.domains) == ('7', '"v7"', BUNDLE['domains'])
+    assert rules.cdn_domains == {'cdn.example'}
+    assert rules.service_for_ip('3.7.35.100') == 'Zoom'
+    assert rules.service_for_ip('10.1.2.3') == 'Example'
+    assert rules.service_for_ip('10.2.0.1') == 'Private'
+    assert rules.service_for_ip('3.7.35.200') is None
+
+@pytest.mark.parametrize('contents', [
+    b'',
+    b'not marshal data',
+    marshal.dumps((RULES_CACHE_FORMAT + 1, '7', None, {}, (), (), [])),  # written by another agent version
+    marshal.dumps((RULES_CACHE_FORMAT, '7')),
+    marshal.dumps(None),
+])
+def test_unusable_cache_ignored(tmp_path, contents):
+    path = tmp_path / 'rules.bin'
+    path.write_bytes(contents)
+    assert ClassificationRules.load(str(path)) is None
+
+def test_missing_cache_ignored(tmp_path):
+    assert ClassificationRules.load(str(tmp_path / 'rules.bin')) is None
+
+@pytest.fixture
+def agent():
+    pytest.importorskip('psutil')
+    from network_monitor_agent import NetworkMonitorAgent
+    agent = NetworkMonitorAgent()
+    agent.requests = []
+    agent.responses = []
+
+    def get_from_backend(endpoint, headers=None, timeout=10, long_poll=False):
+        agent.requests.append((endpoint, headers))
+        return agent.responses.pop(0)
+    agent.get_from_backend = get_from_backend
+    yield agent
+    if os.path.exists(RULES_FILE):
+        os.remove(RULES_FILE)
+
+def test_new_bundle_fetched_cached_and_swapped_in(agent):
+    agent.responses = [Response(200, BUNDLE, '"v7"')]
+    assert agent.fetch_rules()
+    assert agent.requests == [('rules', {})]
+    assert agent.pending_rules.version == '7'
+    assert ClassificationRules.load().etag == '"v7"'
+
+    agent.domain_cache['3.7.35.100'] = ('stale', 0, 0)
+    agent.apply_rules(agent.pending_rules)
+    assert agent.domain_cache == {}
+    assert agent.resolve_ip_to_domain('3.7.35.100') != 'stale'
+
+def test_unchanged_bundle_not_downloaded_again(agent):
+    agent.apply_rules(ClassificationRules.from_bundle(BUNDLE, '"v7"'))
+    agent.responses = [Response(304)]
+    assert not agent.fetch_rules()
+    assert agent.requests == [('rules', {'If-None-Match': '"v7"'})]
+    assert agent.pending_rules is None
+    assert not os.path.exists(RULES_FILE)
+
+@pytest.mark.parametrize('response', [
+    Response(500),
+    Response(200, {'version': '8', 'domains': ['zoom.us']}, '"v8"'),
+    Response(200, {'version': '8', 'domains': {}, 'ipRanges': {'10.0.0.0/40': 'Bad'}}, '"v8"'),
+])
+def test_bad_bundle_keeps_current_rules(agent, response):
+    rules = agent.rules
+    agent.responses = [response]
+    assert not agent.fetch_rules()
+    assert agent.pending_rules is None and agent.rules is rules
+    assert not os.path.exists(RULES_FILE)
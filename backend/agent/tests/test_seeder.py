@@ -0,0 +1,189 @@
+"""ServiceSeeder scheduling against a stub resolver"""
+
+import threading
+
+import pytest
+
+from network_monitor_agent import (
+    SEED_BATCH, SEED_MIN_REFRESH, SEED_MAX_REFRESH, SEED_NEGATIVE_REFRESH, SEED_RETRY, SEED_POLL_MAX,
+    NetworkMonitorAgent, ServiceSeeder, ResourceGovernor, _WorkerLease
+)
+from agent_harness import VirtualClock
+
+class StubResolver:
+    """resolve(name) -> [(address, ttl)] from a table; raises for names mapped to an exception"""
+
+    def __init__(self, answers, delay=None):
+        self.answers = answers
+        self.calls = []
+        self.release = threading.Event()
+        if delay is None:
+            self.release.set()
+
+    def resolve(self, name):
+        self.calls.append(name)
+        self.release.wait()
+        answer = self.answers.get(name, [])
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+@pytest.fixture
+def seeder_for():
+    seeders = []
+
+    def make(answers, names=None, **kwargs):
+        resolver = StubResolver(answers, **kwargs)
+        seeder = ServiceSeeder(names if names is not None else list(answers), resolver)
+        seeders.append(seeder)
+        return seeder, resolver
+
+    yield make
+    for seeder in seeders:
+        seeder.close()
+
+def test_round_resolves_every_due_name(seeder_for):
+    seeder, resolver = seeder_for({
+        'example.com': [('93.184.216.34', 3600)],
+        'www.example.com': [('93.184.216.34', 3600), ('2606:2800:220:1::1', 1800)]
+    })
+    results = seeder.run_round(0.0)
+    assert sorted(resolver.calls) == ['example.com', 'www.example.com']
+    assert sorted(results) == [('2606:2800:220:1::1', 'www.example.com', 1800),
+                               ('93.184.216.34', 'example.com', 3600),
+                               ('93.184.216.34', 'www.example.com', 1800)]
+    assert seeder.schedule == {'example.com': 3600.0, 'www.example.com': 1800.0}
+    assert seeder.metrics() == {'names': 2, 'resolved': 2, 'failed': 0}
+
+def test_round_limited_to_batch(seeder_for):
+    names = [f"host{i}.example.com" for i in range(SEED_BATCH + 5)]
+    seeder, resolver = seeder_for({name: [('10.0.0.1', 3600)] for name in names})
+    seeder.run_round(0.0)
+    assert len(resolver.calls) == SEED_BATCH
+    seeder.run_round(0.0)
+    assert sorted(resolver.calls) == sorted(names)
+
+def test_ttl_clamped_and_expiry_reschedules(seeder_for):
+    seeder, resolver = seeder_for({
+        'short.example.com': [('10.0.0.1', 5)],
+        'long.example.com': [('10.0.0.2', 10 ** 6)]
+    })
+    results = seeder.run_round(0.0)
+    assert sorted(refresh for _, _, refresh in results) == [SEED_MIN_REFRESH, SEED_MAX_REFRESH]
+    assert seeder.next_due() == SEED_MIN_REFRESH
+    
+    resolver.calls.clear()
+    assert seeder.run_round(SEED_MIN_REFRESH - 1) == []
+    assert resolver.calls == []
+    seeder.run_round(SEED_MIN_REFRESH)
+    assert resolver.calls == ['short.example.com']
+    resolver.calls.clear()
+    seeder.run_round(SEED_MAX_REFRESH)
+    assert sorted(resolver.calls) == ['long.example.com', 'short.example.com']
+
+def test_negative_answer_retried_rarely(seeder_for):
+    seeder, _ = seeder_for({'gone.example.com': []})
+    assert seeder.run_round(0.0) == []
+    assert seeder.schedule['gone.example.com'] == SEED_NEGATIVE_REFRESH
+    assert seeder.metrics()['resolved'] == 1
+
+def test_failed_lookup_retried(seeder_for):
+    seeder, _ = seeder_for({'broken.example.com': OSError('timed out'), 'ok.example.com': [('10.0.0.1', 600)]})
+    results = seeder.run_round(100.0)
+    assert results == [('10.0.0.1', 'ok.example.com', 600)]
+    assert seeder.schedule['broken.example.com'] == 100.0 + SEED_RETRY
+    assert seeder.metrics()['failed'] == 1
+
+def test_slow_lookup_abandoned_for_the_round(seeder_for):
+    seeder, resolver = seeder_for({'slow.example.com': [('10.0.0.1', 600)]}, delay=True)
+    assert seeder.run_round(0.0, timeout=0.05) == []
+    assert seeder.schedule['slow.example.com'] == SEED_RETRY
+    resolver.release.set()
+
+def test_set_names_keeps_schedule(seeder_for):
+    seeder, _ = seeder_for({'a.example.com': [('10.0.0.1', 900)]})
+    seeder.run_round(0.0)
+    seeder.set_names(['a.example.com', 'b.example.com'])
+    assert seeder.schedule == {'a.example.com': 900.0, 'b.example.com': 0.0}
+
+def test_close_shuts_down_pool(seeder_for):
+    seeder, _ = seeder_for({'a.example.com': [('10.0.0.1', 900)]})
+    seeder.run_round(0.0)
+    threads = list(seeder.pool._threads)
+    assert threads
+    seeder.close()
+    assert seeder.pool is None
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    # A later round starts a fresh pool
+    assert seeder.run_round(900.0) == [('10.0.0.1', 'a.example.com', 900)]
+    assert seeder.pool is not None
+
+def test_seeded_labels_cached_until_expiry():
+    pytest.importorskip('psutil')
+    agent = NetworkMonitorAgent()
+    agent.clock = VirtualClock(start=0)
+    seeder = ServiceSeeder(['github.com'], StubResolver({'github.com': [('140.82.112.3', 60)]}))
+    try:
+        agent.seed_results.put(seeder.run_round(agent.clock.monotonic()))
+    finally:
+        seeder.close()
+    agent.apply_seeds()
+    label = agent.domain_cache['140.82.112.3'][0]
+    assert agent.resolve_ip_to_domain('140.82.112.3', allow_lookup=False) == label
+    assert agent.dns_cache_hits == 1
+    
+    agent.clock.advance(SEED_MIN_REFRESH + SEED_POLL_MAX)
+    agent.resolve_ip_to_domain('140.82.112.3', allow_lookup=False)
+    assert agent.dns_cache_misses == 1
+
+class RecordingEvent:
+    """Event stand-in that records wait timeouts and ends the worker after the first one"""
+
+    def __init__(self, lease):
+        self.lease = lease
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        self.lease.valid = False
+        return False
+
+    def is_set(self):
+        return False
+
+def seeding_waits(agent):
+    lease = _WorkerLease('seeder')
+    agent.power.ac_power = RecordingEvent(lease)
+    agent.stop_event = RecordingEvent(lease)
+    agent.is_running = True
+    agent.seeding_loop(lease)
+    return agent.power.ac_power.waits, agent.stop_event.waits
+
+@pytest.fixture
+def seeding_agent():
+    pytest.importorskip('psutil')
+    agent = NetworkMonitorAgent()
+    agent.clock = VirtualClock(start=0)
+    resolver = StubResolver({'github.com': [('140.82.112.3', 60)]})
+    agent.seeder = ServiceSeeder(['github.com'], resolver)
+    yield agent, resolver
+    agent.seeder.close()
+
+def test_seeding_sleeps_until_ac_power_on_battery(seeding_agent):
+    agent, resolver = seeding_agent
+    agent.power.on_battery = True
+    assert seeding_waits(agent) == ([SEED_POLL_MAX], [])
+    assert resolver.calls == []
+
+def test_seeding_backs_off_while_enrichment_is_shed(seeding_agent, monkeypatch):
+    agent, resolver = seeding_agent
+    monkeypatch.setattr(ResourceGovernor, 'skip_enrichment', property(lambda self: True))
+    assert seeding_waits(agent) == ([], [SEED_POLL_MAX])
+    assert resolver.calls == []
+
+def test_seeding_waits_for_next_due_name(seeding_agent):
+    agent, resolver = seeding_agent
+    assert seeding_waits(agent) == ([], [SEED_MIN_REFRESH])
+    assert resolver.calls == ['github.com']
@@ -0,0 +1,136 @@
+"""RateSketch and HyperLogLog accuracy, merging and serialized size"""
+
+import json
+import random
+
+import pytest
+
+from network_monitor_agent import RATE_SKETCH_ACCURACY, HLL_PRECISION, RateSketch, HyperLogLog
+
+QUANTILES = [0.5, 0.75, 0.9, 0.95, 0.99]
+HLL_STANDARD_ERROR = 1.04 / (1 << HLL_PRECISION) ** 0.5
+
+def exact_quantile(values, q):
+    """The value RateSketch.quantile estimates: rank q * (n - 1) of the sorted samples"""
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+def rates(distribution, count=20000, seed=1):
+    rng = random.Random(seed)
+    if distribution == 'uniform':
+        return [rng.uniform(1e3, 1e5) for _ in range(count)]
+    if distribution == 'lognormal':
+        return [rng.lognormvariate(10, 2) for _ in range(count)]
+    return [rng.paretovariate(1.5) * 1e3 for _ in range(count)]
+
+def addresses(count, start=0):
+    return [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(start, start + count)]
+
+@pytest.mark.parametrize('distribution', ['uniform', 'lognormal', 'pareto'])
+def test_rate_quantiles_within_relative_accuracy(distribution):
+    values = rates(distribution)
+    sketch = RateSketch()
+    for value in values:
+        sketch.add(value)
+    for q in QUANTILES:
+        exact = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= RATE_SKETCH_ACCURACY * exact
+    assert sketch.quantile(1) == max(values)
+
+def test_rate_idle_seconds_count_as_zero():
+    sketch = RateSketch()
+    for value in [0] * 60 + [5000] * 40:
+        sketch.add(value)
+    assert sketch.quantile(0.5) == 0.0
+    assert abs(sketch.quantile(0.95) - 5000) <= RATE_SKETCH_ACCURACY * 5000
+
+def test_rate_merge_matches_single_sketch():
+    values = rates('lognormal')
+    whole, first, second = RateSketch(), RateSketch(), RateSketch()
+    for i, value in enumerate(values):
+        whole.add(value)
+        (first if i % 2 else second).add(value)
+    merged = first.merge(second)
+    assert merged.to_dict() == whole.to_dict()
+    for q in QUANTILES:
+        assert merged.quantile(q) == whole.quantile(q)
+
+def test_rate_merge_rejects_different_accuracy():
+    with pytest.raises(ValueError):
+        RateSketch().merge(RateSketch(relative_accuracy=0.01))
+
+def test_rate_serialized_size_and_round_trip():
+    sketch = RateSketch()
+    for value in rates('pareto', count=50000):
+        sketch.add(value)
+    data = sketch.to_dict()
+    assert len(json.dumps(data)) < 1024
+    restored = RateSketch.from_dict(json.loads(json.dumps(data)))
+    for q in QUANTILES:
+        assert restored.quantile(q) == sketch.quantile(q)
+    assert restored.count == sketch.count
+
+@pytest.mark.parametrize('cardinality', [10, 100, 1000, 5000, 20000, 100000])
+def test_hll_cardinality_error(cardinality):
+    sketch = HyperLogLog()
+    for address in addresses(cardinality):
+        sketch.add(address)
+        sketch.add(address)  # duplicates must not count
+    # Three standard errors; small cardinalities use linear counting and are near exact
+    assert abs(sketch.estimate() - cardinality) <= max(3 * HLL_STANDARD_ERROR * cardinality, 1)
+
+def test_hll_mean_error_near_standard_error():
+    errors = []
+    for seed in range(20):
+        sketch = HyperLogLog()
+        for address in addresses(10000, start=seed * 10000):
+            sketch.add(address)
+        errors.append(abs(sketch.estimate() - 10000) / 10000)
+    assert sum(errors) / len(errors) <= 1.5 * HLL_STANDARD_ERROR
+
+def test_hll_merge_matches_union():
+    first, second, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for address in addresses(6000):
+        first.add(address)
+        union.add(address)
+    for address in addresses(6000, start=3000):
+        second.add(address)
+        union.add(address)
+    merged = first.merge(second)
+    assert merged.registers == union.registers
+    assert merged.estimate() == union.estimate()
+
+def test_hll_merge_rejects_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog().merge(HyperLogLog(precision=HLL_PRECISION + 1))
+
+@pytest.mark.parametrize('cardinality', [0, 100, 100000])
+def test_hll_serialized_size_and_round_trip(cardinality):
+    sketch = HyperLogLog()
+    for address in addresses(cardinality):
+        sketch.add(address)
+    data = sketch.to_string()
+    assert len(data) < 1024
+    restored = HyperLogLog.from_string(data)
+    assert restored.registers == sketch.registers
+    assert restored.estimate() == sketch.estimate()
+
+def test_hll_rejects_wrong_register_count():
+    with pytest.raises(ValueError):
+        HyperLogLog.from_string(HyperLogLog(precision=HLL_PRECISION + 1).to_string())
+
+def test_rates_weighted_by_tick_length_across_cadences():
+    pytest.importorskip('psutil')
+    from network_monitor_agent import NetworkMonitorAgent
+    agent = NetworkMonitorAgent()
+    usage = lambda bps, seconds: {'example.com': {'upload': 0.0, 'download': bps * seconds / 1024 / 1024, 'count': 1}}
+    
+    # 45 idle-cadence seconds at 1 KB/s, then 5 one-second ticks at 1 MB/s
+    for _ in range(3):
+        agent.aggregate_usage(usage(1e3, 15), 15)
+    for _ in range(5):
+        agent.aggregate_usage(usage(1e6, 1), 1)
+    rate = agent.network_stats['example.com']['rate']
+    assert rate.count == 50
+    assert rate.quantile(0.5) == pytest.approx(1e3, rel=RATE_SKETCH_ACCURACY)
+    assert rate.quantile(0.95) == pytest.approx(1e6, rel=RATE_SKETCH_ACCURACY)
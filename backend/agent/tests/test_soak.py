@@ -0,0 +1,35 @@
+"""Short simulated soak runs: flat memory passes, a leak past the limit fails"""
+
+import pytest
+
+pytest.importorskip('psutil')
+
+from network_monitor_agent import NetworkMonitorAgent
+from agent_harness import SOAK_GROWTH_LIMIT, soak_agent
+
+# Six simulated hours over a small host pool, so the caches fill within the warm-up;
+# the run still covers the simulated nightly backend outage and the flush after it
+SHORT_SOAK = dict(days=0.25, tick_seconds=120, sample_hours=1, warmup_hours=1, hosts=50)
+
+def test_short_soak_passes():
+    assert soak_agent(**SHORT_SOAK)
+
+def test_short_soak_fails_on_leak(monkeypatch):
+    leaked = []
+    tick = NetworkMonitorAgent.monitor_network_traffic
+    
+    def leaky_tick(self):
+        tick(self)
+        leaked.append(bytearray(4096))
+    
+    monkeypatch.setattr(NetworkMonitorAgent, 'monitor_network_traffic', leaky_tick)
+    assert not soak_agent(**SHORT_SOAK)
+    # The leak after the warm-up alone exceeds the limit
+    measured_ticks = (SHORT_SOAK['days'] * 24 - SHORT_SOAK['warmup_hours']) * 3600 / SHORT_SOAK['tick_seconds']
+    assert measured_ticks * 4096 > SOAK_GROWTH_LIMIT
+
+def test_warmup_capped_at_half_the_run(capsys):
+    soak_agent(days=0.05, tick_seconds=120, sample_hours=0.25, hosts=20)
+    output = capsys.readouterr().out
+    assert 'Warm-up: 0.6 h' in output
+    assert 'Growth after warm-up' in output
@@ -0,0 +1,137 @@
+"""Self-update manifests: signature checks and delta verification"""
+
+import os
+import sys
+import time
+import hashlib
+import subprocess
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from network_monitor_agent import (UPDATE_PUBLIC_KEY_FILE, SelfUpdater, make_delta, manifest_signing_payload,
+                                   ed25519_verify, _WorkerLease)
+
+OLD = b''.join(b'# line %d of the installed agent\n' % i for i in range(200))
+NEW = OLD.replace(b'# line 100 ', b'# line one hundred ')
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+@pytest.fixture
+def key():
+    return Ed25519PrivateKey.generate()
+
+@pytest.fixture
+def updater(tmp_path, key):
+    with open(tmp_path / UPDATE_PUBLIC_KEY_FILE, 'w') as f:
+        f.write(key.public_key().public_bytes_raw().hex() + '\n')
+    with open(tmp_path / 'agent.py', 'wb') as f:
+        f.write(OLD)
+    return SelfUpdater(install_dir=str(tmp_path), state_file=str(tmp_path / 'update.json'))
+
+def signed(key, version='9.0.0', data=NEW):
+    manifest = {'version': version, 'rolloutPercent': 100, 'files': {'agent.py': {
+        'sha256': sha256(data), 'size': len(data), 'url': 'full/agent.py',
+        'deltas': {sha256(OLD): {'from': '1.0.0', 'url': 'delta/agent.py', 'size': 0}}}}}
+    manifest['signature'] = key.sign(manifest_signing_payload(manifest)).hex()
+    return manifest
+
+def test_signed_manifest_is_installed_from_its_delta(updater, key):
+    downloads = {'delta/agent.py': make_delta(OLD, NEW), 'full/agent.py': NEW}
+    assert updater.verify(signed(key))
+    assert updater.stage(signed(key), downloads.__getitem__) == ['agent.py']
+    assert (updater.stats['filesPatched'], updater.stats['filesDownloaded']) == (1, 0)
+    updater.install('9.0.0', ['agent.py'])
+    with open(os.path.join(updater.install_dir, 'agent.py'), 'rb') as f:
+        assert f.read() == NEW
+
+@pytest.mark.parametrize('tamper', [
+    lambda m: m.update(version='9.0.1'),
+    lambda m: m['files']['agent.py'].update(sha256=sha256(b'evil')),
+    lambda m: m['files'].update({'extra.py': {'sha256': sha256(b''), 'size': 0, 'url': 'x', 'deltas': {}}}),
+    lambda m: m.update(signature=m['signature'][:-2] + ('00' if m['signature'][-2:] != '00' else '01')),
+    lambda m: m.update(signature='zz'),
+    lambda m: m.pop('signature'),
+])
+def test_tampered_manifest_rejected(updater, key, tamper):
+    manifest = signed(key)
+    tamper(manifest)
+    assert not updater.verify(manifest)
+    with pytest.raises(ValueError):
+        updater.stage(manifest, lambda url: pytest.fail('nothing is fetched for an unsigned manifest'))
+
+def test_manifest_signed_by_another_key_rejected(updater):
+    assert not updater.verify(signed(Ed25519PrivateKey.generate()))
+
+def test_tampered_delta_falls_back_to_the_full_file(updater, key):
+    delta = bytearray(make_delta(OLD, NEW))
+    delta[-1] ^= 0xff
+    downloads = {'delta/agent.py': bytes(delta), 'full/agent.py': NEW}
+    assert updater.stage(signed(key), downloads.__getitem__) == ['agent.py']
+    assert (updater.stats['filesPatched'], updater.stats['filesDownloaded']) == (0, 1)
+    with open(os.path.join(updater.staging_dir, 'agent.py'), 'rb') as f:
+        assert f.read() == NEW
+
+def test_delta_to_other_contents_rejected(updater, key):
+    evil = NEW.replace(b'# line 5 ', b'import os; os.remove(__file__)  # ')
+    downloads = {'delta/agent.py': make_delta(OLD, evil), 'full/agent.py': evil}
+    with pytest.raises(ValueError):
+        updater.stage(signed(key), downloads.__getitem__)
+    assert not os.path.exists(os.path.join(updater.staging_dir, 'agent.py'))
+
+def test_verify_rejects_malformed_keys_and_signatures(key):
+    public = key.public_key().public_bytes_raw()
+    signature = key.sign(b'message')
+    assert ed25519_verify(public, b'message', signature)
+    assert not ed25519_verify(public, b'message!', signature)
+    assert not ed25519_verify(public[:31], b'message', signature)
+    assert not ed25519_verify(public, b'message', signature[:63])
+
+def test_replaced_worker_stops_before_touching_files(updater, key):
+    lease = _WorkerLease('updater')
+    downloads = {'delta/agent.py': make_delta(OLD, NEW), 'full/agent.py': NEW}
+    assert updater.stage(signed(key), downloads.__getitem__, lease) == ['agent.py']
+    lease.valid = False
+    with pytest.raises(RuntimeError):
+        updater.install('9.0.0', ['agent.py'], lease)
+    with pytest.raises(RuntimeError):
+        updater.stage(signed(key), downloads.__getitem__, lease)
+    with open(os.path.join(updater.install_dir, 'agent.py'), 'rb') as f:
+        assert f.read() == OLD
+    assert updater.state.get('status') is None
+
+def test_update_postponed_while_an_abandoned_attempt_holds_the_lock(key, monkeypatch):
+    pytest.importorskip('psutil')
+    from network_monitor_agent import NetworkMonitorAgent
+    agent = NetworkMonitorAgent()
+    manifest = signed(key)
+    monkeypatch.setattr(agent, 'update_request', lambda *args, **kwargs: type('Response', (), {
+        'status_code': 200, 'headers': {}, 'json': lambda self: manifest})())
+    monkeypatch.setattr(agent.updater, 'verify', lambda manifest: True)
+    monkeypatch.setattr(agent.updater, 'wanted', lambda manifest, system_id: True)
+    monkeypatch.setattr(agent.updater, 'stage', lambda *args: pytest.fail('staged while locked'))
+    with SelfUpdater.lock:
+        assert not agent.check_for_update(_WorkerLease('updater'))
+    assert not SelfUpdater.lock.locked()
+
+def test_relaunch_runs_command_after_the_process_exits(tmp_path):
+    pytest.importorskip('psutil')
+    agent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    marker = str(tmp_path / 'relaunched')
+    child = subprocess.run([sys.executable, '-c', f"""
+import os, sys
+sys.path.insert(0, {agent_dir!r})
+from network_monitor_agent import restart_process
+restart_process([sys.executable, '-c', 'import sys, psutil; open(sys.argv[1], "w").write(str(psutil.pid_exists(int(sys.argv[2]))))',
+                 {marker!r}, str(os.getpid())])
+"""], timeout=30)
+    assert child.returncode == 0
+    deadline = time.monotonic() + 30
+    while not os.path.exists(marker) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    with open(marker) as f:
+        assert f.read() == 'False'  # the old process was gone when the command ran
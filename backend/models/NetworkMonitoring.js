@@ -23,7 +23,21 @@ const WebsiteUsageSchema = new mongoose.Schema({
   requestCount: {
     type: Number,
     default: 0
-  }
+  },
+  // Per-second throughput percentiles reported by the agent (bytes/sec)
+  rateBps: {
+    p50: Number,
+    p95: Number,
+    p99: Number,
+    max: Number
+  },
+  // Serialized mergeable rate sketch (DDSketch bins) for fleet-wide percentiles
+  rateSketch: mongoose.Schema.Types.Mixed,
+  // Distinct destinations estimated by the agent's HyperLogLog sketches
+  distinctRemoteIps: Number,
+  distinctRemotePorts: Number,
+  // Serialized HyperLogLog registers ({ p, ips, ports }), mergeable by register-wise max
+  destinationSketch: mongoose.Schema.Types.Mixed
 }, { _id: false });
 
 const NetworkMonitoringSchema = new mongoose.Schema({
@@ -75,6 +89,8 @@ const NetworkMonitoringSchema = new mongoose.Schema({
     ipAddress: String,
     macAddress: String
   },
+  // Agent self-metrics (sampling cadence, CPU cost, ...) reported with each upload
+  agentMetrics: mongoose.Schema.Types.Mixed,
   isActive: {
     type: Boolean,
     default: true
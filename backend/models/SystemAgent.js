@@ -48,10 +48,26 @@ const SystemAgentSchema = new mongoose.Schema({
     type: Boolean,
     default: true
   },
+  // Set by an admin for branch-office relays, the only agents allowed to verify
+  // other agents' tokens and upload on their behalf
+  isRelay: {
+    type: Boolean,
+    default: false
+  },
   status: {
     type: String,
     enum: ['active', 'inactive', 'suspended', 'uninstalled'],
     default: 'active'
+  },
+  // Commands queued by admins, taken by the agent's next command poll
+  pendingCommands: {
+    type: [new mongoose.Schema({
+      type: { type: String, required: true },
+      config: mongoose.Schema.Types.Mixed,
+      issuedAt: { type: Date, default: Date.now }
+    }, { _id: false })],
+    default: [],
+    select: false
   }
 }, {
   timestamps: true
@@ -1,4 +1,8 @@
 const express = require('express');
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
+const rateLimit = require('express-rate-limit');
 const router = express.Router();
 const NetworkMonitoring = require('../models/NetworkMonitoring');
 const SystemAgent = require('../models/SystemAgent');
@@ -164,6 +168,103 @@ router.post('/register', protect, async (req, res) => {
   }
 });
 
+// Build and save one NetworkMonitoring document from an agent's /logs body.
+// Returns null when the body lacks the required totals.
+const saveNetworkLog = async (agent, body) => {
+  const { 
+    totalUploadMB, 
+    totalDownloadMB, 
+    websites, 
+    agentVersion,
+    systemInfo,
+    agentMetrics
+  } = body || {};
+
+  // Validate required fields
+  if (totalUploadMB === undefined || totalDownloadMB === undefined) {
+    return null;
+  }
+
+  // Filter out websites with empty or invalid domains
+  const validWebsites = (websites || []).filter(site => {
+    return site && site.domain && site.domain.trim() !== '';
+  });
+
+  // Create monitoring log
+  const log = new NetworkMonitoring({
+    systemName: agent.systemName,
+    systemId: agent.systemId,
+    userId: agent.userId,
+    timestamp: new Date(),
+    totalUploadMB: parseFloat(totalUploadMB) || 0,
+    totalDownloadMB: parseFloat(totalDownloadMB) || 0,
+    websites: validWebsites,
+    agentVersion: agentVersion || '1.0.0',
+    systemInfo: systemInfo || agent.systemInfo,
+    agentMetrics
+  });
+
+  await log.save();
+  return log;
+};
+
+// Emit real-time updates via Socket.IO for freshly saved logs
+const emitNetworkUpdates = async (io, logs) => {
+  if (!io || logs.length === 0) {
+    return;
+  }
+  logs.forEach(log => {
+    io.emit('network-update', {
+      systemId: log.systemId,
+      systemName: log.systemName,
+      totalUploadMB: log.totalUploadMB,
+      totalDownloadMB: log.totalDownloadMB,
+      totalDataMB: log.totalDataMB,
+      timestamp: log.timestamp,
+      websites: log.websites
+    });
+  });
+  
+  // Also emit aggregated stats update
+  try {
+    const stats = await NetworkMonitoring.aggregate([
+      {
+        $match: {
+          timestamp: { $gte: new Date(Date.now() - 24 * 60 * 60 * 1000) } // Last 24 hours
+        }
+      },
+      {
+        $group: {
+          _id: null,
+          totalUpload: { $sum: '$totalUploadMB' },
+          totalDownload: { $sum: '$totalDownloadMB' },
+          totalData: { $sum: '$totalDataMB' },
+          recordCount: { $sum: 1 }
+        }
+      }
+    ]);
+    
+    const totalAgents = await SystemAgent.countDocuments({ isActive: true });
+    
+    io.emit('network-stats-update', {
+      totalAgents,
+      usage: stats[0] || { totalUpload: 0, totalDownload: 0, totalData: 0, recordCount: 0 },
+      timestamp: new Date()
+    });
+  } catch (error) {
+    console.error('Error emitting stats update:', error);
+  }
+};
+
+// Resolve an agent token to its active SystemAgent, or null
+const findAgentByToken = async (token) => {
+  const decoded = token && SystemAgent.verifyAgentToken(token);
+  if (!decoded || decoded.type !== 'agent') {
+    return null;
+  }
+  return SystemAgent.findOne({ systemId: decoded.systemId, isActive: true });
+};
+
 /**
  * @desc    Receive real-time network monitoring data from agent
  * @route   POST /api/network-monitoring/logs
@@ -171,89 +272,98 @@ router.post('/register', protect, async (req, res) => {
  */
 router.post('/logs', verifyAgent, async (req, res) => {
   try {
-    const { 
-      totalUploadMB, 
-      totalDownloadMB, 
-      websites, 
-      agentVersion,
-      systemInfo 
-    } = req.body;
-
-    // Validate required fields
-    if (totalUploadMB === undefined || totalDownloadMB === undefined) {
+    const log = await saveNetworkLog(req.agent, req.body);
+    if (!log) {
       return res.status(400).json({ msg: 'Upload and download data are required' });
     }
 
-    // Filter out websites with empty or invalid domains
-    const validWebsites = (websites || []).filter(site => {
-      return site && site.domain && site.domain.trim() !== '';
-    });
+    await emitNetworkUpdates(req.io, [log]);
 
-    // Create monitoring log
-    const log = new NetworkMonitoring({
-      systemName: req.systemName,
-      systemId: req.systemId,
-      userId: req.agent.userId,
-      timestamp: new Date(),
-      totalUploadMB: parseFloat(totalUploadMB) || 0,
-      totalDownloadMB: parseFloat(totalDownloadMB) || 0,
-      websites: validWebsites,
-      agentVersion: agentVersion || '1.0.0',
-      systemInfo: systemInfo || req.agent.systemInfo
+    res.status(201).json({
+      success: true,
+      message: 'Network data logged successfully'
     });
+  } catch (error) {
+    console.error('Network logging error:', error);
+    res.status(500).json({ msg: 'Server error during logging' });
+  }
+});
 
-    await log.save();
-
-    // Emit real-time update via Socket.IO
-    if (req.io) {
-      req.io.emit('network-update', {
-        systemId: log.systemId,
-        systemName: log.systemName,
-        totalUploadMB: log.totalUploadMB,
-        totalDownloadMB: log.totalDownloadMB,
-        totalDataMB: log.totalDataMB,
-        timestamp: log.timestamp,
-        websites: log.websites
-      });
-      
-      // Also emit aggregated stats update
-      try {
-        const stats = await NetworkMonitoring.aggregate([
-          {
-            $match: {
-              timestamp: { $gte: new Date(Date.now() - 24 * 60 * 60 * 1000) } // Last 24 hours
-            }
-          },
-          {
-            $group: {
-              _id: null,
-              totalUpload: { $sum: '$totalUploadMB' },
-              totalDownload: { $sum: '$totalDownloadMB' },
-              totalData: { $sum: '$totalDataMB' },
-              recordCount: { $sum: 1 }
-            }
-          }
-        ]);
-        
-        const totalAgents = await SystemAgent.countDocuments({ isActive: true });
-        
-        req.io.emit('network-stats-update', {
-          totalAgents,
-          usage: stats[0] || { totalUpload: 0, totalDownload: 0, totalData: 0, recordCount: 0 },
-          timestamp: new Date()
-        });
-      } catch (error) {
-        console.error('Error emitting stats update:', error);
+// Relay endpoints act for other agents, so they are refused to agents an admin has not marked as relays
+const verifyRelay = (req, res, next) => {
+  if (!req.agent.isRelay) {
+    return res.status(403).json({ msg: 'Agent is not a relay' });
+  }
+  next();
+};
+
+// A relay caches verified tokens, so it needs few verify calls; more than this is token guessing
+const relayVerifyLimiter = rateLimit({
+  windowMs: 60 * 1000,
+  max: 30,
+  keyGenerator: (req) => req.systemId,
+  message: { msg: 'Too many token verification requests' },
+  standardHeaders: true,
+  legacyHeaders: false
+});
+
+/**
+ * @desc    Check agent tokens on behalf of a branch-office relay, which caches the answers
+ * @route   POST /api/network-monitoring/relay/verify
+ * @access  Relay agent (the relay's own agent token, isRelay set by an admin)
+ */
+router.post('/relay/verify', verifyAgent, verifyRelay, relayVerifyLimiter, async (req, res) => {
+  try {
+    const tokens = Array.isArray(req.body?.tokens) ? req.body.tokens.slice(0, 100) : [];
+    const agents = await Promise.all(tokens.map(findAgentByToken));
+    res.status(200).json({ valid: agents.map(agent => !!agent) });
+  } catch (error) {
+    console.error('Relay verification error:', error);
+    res.status(500).json({ msg: 'Server error' });
+  }
+});
+
+/**
+ * @desc    Receive the merged uploads and heartbeats of the agents behind a relay
+ * @route   POST /api/network-monitoring/logs/bulk
+ * @access  Relay agent (the relay's own agent token; each batch carries its agent's token)
+ */
+router.post('/logs/bulk', verifyAgent, verifyRelay, async (req, res) => {
+  try {
+    const { batches, alive } = req.body || {};
+    const logs = [];
+    let rejected = 0;
+
+    for (const batch of Array.isArray(batches) ? batches : []) {
+      const agent = await findAgentByToken(batch?.token);
+      const log = agent && await saveNetworkLog(agent, batch.payload);
+      if (log) {
+        logs.push(log);
+      } else {
+        rejected++;
       }
     }
 
-    res.status(201).json({
+    // Agents that only sent heartbeats through the relay count as alive too
+    const aliveAgents = await Promise.all((Array.isArray(alive) ? alive : []).map(findAgentByToken));
+    const systemIds = [...logs.map(log => log.systemId), ...aliveAgents.filter(Boolean).map(agent => agent.systemId)];
+    if (systemIds.length > 0) {
+      await SystemAgent.updateMany(
+        { systemId: { $in: systemIds } },
+        { lastHeartbeat: Date.now(), status: 'active' }
+      );
+    }
+
+    await emitNetworkUpdates(req.io, logs);
+
+    res.status(200).json({
       success: true,
-      message: 'Network data logged successfully'
+      accepted: logs.length,
+      rejected
     });
   } catch (error) {
-    console.error('Network logging error:', error);
-    res.status(500).json({ msg: 'Server error during logging' });
+    console.error('Bulk logging error:', error);
+    res.status(500).json({ msg: 'Server error during bulk logging' });
   }
 });
 
@@ -408,14 +518,14 @@ router.get('/agents', protect, authorize('admin'), async (req, res) => {
 });
 
 /**
- * @desc    Update agent status (activate/deactivate/suspend)
+ * @desc    Update agent status (activate/deactivate/suspend) or mark it as a branch-office relay
  * @route   PATCH /api/network-monitoring/agents/:systemId
  * @access  Admin only
  */
 router.patch('/agents/:systemId', protect, authorize('admin'), async (req, res) => {
   try {
     const { systemId } = req.params;
-    const { status, isActive } = req.body;
+    const { status, isActive, isRelay } = req.body;
 
     const agent = await SystemAgent.findOne({ systemId });
 
@@ -425,6 +535,12 @@ router.patch('/agents/:systemId', protect, authorize('admin'), async (req, res)
 
     if (status) agent.status = status;
     if (isActive !== undefined) agent.isActive = isActive;
+    if (isRelay !== undefined) {
+      if (typeof isRelay !== 'boolean') {
+        return res.status(400).json({ msg: 'isRelay must be true or false' });
+      }
+      agent.isRelay = isRelay;
+    }
 
     await agent.save();
 
@@ -533,6 +649,298 @@ router.post('/heartbeat', verifyAgent, async (req, res) => {
   }
 });
 
+// Push channel: agents long-poll GET /commands, admins queue commands for them.
+// Queued commands are kept on the SystemAgent document, so they survive a
+// restart and reach the agent whichever server instance holds its poll; each
+// instance checks the queues of the polls it holds every COMMAND_SWEEP_SECONDS.
+const COMMAND_TYPES = ['flush', 'config', 'rules', 'update'];
+const MAX_COMMAND_WAIT_SECONDS = 300;
+const MAX_QUEUED_COMMANDS = 20;
+const COMMAND_SWEEP_SECONDS = 5;
+const waitingAgents = new Map(); // systemId -> { res, timer }, polls held by this instance
+
+// Append commands to the queues of the matching agents (or put them back in front), keeping the newest
+const pushCommands = (filter, commands, atFront = false) => SystemAgent.updateMany(filter, {
+  $push: {
+    pendingCommands: { $each: commands, ...(atFront ? { $position: 0 } : {}), $slice: -MAX_QUEUED_COMMANDS }
+  }
+});
+
+const deliverCommands = async (systemId) => {
+  if (!waitingAgents.has(systemId)) {
+    return false;
+  }
+  // Taking the queue is a single atomic update, so only one instance delivers a command
+  const agent = await SystemAgent.findOneAndUpdate(
+    { systemId, 'pendingCommands.0': { $exists: true } },
+    { $set: { pendingCommands: [] } }
+  ).select('pendingCommands').lean();
+  if (!agent) {
+    return false;
+  }
+  const waiting = waitingAgents.get(systemId);
+  if (!waiting) {
+    // The poll ended while the queue was being taken: keep the commands for the next one
+    await pushCommands({ systemId }, agent.pendingCommands, true);
+    return false;
+  }
+  clearTimeout(waiting.timer);
+  waitingAgents.delete(systemId);
+  waiting.res.status(200).json({ success: true, commands: agent.pendingCommands });
+  return true;
+};
+
+// Answer the polls held by this instance whose agents have commands queued
+const deliverQueuedCommands = async () => {
+  if (waitingAgents.size === 0) {
+    return 0;
+  }
+  const agents = await SystemAgent.find({
+    systemId: { $in: [...waitingAgents.keys()] },
+    'pendingCommands.0': { $exists: true }
+  }).select('systemId').lean();
+  const delivered = await Promise.all(agents.map((agent) => deliverCommands(agent.systemId)));
+  return delivered.filter(Boolean).length;
+};
+
+// Queue a command for every agent matching filter; resolves to the number of agents it was queued for
+const queueCommand = async (filter, command) => {
+  const result = await pushCommands(filter, [{ ...command, issuedAt: new Date() }]);
+  await deliverQueuedCommands();
+  return result.modifiedCount;
+};
+
+// Commands queued through another instance reach the polls this one holds
+setInterval(() => {
+  deliverQueuedCommands().catch((error) => console.error('Command delivery error:', error));
+}, COMMAND_SWEEP_SECONDS * 1000).unref();
+
+/**
+ * @desc    Long-poll for commands (flush now, config changes, rule updates)
+ * @route   GET /api/network-monitoring/commands?wait=240
+ * @access  Agent (verified with agent token)
+ *
+ * Answers 200 with the queued commands as soon as there are any, or 204 when
+ * the wait runs out. An agent holding a poll open is live, so while connected
+ * it sends no heartbeats.
+ */
+router.get('/commands', verifyAgent, (req, res) => {
+  const systemId = req.systemId;
+  const wait = Math.min(Math.max(parseInt(req.query.wait, 10) || 0, 0), MAX_COMMAND_WAIT_SECONDS);
+
+  // A newer poll from the same agent replaces one left over from a dropped connection
+  const previous = waitingAgents.get(systemId);
+  if (previous) {
+    clearTimeout(previous.timer);
+    previous.res.status(204).end();
+  }
+
+  const timer = setTimeout(() => {
+    if (waitingAgents.get(systemId)?.res === res) {
+      waitingAgents.delete(systemId);
+      res.status(204).end();
+    }
+  }, wait * 1000);
+  waitingAgents.set(systemId, { res, timer });
+  req.on('close', () => {
+    if (waitingAgents.get(systemId)?.res === res) {
+      clearTimeout(timer);
+      waitingAgents.delete(systemId);
+    }
+  });
+
+  deliverCommands(systemId).catch((error) => console.error('Command delivery error:', error));
+});
+
+/**
+ * @desc    Queue a command for one agent, or for every agent with systemId "all"
+ * @route   POST /api/network-monitoring/agents/:systemId/commands
+ * @access  Admin only
+ */
+router.post('/agents/:systemId/commands', protect, authorize('admin'), async (req, res) => {
+  try {
+    const { systemId } = req.params;
+    const { type, config } = req.body;
+
+    if (!COMMAND_TYPES.includes(type)) {
+      return res.status(400).json({ msg: `Command type must be one of: ${COMMAND_TYPES.join(', ')}` });
+    }
+    if (type === 'config' && (!config || typeof config !== 'object')) {
+      return res.status(400).json({ msg: 'A config object is required' });
+    }
+
+    if (systemId !== 'all' && !(await SystemAgent.exists({ systemId }))) {
+      return res.status(404).json({ msg: 'Agent not found' });
+    }
+
+    const command = type === 'config' ? { type, config } : { type };
+    const queued = await queueCommand(systemId === 'all' ? { isActive: true } : { systemId }, command);
+
+    res.status(202).json({
+      success: true,
+      queued
+    });
+  } catch (error) {
+    console.error('Command queue error:', error);
+    res.status(500).json({ msg: 'Server error' });
+  }
+});
+
+// Classification rules bundle served to agents; edited through PUT /rules
+const RULES_FILE = path.join(__dirname, '..', 'agent', 'classification_rules.json');
+let rulesCache = null; // { mtimeMs, etag, body }, re-read when the file changes
+
+const loadRules = async () => {
+  const stat = await fs.promises.stat(RULES_FILE);
+  if (!rulesCache || rulesCache.mtimeMs !== stat.mtimeMs) {
+    const body = await fs.promises.readFile(RULES_FILE);
+    const etag = `"${crypto.createHash('sha256').update(body).digest('hex').slice(0, 32)}"`;
+    rulesCache = { mtimeMs: stat.mtimeMs, etag, body };
+  }
+  return rulesCache;
+};
+
+/**
+ * @desc    Classification rules bundle (domain names, CDN domains, IP ranges)
+ * @route   GET /api/network-monitoring/rules
+ * @access  Agent (verified with agent token)
+ *
+ * Agents poll hourly with If-None-Match, so an unchanged bundle costs a 304.
+ */
+router.get('/rules', verifyAgent, async (req, res) => {
+  try {
+    const rules = await loadRules();
+    res.set('ETag', rules.etag);
+    res.set('Cache-Control', 'no-cache');
+    if (req.headers['if-none-match'] === rules.etag) {
+      return res.status(304).end();
+    }
+    res.type('application/json').send(rules.body);
+  } catch (error) {
+    console.error('Rules fetch error:', error);
+    res.status(500).json({ msg: 'Server error' });
+  }
+});
+
+/**
+ * @desc    Replace the classification rules bundle served to agents
+ * @route   PUT /api/network-monitoring/rules
+ * @access  Admin
+ */
+router.put('/rules', protect, authorize('admin'), async (req, res) => {
+  try {
+    const { domains, cdnDomains, serviceIndicators, ipRanges } = req.body;
+
+    if (!domains || typeof domains !== 'object' || !ipRanges || typeof ipRanges !== 'object') {
+      return res.status(400).json({ msg: 'domains and ipRanges objects are required' });
+    }
+    const badRange = Object.keys(ipRanges).find((cidr) => !/^\d{1,3}(\.\d{1,3}){3}\/\d{1,2}$/.test(cidr));
+    if (badRange) {
+      return res.status(400).json({ msg: `Invalid IP range: ${badRange}` });
+    }
+
+    const current = await loadRules().catch(() => null);
+    const previousVersion = current ? parseInt(JSON.parse(current.body).version, 10) || 0 : 0;
+    const bundle = {
+      version: String(previousVersion + 1),
+      domains,
+      cdnDomains: cdnDomains || [],
+      serviceIndicators: serviceIndicators || [],
+      ipRanges
+    };
+
+    // Write then rename so agents never receive a half-written bundle
+    const temporary = `${RULES_FILE}.tmp`;
+    await fs.promises.writeFile(temporary, JSON.stringify(bundle, null, 2) + '\n');
+    await fs.promises.rename(temporary, RULES_FILE);
+    rulesCache = null;
+
+    // Agents holding a command poll pick the new version up right away, the rest on reconnecting
+    await queueCommand({ isActive: true, 'pendingCommands.type': { $ne: 'rules' } }, { type: 'rules' });
+
+    console.log(`📘 Classification rules updated to version ${bundle.version} by ${req.user.email}`);
+    res.json({ success: true, version: bundle.version });
+  } catch (error) {
+    console.error('Rules update error:', error);
+    res.status(500).json({ msg: 'Server error' });
+  }
+});
+
+// Agent self-update manifest, written by agent/build_update.py next to the
+// release files and deltas it references (served statically from /downloads)
+const UPDATE_MANIFEST_FILE = path.join(__dirname, '..', 'downloads', 'agent-manifest.json');
+let manifestCache = null; // { mtimeMs, etag, body }, re-read when the file changes
+
+const loadManifest = async () => {
+  const stat = await fs.promises.stat(UPDATE_MANIFEST_FILE);
+  if (!manifestCache || manifestCache.mtimeMs !== stat.mtimeMs) {
+    const body = await fs.promises.readFile(UPDATE_MANIFEST_FILE);
+    const etag = `"${crypto.createHash('sha256').update(body).digest('hex').slice(0, 32)}"`;
+    manifestCache = { mtimeMs: stat.mtimeMs, etag, body };
+  }
+  return manifestCache;
+};
+
+/**
+ * @desc    Get the agent update manifest (conditional GET with If-None-Match)
+ * @route   GET /api/network-monitoring/update/manifest
+ * @access  Agent (verified with agent token)
+ */
+router.get('/update/manifest', verifyAgent, async (req, res) => {
+  try {
+    const manifest = await loadManifest();
+    res.set('ETag', manifest.etag);
+    res.set('Cache-Control', 'no-cache');
+    if (req.headers['if-none-match'] === manifest.etag) {
+      return res.status(304).end();
+    }
+    res.type('application/json').send(manifest.body);
+  } catch (error) {
+    if (error.code === 'ENOENT') {
+      return res.status(404).json({ msg: 'No agent update published' });
+    }
+    console.error('Update manifest error:', error);
+    res.status(500).json({ msg: 'Server error' });
+  }
+});
+
+/**
+ * @desc    Change the share of the fleet that installs the published agent release
+ * @route   PATCH /api/network-monitoring/update/rollout
+ * @access  Admin
+ */
+router.patch('/update/rollout', protect, authorize('admin'), async (req, res) => {
+  try {
+    const rolloutPercent = Number(req.body?.rolloutPercent);
+    if (!Number.isFinite(rolloutPercent) || rolloutPercent < 0 || rolloutPercent > 100) {
+      return res.status(400).json({ msg: 'rolloutPercent must be a number from 0 to 100' });
+    }
+
+    const manifest = JSON.parse((await loadManifest()).body);
+    const widened = rolloutPercent > (manifest.rolloutPercent ?? 100);
+    manifest.rolloutPercent = rolloutPercent;
+
+    const temporary = `${UPDATE_MANIFEST_FILE}.tmp`;
+    await fs.promises.writeFile(temporary, JSON.stringify(manifest, null, 2) + '\n');
+    await fs.promises.rename(temporary, UPDATE_MANIFEST_FILE);
+    manifestCache = null;
+
+    // Newly included agents holding a command poll check right away, the rest on reconnecting
+    if (widened) {
+      await queueCommand({ isActive: true, 'pendingCommands.type': { $ne: 'update' } }, { type: 'update' });
+    }
+
+    console.log(`📦 Agent v${manifest.version} rollout set to ${rolloutPercent}% by ${req.user.email}`);
+    res.json({ success: true, version: manifest.version, rolloutPercent });
+  } catch (error) {
+    if (error.code === 'ENOENT') {
+      return res.status(404).json({ msg: 'No agent update published' });
+    }
+    console.error('Rollout update error:', error);
+    res.status(500).json({ msg: 'Server error' });
+  }
+});
+
 // @route   DELETE /api/network-monitoring/agents/:systemId
 // @desc    Delete a registered agent/system
 // @access  Admin